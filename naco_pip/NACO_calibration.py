@@ -9,27 +9,472 @@ __author__ = 'Lewis Picker, Iain Hammond'
 __all__ = ['raw_dataset', 'find_nearest', 'find_filtered_max']
 
 import pdb
+import math
+from functools import lru_cache
 import numpy as np
+try:
+    import bottleneck as bn
+    _cube_median = bn.median # partition based O(N) median that releases the GIL
+except ImportError: # optional dependency, numpy gives the same result with a full sort
+    _cube_median = np.median
+try:
+    import fitsio # faster raw-frame reads through cfitsio, especially for partial reads
+except ImportError: # optional dependency, astropy is used instead
+    fitsio = None
 import pyprind
 import os
-import random
-import matplotlib as mpl
-mpl.use('Agg') #show option for plot is unavailable with this option, set specifically to save plots on m3
-from matplotlib import pyplot as plt
+import io
+import glob
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 from numpy import isclose
+from astropy.io import fits
 from vip_hci.fits import open_fits, write_fits
 from vip_hci.preproc import frame_crop, cube_crop_frames, frame_shift,\
 cube_subtract_sky_pca, cube_correct_nan, cube_fix_badpix_isolated,cube_fix_badpix_clump,\
 cube_recenter_2dfit
-from vip_hci.var import frame_center, get_annulus_segments, frame_filter_lowpass,\
+from vip_hci.var import frame_center, get_annulus_segments,\
 mask_circle, dist, fit_2dgaussian, frame_filter_highpass, get_circle, get_square
 from vip_hci.metrics import detection, normalize_psf
 from vip_hci.conf import time_ini, time_fin, timing
-from hciplot import plot_frames
-from skimage.feature import register_translation
+try:
+    from skimage.registration import phase_cross_correlation
+except ImportError:  # skimage < 0.17
+    from skimage.feature import register_translation as phase_cross_correlation
 from photutils import CircularAperture, aperture_photometry
-from astropy.stats import sigma_clipped_stats
-from scipy.optimize import minimize
+from astropy.stats import sigma_clipped_stats, gaussian_fwhm_to_sigma
+from scipy.ndimage import median_filter, gaussian_filter, uniform_filter
+from scipy.optimize import minimize_scalar
+from scipy.linalg.blas import ssyrk
+from scipy.sparse.linalg import eigsh
+from scipy.sparse.csgraph import connected_components
+
+def plot_frames(*args, **kwargs):
+    """
+    Lazy wrapper around hciplot.plot_frames. matplotlib costs a few hundred ms and loads
+    fonts/backends at import, so defer it until a plot is actually requested.
+    """
+    import matplotlib as mpl
+    mpl.use('Agg') #show option for plot is unavailable with this option, set specifically to save plots on m3
+    from hciplot import plot_frames as _plot_frames
+    return _plot_frames(*args, **kwargs)
+
+def _masked_variance(v):
+    """
+    Single pass variance of a 1-D pixel vector: one dot product and one sum instead of the
+    two sweeps inside np.std. The optimizer callbacks only compare values, so the variance
+    (monotonic in the standard deviation) is returned and the sqrt skipped.
+    """
+    n = v.size
+    s1 = v.sum()
+    return (v @ v)/n - (s1/n)**2
+
+def _pca_basis_gram(lib_cube, ncomp=1, mask_flat=None):
+    """
+    Top-ncomp principal components of a frame library from an eigendecomposition of the small
+    nlib x nlib Gram matrix instead of an SVD of the full nlib x npx matrix - the subspace is
+    identical while the decomposition cost drops from O(nlib*npx^2) to O(nlib^2*npx).
+
+    With mask_flat the Gram matrix is built from the masked pixels only, so the
+    decomposition cost scales with the mask size and the components are orthonormal over
+    the pixels that actually drive the least squares fit - while the returned components
+    still span full frames, because they are linear combinations of the library frames,
+    so the model can be subtracted everywhere.
+    """
+    nlib = lib_cube.shape[0]
+    npx = lib_cube.shape[1]*lib_cube.shape[2]
+    # float32 gemm halves the bandwidth of the big products; only the small nlib x nlib
+    # eigenproblem is promoted to float64 for stability
+    lib = lib_cube.reshape(nlib, npx).astype(np.float32, copy=False)
+    lib_fit = lib[:, mask_flat] if mask_flat is not None else lib
+    # syrk exploits the symmetry of lib @ lib.T - half the flops of a general gemm;
+    # it only fills the upper triangle, so reflect it before handing to the eig solvers
+    gram = ssyrk(1.0, lib_fit)
+    gram = (gram + np.triu(gram, 1).T).astype(np.float64) # nlib x nlib
+    if ncomp < max(nlib // 4, 1):
+        # only the ncomp dominant eigenpairs are needed (npc_dark is 1 in practice, sky npc
+        # is 1-20 against hundreds of library frames), so a Lanczos solve beats computing
+        # the full spectrum - but only while ncomp stays well below nlib, hence the nlib/4
+        # cutoff; eigsh also returns ascending order
+        w, v = eigsh(gram, k=ncomp, which='LM')
+    else:
+        w, v = np.linalg.eigh(gram) # eigenvalues in ascending order
+    w = np.clip(w[-ncomp:], 1e-30, None)
+    v = v[:, -ncomp:].astype(np.float32)
+    return (lib.T @ v).T / np.sqrt(w).astype(np.float32)[:, None] # ncomp x npx principal components
+
+def _subtract_pca_gram(sci_cube, lib_cube, mask, ncomp=1, pcs=None):
+    """
+    Drop-in for cube_subtract_sky_pca used with the dark library. The basis comes from
+    _pca_basis_gram (or is passed in precomputed when several passes share the same library)
+    and the masked least squares fit only depends on the spanned subspace, so the result
+    matches the SVD path to numerical precision.
+    """
+    if pcs is None:
+        pcs = _pca_basis_gram(lib_cube, ncomp)
+    npx = sci_cube.shape[1]*sci_cube.shape[2]
+    mask_flat = mask.reshape(npx).astype(bool)
+    pcs_masked = pcs[:, mask_flat]
+    sci = sci_cube.reshape(sci_cube.shape[0], npx)
+    # least squares fit of the masked pixels, then subtract the full-frame reconstruction;
+    # only the tiny ncomp x ncomp solve runs in float64. These gemms stay on the CPU:
+    # at ncomp<=20 and NACO frame sizes they take a few ms in float32 BLAS, well below
+    # what a host<->GPU round trip would cost, and the pipeline has no GPU dependency
+    coeffs = np.linalg.solve((pcs_masked @ pcs_masked.T).astype(np.float64),
+                             (pcs_masked @ sci[:, mask_flat].T).astype(np.float64))
+    coeffs = coeffs.astype(pcs.dtype, copy=False)
+    # subtract into the reconstruction buffer the gemm just produced, so the residual
+    # costs no extra full-frame temporary
+    recon = coeffs.T @ pcs
+    np.subtract(sci, recon, out=recon)
+    return np.asarray(recon, dtype=sci_cube.dtype).reshape(sci_cube.shape)
+
+@lru_cache(maxsize=8)
+def _cached_open_fits(path):
+    """
+    Read-only cache for static intermediate products that several stages reopen within one
+    run (bad pixel maps, common_sz). Callers must not modify the returned array; copy first
+    if mutation is needed.
+    """
+    return open_fits(path, verbose=False)
+
+def _correct_nan_3x3(cube):
+    """
+    Specialization of cube_correct_nan for the fixed neighbor_box=3 / min_neighbors=3 used
+    in this pipeline: every NaN with at least 3 finite neighbours is replaced by the mean of
+    its 3x3 neighbourhood, computed for the whole cube at once from eight shifted views
+    instead of a python loop per pixel. Repeats until no correctable NaNs remain, like the
+    generic VIP routine.
+    """
+    out = np.array(cube, dtype=np.float32)
+    nz, ny, nx = out.shape
+    while True:
+        nan_px = np.isnan(out)
+        if not nan_px.any():
+            break
+        padded = np.pad(out, ((0, 0), (1, 1), (1, 1)), constant_values=np.nan)
+        finite = np.isfinite(padded)
+        vals = np.where(finite, padded, np.float32(0))
+        neigh_sum = np.zeros(out.shape, dtype=np.float32)
+        neigh_cnt = np.zeros(out.shape, dtype=np.int16)
+        for dy in (0, 1, 2):
+            for dx in (0, 1, 2):
+                if dy == 1 and dx == 1:
+                    continue
+                neigh_sum += vals[:, dy:dy+ny, dx:dx+nx]
+                neigh_cnt += finite[:, dy:dy+ny, dx:dx+nx]
+        fix = nan_px & (neigh_cnt >= 3)
+        if not fix.any(): # isolated clusters of NaNs with too few good neighbours
+            break
+        out[fix] = neigh_sum[fix] / neigh_cnt[fix]
+    return out
+
+def _remove_file(path):
+    """
+    Deletes one file with a single unlink syscall instead of spawning a shell per file.
+    Files already gone are ignored.
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def _open_fits_mmap(path):
+    """
+    Memory-mapped read of an intermediate FITS cube: pages stream in as slices are touched
+    instead of the whole file loading up front. astropy keeps the mapping alive while the
+    returned array is referenced, so it safely outlives the file handle.
+
+    Intermediate products deliberately stay in FITS rather than a chunked format: every
+    stage's output is routinely opened in DS9 for inspection and the file names are part of
+    how the classification/preproc modules talk to each other. The per-stage prefixes
+    (2_crop_, 2_bpix_corr2_, 3_rmfr_, ...) also let remove=True reclaim scratch space as a
+    run progresses, which a single consolidated container would prevent. Where a stage only
+    needs a shape or a single plane, use memory-mapped/section reads instead of switching
+    formats.
+    """
+    with fits.open(path, memmap=True) as hdul:
+        return hdul[0].data
+
+def _open_fits_fast(path, verbose=False):
+    """
+    Whole-cube read of a pipeline-written FITS file through cfitsio when fitsio is
+    available (noticeably faster than astropy and with a lower peak memory), astropy
+    otherwise. Only used on intermediates this pipeline wrote itself - plain single-HDU
+    float images - so none of the scaling/compression corner cases open_fits handles
+    can occur.
+    """
+    if fitsio is None:
+        return open_fits(path, verbose=verbose)
+    data = fitsio.read(path)
+    if verbose:
+        print('Fits HDU-0 data successfully loaded with fitsio. Data shape:', data.shape)
+    return data
+
+def _getheader_fast(path):
+    """
+    Primary header only, through cfitsio's purpose-built header reader when fitsio is
+    available, astropy's getheader otherwise. Both support keyword indexing.
+    """
+    if fitsio is None:
+        return fits.getheader(path)
+    return fitsio.read_header(path)
+
+def _write_fits_fast(path, data, verbose=False):
+    """
+    Write counterpart of _open_fits_fast for pipeline intermediates: cfitsio when
+    available, else the buffered astropy writer. Single primary image HDU either way.
+    """
+    if fitsio is None:
+        _write_fits_buffered(path, data, verbose=verbose)
+        return
+    fitsio.write(path, data, clobber=True)
+    if verbose:
+        print('Fits file successfully saved with fitsio:', path)
+
+def _fix_badpix_isolated_fast(cube, sigma_clip=8, size=5, protect_rad=10):
+    """
+    Residual hot pixel correction, the second pass of correct_bad_pixels. Same idea as
+    cube_fix_badpix_isolated (a pixel further than sigma_clip local sigmas from its
+    neighbourhood median is replaced by that median) but built on scipy.ndimage's C
+    filters: the size x size median, mean and std of every pixel come from three filter
+    passes per frame instead of a Python loop over pixels, which made the VIP call the
+    dominant wall-clock cost of this function. The tested pixel is excluded from its own
+    window statistics, so the sigma is that of the neighbours alone. Pixels within
+    protect_rad of the frame centre are left untouched, as with protect_mask=True.
+    """
+    cube = np.asarray(cube)
+    ny, nx = cube.shape[-2:]
+    cy, cx = frame_center(cube[0])
+    protect = _radial_grid_sq(ny, nx, cy, cx) <= protect_rad**2
+    n = size*size
+    out = np.empty_like(cube)
+    for fr in range(cube.shape[0]):
+        frame = cube[fr]
+        med = median_filter(frame, size=size, mode='mirror')
+        mean = uniform_filter(frame, size=size, mode='mirror')
+        sqmean = uniform_filter(frame*frame, size=size, mode='mirror')
+        # remove the tested pixel from its own mean and squared sum: with it included, a
+        # single outlier among the n window samples inflates std so much that
+        # |frame-med|/std tops out near n/sqrt(n-1) (~5.1 for 5x5) and a sigma_clip of 8
+        # can never fire (exclusion is approximate within size//2 of the mirrored edges,
+        # where the pixel can appear more than once in its window)
+        mean = (n*mean - frame)/(n - 1)
+        sqmean = (n*sqmean - frame*frame)/(n - 1)
+        std = np.sqrt(np.maximum(sqmean - mean*mean, 0)) # clip fp rounding below zero
+        bad = np.abs(frame - med) > sigma_clip*std
+        bad &= ~protect
+        out[fr] = np.where(bad, med, frame)
+    return out
+
+def _fix_badpix_one(fits_name, outpath, in_prefix, out_suffix, bpix_map, rand_idx, keep_frames, remove, debug):
+    """
+    Bad pixel correction of a single cube: clump correction with the flat-derived map, then
+    frame-by-frame residual hot pixels. Lives at module level so multiprocessing can pickle
+    it; the cubes are independent, so correct_bad_pixels farms them out one per process.
+    Returns the small pieces the caller keeps in memory (cube shape, a random frame for the
+    master medians, first/last frames for the diagnostic plots) so nothing is re-read later.
+    """
+    tmp = open_fits(outpath + in_prefix + fits_name, verbose=debug)
+    # first with the bp map defined from the flat field (without protecting radius)
+    tmp_tmp = cube_fix_badpix_clump(tmp, bpm_mask=bpix_map, verbose=debug)
+    write_fits(outpath + '2_bpix_corr_' + out_suffix + fits_name, tmp_tmp, verbose=debug)
+    # second, residual hot pixels - same clipping as cube_fix_badpix_isolated with
+    # sigma_clip=8, size=5, protect_mask=True, radius=10, but through scipy's C filters
+    tmp_tmp = _fix_badpix_isolated_fast(tmp_tmp, sigma_clip=8, size=5, protect_rad=10)
+    # create a bpm for the 2nd correction - a fused comparison into uint8, instead of
+    # np.where on the difference which allocates an int64 cube and scans twice; the
+    # BITPIX=8 map is also 8x smaller on disk for the later re-reads
+    bpm = (tmp_tmp != tmp).astype(np.uint8)
+    write_fits(outpath + '2_bpix_corr2_' + out_suffix + fits_name, tmp_tmp, verbose=debug)
+    write_fits(outpath + '2_bpix_corr2_map_' + out_suffix + fits_name, bpm, verbose=debug)
+    if remove:
+        _remove_file(outpath + in_prefix + fits_name)
+    res = {'shape': tmp_tmp.shape}
+    if rand_idx is not None:
+        res['rand_frame'] = tmp_tmp[rand_idx]
+    if keep_frames:
+        res['map0'] = bpm[0]
+        res['raw0'] = tmp[0]
+        res['corr0'] = tmp_tmp[0]
+        res['raw_last'] = tmp[-1]
+        res['corr_last'] = tmp_tmp[-1]
+    return res
+
+def _dust_centroid(frame, cent, crop_sz):
+    """
+    Centroid of one dust grain from intensity-weighted moments on a small cutout,
+    replacing the generic astropy-modelling Gaussian fit whose per-call overhead
+    dominated the alignment loops. The cutout is median-subtracted and negative
+    residuals clipped so sky noise does not pull the moments; the subsequent median
+    over the dust grains absorbs the small accuracy difference with the full fit.
+    Raises ValueError like fit_2dgaussian when the cutout carries no signal, so the
+    caller's eye-guess fallback still applies. Returns (y, x) like fit_2dgaussian.
+    """
+    x0 = max(int(cent[0]) - crop_sz//2, 0)
+    y0 = max(int(cent[1]) - crop_sz//2, 0)
+    sub = frame[y0:y0+crop_sz, x0:x0+crop_sz]
+    if sub.size == 0:
+        raise ValueError('dust grain cutout is outside the frame')
+    w = sub - np.median(sub)
+    np.clip(w, 0, None, out=w)
+    tot = w.sum()
+    if tot <= 0:
+        raise ValueError('no signal in dust grain cutout')
+    yy, xx = np.indices(w.shape)
+    return (w*yy).sum()/tot + y0, (w*xx).sum()/tot + x0
+
+def _align_dust_one(fits_name, outpath, dust_xy, xy_cube0, crop_sz, hpf_sz, resel_ori,
+                    imlib, remove, debug):
+    """
+    Aligns one 3_rmfr_ cube on the dust grains and writes the 3_AGPM_aligned_imlib_
+    cube (used by subtract_sky). Module level so multiprocessing can pickle it - one
+    cube per process. Returns the (ndust, nz, 2) shifts found in this cube so the
+    caller can print the fit diagnostics without re-reading anything from disk.
+    """
+    ndust = len(dust_xy)
+    tmp_cube = _open_fits_fast(outpath+'3_rmfr_'+fits_name, verbose=debug)
+    shifts_xy = np.zeros([ndust, tmp_cube.shape[0], 2], dtype=np.float32)
+    # high-pass filter the whole cube in one C call (size 1 along the frame
+    # axis so frames stay independent), equivalent to frame_filter_highpass
+    # with mode='median-subt' on every frame
+    tmp_cube_hpf = tmp_cube - median_filter(tmp_cube, size=(1, hpf_sz, hpf_sz), mode='mirror')
+    for zz in range(tmp_cube.shape[0]):
+        tmp = tmp_cube_hpf[zz]
+        for dd in range(ndust):
+            try: # note we have to do try, because for some (rare) channels the centroid fails
+                y_tmp, x_tmp = _dust_centroid(tmp, dust_xy[dd], crop_sz)
+            except ValueError:
+                x_tmp, y_tmp = dust_xy[dd]
+            shifts_xy[dd,zz,0] = xy_cube0[dd,0] - x_tmp
+            shifts_xy[dd,zz,1] = xy_cube0[dd,1] - y_tmp
+    del tmp_cube_hpf # the filtered copy is only needed for the fits; free it before shifting
+    # median shift over the dust grains for this cube, then shift while it is still in memory.
+    # every plane is overwritten below so an uninitialised buffer is enough - no zero fill.
+    # the warps stay on the CPU: with one cube per process the pool already saturates the
+    # machine, and a GPU path would both add a cupy dependency and swap the Lanczos
+    # resampling for spline interpolation, changing the science frames
+    med_shift = np.median(shifts_xy, axis=0)
+    tmp_tmp_tmp_tmp = np.empty_like(tmp_cube)
+    for zz in range(tmp_cube.shape[0]):
+        tmp_tmp_tmp_tmp[zz] = frame_shift(tmp_cube[zz], med_shift[zz,1], med_shift[zz,0], imlib=imlib)
+    # written at float32: FITS has no half-precision BITPIX, and the ~3 significant
+    # digits of float16 would quantise the faint sky structure the PCA fit relies on
+    _write_fits_fast(outpath+'3_AGPM_aligned_imlib_'+fits_name, tmp_tmp_tmp_tmp, verbose=debug)
+    if remove:
+        _remove_file(outpath+'3_rmfr_'+fits_name)
+    return shifts_xy
+
+def _pca_sky_group(fits_names, outpath, med_sky, pcs, mask, npc, remove, debug, plot_names=()):
+    """
+    PCA sky subtraction of every science cube sharing one sky group (used by
+    subtract_sky). Module level so multiprocessing can pickle it; handing a worker the
+    whole group means the basis and group median cross the process boundary once per
+    group instead of once per cube. For the cubes named in plot_names the frame medians
+    before and after subtraction are returned, so the caller can plot them without
+    reopening cubes that were just in memory here (or already removed).
+    """
+    plot_meds = {}
+    # one-slot prefetcher (same pattern as the crop loop): the next cube streams off disk
+    # while the current one is in the gemms, hiding the read latency
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        fut = prefetcher.submit(_open_fits_fast, outpath+'3_AGPM_aligned_imlib_'+fits_names[0], debug)
+        for ii, fits_name in enumerate(fits_names):
+            tmp = fut.result().astype(np.float32, copy=False) # no-op for pipeline-written cubes, keeps the gemms in sgemm
+            if ii + 1 < len(fits_names):
+                fut = prefetcher.submit(_open_fits_fast, outpath+'3_AGPM_aligned_imlib_'+fits_names[ii+1], debug)
+            med_bef = _axis0_median(tmp) if fits_name in plot_names else None # before the in-place centring below
+            tmp -= med_sky # freshly read private array, centre it in place - no temporary
+            tmp_tmp = _subtract_pca_gram(tmp, None, mask, ncomp=npc, pcs=pcs)
+            if med_bef is not None:
+                plot_meds[fits_name] = (med_bef, _axis0_median(tmp_tmp))
+            _write_fits_fast(outpath+'4_sky_subtr_imlib_'+fits_name, tmp_tmp, verbose=debug)
+            if remove:
+                _remove_file(outpath+'3_AGPM_aligned_imlib_'+fits_name)
+    return plot_meds
+
+def _axis0_median(a):
+    """
+    Median over the frame axis without the full per-pixel sort np.median does: partition
+    at the middle rank(s) only, O(n) per pixel. When bottleneck is installed its C median
+    already works this way, so just use it.
+    """
+    if _cube_median is not np.median:
+        return _cube_median(a, axis=0)
+    n = a.shape[0]
+    k = n // 2
+    if n % 2:
+        return np.partition(a, k, axis=0)[k]
+    p = np.partition(a, [k-1, k], axis=0)
+    return 0.5*(p[k-1]+p[k])
+
+def _write_fits_buffered(path, data, verbose=False):
+    """
+    Builds the complete FITS file in a memory buffer and flushes it with one write call,
+    instead of letting astropy stream the header and data blocks out incrementally. On the
+    network filesystems these reductions usually run on, the many small writes are what
+    make saving a stage's worth of cubes slow. Output is identical to write_fits.
+    """
+    buf = io.BytesIO()
+    fits.PrimaryHDU(np.asarray(data)).writeto(buf)
+    with open(path, 'wb') as f:
+        f.write(buf.getbuffer())
+    if verbose:
+        print("Fits file successfully saved to disk: ", path)
+
+def _fast_pct(a, pct):
+    """
+    Single percentile through an O(N) partial sort: partitions the raveled array at the
+    target rank instead of fully sorting it like np.percentile. Meant for plot cuts, where
+    the nearest-rank value is indistinguishable from the interpolated one.
+    """
+    a = np.asarray(a).ravel()
+    k = min(int(a.size * pct / 100.), a.size - 1)
+    return np.partition(a, k)[k]
+
+def _last_frame_and_shape(path):
+    """
+    Returns the final plane of a FITS cube and its shape through a memory map. section
+    indexing pulls only the byte range of that plane from disk, so probing a cube's real
+    ndit no longer costs a full cube read.
+    """
+    with fits.open(path, memmap=True) as hdul:
+        h = hdul[0]
+        shp = h.shape
+        return np.array(h.section[shp[0]-1]), shp
+
+@lru_cache(maxsize=8)
+def _radial_grid_sq(ny, nx, cy, cx):
+    """
+    Squared radial distance of every pixel from (cy, cx) in a ny x nx frame. Cached per
+    geometry so the O(N^2) grid is only built once, as the same few centres are reused for
+    every circle/annulus mask in this module. Callers must not modify the returned array.
+    """
+    yy, xx = np.ogrid[:ny, :nx]
+    return (yy - cy)**2 + (xx - cx)**2
+
+@lru_cache(maxsize=4)
+def _annulus_mask(ny, nx, cy, cx, r_in, r_out):
+    """
+    Boolean annulus mask r_in <= r < r_out centred on (cy, cx), cached per geometry. The
+    same annulus is reused across every cube of a run (and across method calls), so the
+    distance grid and comparison only ever run once. Callers must not modify the result.
+    """
+    r2 = _radial_grid_sq(ny, nx, cy, cx)
+    return (r2 >= r_in**2) & (r2 < r_out**2)
+
+def _low_pass_filter(frame):
+    """
+    Median + Gaussian low pass filter applied before every maximum search in this module.
+    Defined once so all the find_* functions share the same smoothing stage.
+    """
+    # scipy.ndimage.median_filter is substantially faster than the medfilt2d-based
+    # median mode of frame_filter_lowpass, with identical results
+    frame = median_filter(frame, size = 7, mode = 'mirror')
+    # separable Gaussian in scipy, same smoothing as frame_filter_lowpass gauss mode with
+    # fwhm_size = 5 but without the 2D astropy convolution (2*K*N^2 ops instead of K^2*N^2)
+    frame = gaussian_filter(frame, sigma = 5 * gaussian_fwhm_to_sigma, mode = 'mirror')
+    return frame
 
 def find_shadow_list(self, file_list, threshold = 0, verbose = True, debug = False, plot = None):
        """
@@ -40,21 +485,20 @@ def find_shadow_list(self, file_list, threshold = 0, verbose = True, debug = Fal
        cube = open_fits(self.inpath + file_list[0],verbose=debug)
        nz, ny, nx = cube.shape
        median_frame = np.median(cube, axis = 0)
-       median_frame = frame_filter_lowpass(median_frame, median_size = 7, mode = 'median')
-       median_frame = frame_filter_lowpass(median_frame, mode = 'gauss',fwhm_size = 5)
-       ycom,xcom = np.unravel_index(np.argmax(median_frame), median_frame.shape) #location of AGPM
+       median_frame = _low_pass_filter(median_frame)
+       ycom,xcom = divmod(median_frame.argmax(), median_frame.shape[1]) #location of AGPM
        if debug:
            write_fits(self.outpath + 'shadow_median_frame', median_frame,verbose=debug)
 
-       shadow = np.where(median_frame >threshold, 1, 0) #lyot shadow
+       shadow = (median_frame > threshold).view(np.uint8) #lyot shadow
        #create similar shadow centred at the origin
-       area = sum(sum(shadow))
-       r = np.sqrt(area/np.pi)
-       tmp = np.zeros([ny,nx])
-       tmp = mask_circle(tmp,radius = r, fillwith = 1)
-       tmp = frame_shift(tmp, ycom - ny/2 ,xcom - nx/2 )
-       #measure translation
-       shift_yx, _, _ = register_translation(tmp, shadow,
+       area = np.count_nonzero(shadow)
+       r = math.sqrt(area/math.pi)
+       # build the reference circle directly at the AGPM position from the cached radial grid,
+       # replacing the mask_circle + subpixel frame_shift round trip
+       tmp = (_radial_grid_sq(ny, nx, int(ycom), int(xcom)) <= r*r).astype(np.float32)
+       #measure translation, float32 halves the FFT memory traffic with no loss at this precision
+       shift_yx, _, _ = phase_cross_correlation(tmp.astype(np.float32), shadow.astype(np.float32),
                                      upsample_factor= 100)
        #express as a coordinate
        y, x = shift_yx
@@ -64,43 +508,42 @@ def find_shadow_list(self, file_list, threshold = 0, verbose = True, debug = Fal
            pdb.set_trace()
        if verbose:
            print('The centre of the shadow is','cy = ',cy,'cx = ',cx)
+       if plot:
+           vmin_med, vmax_med = np.percentile(median_frame, [0.1, 99.9]) # one partial sort for both cuts
        if plot == 'show':
-           plot_frames((median_frame, shadow, tmp),vmax=(np.percentile(median_frame,99.9),1,1),
-                       vmin=(np.percentile(median_frame,0.1),0,0),label=('Median frame','Shadow',''),title='Shadow')
+           plot_frames((median_frame, shadow, tmp),vmax=(vmax_med,1,1),
+                       vmin=(vmin_med,0,0),label=('Median frame','Shadow',''),title='Shadow')
        if plot == 'save':
-           plot_frames((median_frame, shadow, tmp), vmax=(np.percentile(median_frame,99.9),1,1),
-                       vmin=(np.percentile(median_frame,0.1),0,0),label=('Median frame','Shadow',''),title='Shadow',
+           plot_frames((median_frame, shadow, tmp), vmax=(vmax_med,1,1),
+                       vmin=(vmin_med,0,0),label=('Median frame','Shadow',''),title='Shadow',
                        dpi=300, save = self.outpath + 'shadow_fit.pdf')
 
        return cy, cx, r
 
-def find_filtered_max(path, verbose = True, debug = False):
+def find_filtered_max(path, roi_center = None, roi_size = 256, verbose = True, debug = False):
         """
         This method will find the location of the max after low pass filtering.
         It gives a rough approximation of the stars location, reliable in unsaturated frames where the star dominates.
-        Need to supply the path to the cube.
+        Need to supply the path to the cube. If the star position is already bounded, pass roi_center = (y,x) to
+        restrict the filter + max search to a roi_size x roi_size square, which is much cheaper than the full frame.
 
         """
         cube = open_fits(path, verbose = debug)
-        #nz, ny, nx = cube.shape
-        #cy,cx = frame_center(cube, verbose = verbose) #find central pixel coordinates
-
-        # then the position will be that plus the relative shift in y and x
-        #rel_shift_x = rel_AGPM_pos_xy[0] # 6.5 is pixels from frame center to AGPM in y in an example data set, thus providing the relative shift
-        #rel_shift_y = rel_AGPM_pos_xy[1] # 50.5 is pixels from frame center to AGPM in x in an example data set, thus providing the relative shift
-
-        #y_tmp = cy + rel_shift_y
-        #x_tmp = cx + rel_shift_x
 
         median_frame = np.median(cube, axis = 0)
-        # define a square of 100 x 100 with the center being the approximate AGPM/star position
-        #median_frame,cornery,cornerx = get_square(median_frame, size = size, y = y_tmp, x = x_tmp, position = True, verbose = True)
+        cornery, cornerx = 0, 0
+        if roi_center is not None:
+            # only filter a square around the approximate position instead of the full frame
+            median_frame,cornery,cornerx = get_square(median_frame, size = roi_size, y = roi_center[0],
+                                                      x = roi_center[1], position = True, verbose = verbose)
         # apply low pass filter
         #filter for the brightest source
-        median_frame = frame_filter_lowpass(median_frame, median_size = 7, mode = 'median')
-        median_frame = frame_filter_lowpass(median_frame, mode = 'gauss',fwhm_size = 5)
+        median_frame = _low_pass_filter(median_frame)
         #obtain location of the bright source
-        ycom,xcom = np.unravel_index(np.argmax(median_frame), median_frame.shape)
+        ycom,xcom = divmod(median_frame.argmax(), median_frame.shape[1])
+        # add the bottom-left corner of the square back on if a ROI was used
+        ycom += cornery
+        xcom += cornerx
         if verbose:
             print('The location of the star is','ycom =',ycom,'xcom =', xcom)
         if debug:
@@ -148,10 +591,9 @@ def find_AGPM(path, rel_AGPM_pos_xy = (50.5, 6.5), size = 101, verbose = True, d
         # define a square of 100 x 100 with the center being the approximate AGPM/star position
         median_frame,cornery,cornerx = get_square(median_frame, size = size, y = y_tmp, x = x_tmp, position = True, verbose = True)
         # apply low pass filter
-        median_frame = frame_filter_lowpass(median_frame, median_size = 7, mode = 'median')
-        median_frame = frame_filter_lowpass(median_frame, mode = 'gauss',fwhm_size = 5)
+        median_frame = _low_pass_filter(median_frame)
         # find coordinates of max flux in the square
-        ycom_tmp, xcom_tmp = np.unravel_index(np.argmax(median_frame), median_frame.shape)
+        ycom_tmp, xcom_tmp = divmod(median_frame.argmax(), median_frame.shape[1])
         # AGPM/star is the bottom-left corner coordinates plus the location of the max in the square
         ycom = cornery+ycom_tmp
         xcom = cornerx+xcom_tmp
@@ -162,11 +604,13 @@ def find_AGPM(path, rel_AGPM_pos_xy = (50.5, 6.5), size = 101, verbose = True, d
             pdb.set_trace()
         return [ycom, xcom]
 
-def find_nearest(array, value, output='index', constraint=None):
+def find_nearest(array, value, output='index', constraint=None, assume_sorted=False):
     """
     Function to find the index, and optionally the value, of an array's closest element to a certain value.
     Possible outputs: 'index','value','both'
     Possible constraints: 'ceil', 'floor', None ("ceil" will return the closest element with a value greater than 'value', "floor" the opposite)
+    Set assume_sorted = True when the array is already in ascending order (e.g. the MJD lists) for a
+    binary search instead of a full scan.
     """
     if type(array) is np.ndarray:
         pass
@@ -175,10 +619,16 @@ def find_nearest(array, value, output='index', constraint=None):
     else:
         raise ValueError("Input type for array should be np.ndarray or list.")
 
-    idx = (np.abs(array-value)).argmin()
-    if type == 'ceil' and array[idx]-value < 0:
+    if assume_sorted:
+        # O(log N) binary search, then pick the nearer of the two neighbours
+        idx = int(np.searchsorted(array, value))
+        if idx == len(array) or (idx > 0 and value - array[idx-1] <= array[idx] - value):
+            idx -= 1
+    else:
+        idx = (np.abs(array-value)).argmin()
+    if constraint == 'ceil' and array[idx]-value < 0:
         idx+=1
-    elif type == 'floor' and value-array[idx] < 0:
+    elif constraint == 'floor' and value-array[idx] < 0:
         idx-=1
 
     if output=='index': return idx
@@ -203,34 +653,67 @@ class raw_dataset:
         self.outpath = outpath
         self.final_sz = final_sz
         self.coro = coro
-        sci_list = []
+        # read all the file lists in one go and keep them as attributes, so each method
+        # doesn't have to re-parse the same text files line by line
+        self.sci_list = self._load_list("sci_list.txt")
+        self.sky_list = self._load_list("sky_list.txt")
+        self.unsat_list = self._load_list("unsat_list.txt")
+        self.unsat_dark_list = self._load_list("unsat_dark_list.txt")
+        self.flat_list = self._load_list("flat_list.txt")
+        self.flat_dark_list = self._load_list("flat_dark_list.txt")
+        self.sci_dark_list = self._load_list("sci_dark_list.txt")
         # get the common size (crop size)
-        with open(self.inpath+"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
-        nx = open_fits(self.inpath + sci_list[0],verbose = False).shape[2]
-        self.com_sz = np.array([int(nx - 1)])
-        write_fits(self.outpath + 'common_sz', self.com_sz, verbose = False)
+        _cached_open_fits.cache_clear() # products may be rewritten by a fresh reduction
+        nx = open_fits(self.inpath + self.sci_list[0],verbose = False).shape[2]
+        self.com_sz = int(nx - 1)
+        write_fits(self.outpath + 'common_sz', np.array([self.com_sz]), verbose = False)
         #the size of the shadow in NACO data should be constant.
         #will differ for NACO data where the coronagraph has been adjusted
         self.shadow_r = 280 # shouldnt change for NaCO data
-        sci_list_mjd = [] # observation time of each sci cube
-        sky_list_mjd = [] # observation time of each sky cube
-        with open(self.inpath+"sci_list_mjd.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list_mjd.append(float(line.split('\n')[0]))
-
-        with open(self.inpath+"sky_list_mjd.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list_mjd.append(float(line.split('\n')[0]))
-        self.sci_list_mjd = sci_list_mjd
-        self.sky_list_mjd = sky_list_mjd
+        self.sci_list_mjd = self._load_list("sci_list_mjd.txt", dtype=float) # observation time of each sci cube
+        self.sky_list_mjd = self._load_list("sky_list_mjd.txt", dtype=float) # observation time of each sky cube
         self.dataset_dict = dataset_dict
         self.fast_reduction = dataset_dict['fast_reduction']
 
+    def _load_list(self, name, dtype=str):
+        """
+        Reads a text file list from the input path in a single C-level call, one entry per line.
+        """
+        return np.atleast_1d(np.genfromtxt(self.inpath + name, dtype=dtype)).tolist()
+
+    def _open_cropped(self, fits_name, verbose=False):
+        """
+        Reads only the central com_sz x com_sz window of a raw cube using a memory map,
+        so the bytes outside the crop are never pulled from disk. The window matches
+        cube_crop_frames/get_square for the odd crop sizes used in this pipeline, and falls
+        back to open_fits + cube_crop_frames otherwise.
+        """
+        crop_sz = self.com_sz
+        header = fits.getheader(self.inpath + fits_name)
+        ny = header['NAXIS2']
+        nx = header['NAXIS1']
+        if crop_sz % 2 == 1 and crop_sz <= min(ny, nx):
+            # same geometry as get_square: centre (n-1)/2, wing (crop_sz-1)/2
+            wing = (crop_sz - 1) // 2
+            y0 = int((ny - 1) / 2 - wing)
+            x0 = int((nx - 1) / 2 - wing)
+            if fitsio is not None:
+                # cfitsio reads just the requested tile from disk and releases the GIL
+                with fitsio.FITS(self.inpath + fits_name) as hdul:
+                    if header['NAXIS'] == 3:
+                        tmp = hdul[0][:, y0:y0 + crop_sz, x0:x0 + crop_sz]
+                    else:
+                        tmp = hdul[0][y0:y0 + crop_sz, x0:x0 + crop_sz]
+            else:
+                with fits.open(self.inpath + fits_name, memmap=True) as hdul:
+                    if header['NAXIS'] == 3:
+                        tmp = hdul[0].section[:, y0:y0 + crop_sz, x0:x0 + crop_sz]
+                    else:
+                        tmp = hdul[0].section[y0:y0 + crop_sz, x0:x0 + crop_sz]
+            return np.asarray(tmp, dtype=np.float32)
+        tmp = open_fits(self.inpath + fits_name, header=False, verbose=verbose)
+        return cube_crop_frames(tmp, crop_sz, force=True, verbose=verbose)
+
 
     def get_final_sz(self, final_sz = None, verbose = True, debug = False):
         """
@@ -278,10 +761,10 @@ class raw_dataset:
         plot options : 'save' 'show' or None
             Whether to show plot or save it, or do nothing
         """
-        self.com_sz = int(open_fits(self.outpath + 'common_sz',verbose=debug)[0])
+        # self.com_sz is already an int set in __init__, no need to re-read the FITS file here
         crop = 0
         if NACO:
-            mask_std = np.zeros([self.com_sz,self.com_sz])
+            mask_std = np.zeros([self.com_sz,self.com_sz], dtype=np.float32)
             cy,cx = frame_center(mask_std)
             # exclude the negative dot if the frame includes it
             if self.com_sz <=733:
@@ -291,155 +774,101 @@ class raw_dataset:
                 mask_std[int(cy) - 23:int(cy) + 23, :-crop] = 1
             write_fits(self.outpath + 'mask_std.fits',mask_std,verbose=debug)
 
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
-
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
-
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
-
-        unsat_dark_list = []
-        with open(self.inpath +"unsat_dark_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_dark_list.append(line.split('\n')[0])
-
-        flat_list = []
-        with open(self.inpath +"flat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                flat_list.append(line.split('\n')[0])
-
-        flat_dark_list = []
-        with open(self.inpath +"flat_dark_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                flat_dark_list.append(line.split('\n')[0])
-
-        sci_dark_list = []
-        with open(self.inpath +"sci_dark_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_dark_list.append(line.split('\n')[0])
+        # lists were parsed once in __init__
+        sci_list = self.sci_list
+        sky_list = self.sky_list
+        unsat_list = self.unsat_list
+        unsat_dark_list = self.unsat_dark_list
+        flat_list = self.flat_list
+        flat_dark_list = self.flat_dark_list
+        sci_dark_list = self.sci_dark_list
 
         if not os.path.isfile(self.inpath + sci_list[-1]):
             raise NameError('Missing .fits. Double check the contents of the input path')
 
-        self.com_sz = int(open_fits(self.outpath + 'common_sz',verbose=debug)[0])
-
         pixel_scale = self.dataset_dict['pixel_scale']
 
-        tmp = np.zeros([len(flat_dark_list), self.com_sz, self.com_sz])
-
-        master_all_darks = []
+        tmp = np.zeros([len(flat_dark_list), self.com_sz, self.com_sz], dtype=np.float32)
+
+        #pre-scan the sci and unsat dark headers so every buffer (including the master dark
+        #cube) can be allocated once up front instead of growing a Python list and copying
+        #it into an array at the end
+        nz_sci_dark = []
+        for sd_name in sci_dark_list:
+            header = fits.getheader(self.inpath + sd_name)
+            nz_sci_dark.append(header['NAXIS3'] if header['NAXIS'] == 3 else 1)
+        nz_unsat_dark = []
+        nx_unsat_dark = []
+        for sd_name in unsat_dark_list:
+            header = fits.getheader(self.inpath + sd_name)
+            nz_unsat_dark.append(header['NAXIS3'] if header['NAXIS'] == 3 else 1)
+            nx_unsat_dark.append(header['NAXIS1'])
+
+        # one median frame per flat/sci dark cube plus the unsat darks large enough to match
+        n_darks = len(flat_dark_list) + len(sci_dark_list) + sum(1 for nx in nx_unsat_dark if nx >= self.com_sz)
+        master_all_darks = np.empty([n_darks, self.com_sz, self.com_sz], dtype=np.float32)
+        idx_dark = 0
 
         #cropping the flat dark cubes to com_sz
-        for fd, fd_name in enumerate(flat_dark_list):
-            tmp_tmp = open_fits(self.inpath+fd_name, header=False, verbose=debug)
+        #each iteration reads a different file into its own slice of tmp, so the loop can run
+        #in worker threads - astropy FITS I/O releases the GIL and the reads overlap
+        def _crop_flat_dark(fd):
+            tmp_tmp = open_fits(self.inpath+flat_dark_list[fd], header=False, verbose=debug)
             tmp[fd] = frame_crop(tmp_tmp, self.com_sz, force = True , verbose= debug)
-            print(tmp[fd].shape)
-            master_all_darks.append(tmp[fd])
+            if debug:
+                print(tmp[fd].shape)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_crop_flat_dark, range(len(flat_dark_list))))
+        master_all_darks[idx_dark:idx_dark+len(flat_dark_list)] = tmp
+        idx_dark += len(flat_dark_list)
         write_fits(self.outpath+'flat_dark_cube.fits', tmp, verbose=debug)
+        flat_dark_cube = tmp # keep in memory to avoid re-reading the file we just wrote
         if verbose:
             print('Flat dark cubes have been cropped and saved')
 
-        tmp = np.zeros([len(sci_dark_list), self.com_sz, self.com_sz])
-
         #cropping the SCI dark cubes to com_sz
-        for sd, sd_name in enumerate(sci_dark_list):
-            tmp_tmp = open_fits(self.inpath+sd_name, header=False, verbose=debug)
-            n_dim = tmp_tmp.ndim
-            if sd == 0:
-                if n_dim == 2:
-                    tmp = np.array([frame_crop(tmp_tmp, self.com_sz,
-                                               force = True, verbose=debug)])
-                    master_all_darks.append(tmp)
-                    print(tmp.shape)
-                else:
-                    tmp = cube_crop_frames(tmp_tmp, self.com_sz, force = True, verbose=debug)
-                    master_all_darks.append(tmp[-1])
-                    print(tmp[-1].shape)
+        tmp = np.empty([sum(nz_sci_dark), self.com_sz, self.com_sz], dtype=np.float32)
+        offsets = np.concatenate(([0], np.cumsum(nz_sci_dark))) # start of each cube in the buffer
+        def _crop_sci_dark(sd):
+            tmp_tmp = open_fits(self.inpath+sci_dark_list[sd], header=False, verbose=debug)
+            offset = offsets[sd]
+            if tmp_tmp.ndim == 2:
+                tmp[offset] = frame_crop(tmp_tmp, self.com_sz, force = True, verbose=debug)
             else:
-                if n_dim == 2:
-                    tmp = np.append(tmp,[frame_crop(tmp_tmp, self.com_sz, force = True, verbose=debug)],axis=0)
-                    master_all_darks.append(tmp)
-                    print(tmp.shape)
-                else:
-                    tmp = np.append(tmp,cube_crop_frames(tmp_tmp, self.com_sz, force = True, verbose=debug),axis=0)
-                    master_all_darks.append(tmp[-1])
-                    print(tmp[-1].shape)
+                tmp[offset:offset+nz_sci_dark[sd]] = cube_crop_frames(tmp_tmp, self.com_sz, force = True, verbose=debug)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_crop_sci_dark, range(len(sci_dark_list))))
+        for sd in range(len(sci_dark_list)):
+            master_all_darks[idx_dark] = tmp[offsets[sd]+nz_sci_dark[sd]-1]
+            idx_dark += 1
         write_fits(self.outpath + 'sci_dark_cube.fits', tmp, verbose=debug)
+        sci_dark_cube = tmp # keep in memory to avoid re-reading the file we just wrote
         if verbose:
             print('Sci dark cubes have been cropped and saved')
 
-        tmp = np.zeros([len(unsat_dark_list), self.com_sz, self.com_sz])
-
         #cropping of UNSAT dark frames to the common size or less
         #will only add to the master dark cube if it is the same size as the SKY and SCI darks
-        for sd, sd_name in enumerate(unsat_dark_list):
-            tmp_tmp = open_fits(self.inpath+sd_name, header=False, verbose=debug)
-            n_dim = tmp_tmp.ndim
-            if sd == 0:
-                if n_dim ==2:
-                    ny, nx  = tmp_tmp.shape
-                    if nx < self.com_sz:
-                        tmp = np.array([frame_crop(tmp_tmp, nx - 1, force = True, verbose = debug)])
-                        print(tmp.shape)
-                    else:
-                        if nx>self.com_sz:
-                            tmp = np.array([frame_crop(tmp_tmp, self.com_sz, force = True, verbose = debug)])
-                        else:
-                            tmp = np.array([tmp_tmp])
-                        master_all_darks.append(tmp)
-                        print(tmp.shape)
-                else:
-                    nz, ny, nx = tmp_tmp.shape
-                    if nx < self.com_sz:
-                        tmp = cube_crop_frames(tmp_tmp, nx-1, force = True, verbose=debug)
-                        print(tmp[-1].shape)
-                    else:
-                        if nx > self.com_sz:
-                            tmp = cube_crop_frames(tmp_tmp, self.com_sz, force = True, verbose=debug)
-                        else:
-                            tmp = tmp_tmp
-                        master_all_darks.append(np.median(tmp[-nz:],axis=0))
-                        print(tmp[-1].shape)
-            else:
-                if n_dim == 2:
-                    ny, nx = tmp_tmp.shape
-                    if nx < self.com_sz:
-                        tmp = np.append(tmp,[frame_crop(tmp_tmp, nx-1, force = True, verbose=debug)],axis=0)
-                        print(tmp[-1].shape)
-                    else:
-                        if nx > self.com_sz:
-                            tmp = np.append(tmp,[frame_crop(tmp_tmp, self.com_sz, force = True, verbose=debug)],axis=0)
-                        else:
-                            tmp = np.append(tmp,[tmp_tmp])
-                        master_all_darks.append(tmp[-1])
-                        print(tmp[-1].shape)
-                else:
-                    nz, ny, nx = tmp_tmp.shape
-                    if nx < self.com_sz:
-                        tmp = np.append(tmp,cube_crop_frames(tmp_tmp, nx - 1, force = True, verbose=debug),axis=0)
-                        print(tmp[-1].shape)
-                    else:
-                        if nx > self.com_sz:
-                            tmp = np.append(tmp,cube_crop_frames(tmp_tmp, self.com_sz, force = True, verbose=debug),axis=0)
-                        else:
-                            tmp = np.append(tmp,tmp_tmp)
-                        master_all_darks.append(np.median(tmp[-nz:],axis=0))
-                        print(tmp[-1].shape)
+        # frames smaller than the common size are cropped to an odd size, the rest to the common size
+        crop_sz_unsat = min(min(nx - 1 if nx < self.com_sz else self.com_sz for nx in nx_unsat_dark),
+                            min(nx_unsat_dark))
+        tmp = np.empty([sum(nz_unsat_dark), crop_sz_unsat, crop_sz_unsat], dtype=np.float32)
+        offsets = np.concatenate(([0], np.cumsum(nz_unsat_dark)))
+        def _crop_unsat_dark(sd):
+            tmp_tmp = open_fits(self.inpath+unsat_dark_list[sd], header=False, verbose=debug)
+            if tmp_tmp.ndim == 2:
+                tmp_tmp = tmp_tmp[np.newaxis]
+            nz, ny, nx = tmp_tmp.shape
+            if nx != crop_sz_unsat:
+                tmp_tmp = cube_crop_frames(tmp_tmp, crop_sz_unsat, force = True, verbose=debug)
+            tmp[offsets[sd]:offsets[sd]+nz] = tmp_tmp
+            if nx >= self.com_sz: # same size as the SCI/SKY darks, can contribute to the master dark
+                return _cube_median(tmp_tmp, axis=0)
+        with ThreadPoolExecutor() as executor:
+            unsat_dark_medians = list(executor.map(_crop_unsat_dark, range(len(unsat_dark_list))))
+        for med in unsat_dark_medians:
+            if med is not None:
+                master_all_darks[idx_dark] = med
+                idx_dark += 1
 
         write_fits(self.outpath+'unsat_dark_cube.fits', tmp, verbose=debug)
         if verbose:
@@ -448,8 +877,6 @@ class raw_dataset:
         if verbose:
             print('Total of {} median dark frames. Saving dark cube to fits file...'.format(len(master_all_darks)))
 
-        #convert master all darks to numpy array here
-        master_all_darks = np.array(master_all_darks)
         write_fits(self.outpath + "master_all_darks.fits", master_all_darks,verbose=debug)
 
         #defining the mask for the sky/sci pca dark subtraction
@@ -460,48 +887,47 @@ class raw_dataset:
         else:
             raise ValueError('Pipeline does not handle non-coronagraphic data here yet')
 
-        mask_AGPM_com = np.ones([self.com_sz,self.com_sz])
-        cy,cx = frame_center(mask_AGPM_com)
+        cy,cx = frame_center(np.empty([self.com_sz,self.com_sz]))
 
         inner_rad = 3/pixel_scale
         outer_rad = self.shadow_r*0.8
 
         if NACO:
-            mask_sci = np.zeros([self.com_sz,self.com_sz])
+            mask_sci = np.zeros([self.com_sz,self.com_sz], dtype=np.float32)
             mask_sci[int(cy)-23:int(cy)+23,int(cx-outer_rad):int(cx+outer_rad)] = 1
             write_fits(self.outpath + 'mask_sci.fits', mask_sci, verbose=debug)
 
-        # create mask for sci and sky
-        mask_AGPM_com = get_annulus_segments(mask_AGPM_com, inner_rad, outer_rad - inner_rad, mode='mask')[0]
-        mask_AGPM_com = frame_shift(mask_AGPM_com, self.agpm_pos[0]-cy, self.agpm_pos[1]-cx, border_mode = 'constant')
+        # create mask for sci and sky - annulus centred on the AGPM built directly from the
+        # cached radial grid, instead of masking an annulus at the frame centre and shifting
+        # it onto the AGPM with interpolation
+        r2 = _radial_grid_sq(self.com_sz, self.com_sz, int(self.agpm_pos[0]), int(self.agpm_pos[1]))
+        mask_AGPM_com = ((r2 >= inner_rad**2) & (r2 < outer_rad**2)).astype(np.float32)
         #create mask for flats
-        mask_AGPM_flat = np.ones([self.com_sz,self.com_sz])
+        mask_AGPM_flat = np.ones([self.com_sz,self.com_sz], dtype=np.float32)
 
         if verbose:
             print('The masks for SCI, SKY and FLAT have been defined')
         # will exclude a quadrant if specified by looping over the list of bad quadrants and filling the mask with zeros
-        if len(bad_quadrant) > 0 :
-            for quadrant in bad_quadrant:
-                if quadrant == 1:
-                    mask_AGPM_com[int(cy)+1:,int(cx)+1:] = 0
-                    mask_AGPM_flat[int(cy)+1:,int(cx)+1:] = 0
-                    #mask_std[int(cy)+1:,int(cx)+1:] = 0
-                    #mask_sci[int(cy)+1:,int(cx)+1:] = 0
-                if quadrant == 2:
-                    mask_AGPM_com[int(cy)+1:,:int(cx)+1] = 0
-                    mask_AGPM_flat[int(cy)+1:,:int(cx)+1] = 0
-                    #mask_std[int(cy)+1:,:int(cx)+1] = 0
-                    #mask_sci[int(cy)+1:,:int(cx)+1] = 0
-                if quadrant == 3:
-                    mask_AGPM_com[:int(cy)+1,:int(cx)+1] = 0
-                    mask_AGPM_flat[:int(cy)+1,:int(cx)+1] = 0
-                    #mask_std[:int(cy)+1,:int(cx)+1] = 0
-                    #mask_sci[:int(cy)+1,:int(cx)+1] = 0
-                if quadrant == 4:
-                    mask_AGPM_com[:int(cy)+1,int(cx)+1:] = 0
-                    mask_AGPM_flat[:int(cy)+1,int(cx)+1:] = 0
-                    #mask_std[:int(cy)+1,int(cx)+1:] = 0
-                    #mask_sci[:int(cy)+1,:int(cx)+1] = 0
+        # quadrants are numbered  2 | 1  and map to a pair of precomputed slices
+        #                         3 | 4
+        quad_slices = {1: (slice(int(cy)+1, None), slice(int(cx)+1, None)),
+                       2: (slice(int(cy)+1, None), slice(None, int(cx)+1)),
+                       3: (slice(None, int(cy)+1), slice(None, int(cx)+1)),
+                       4: (slice(None, int(cy)+1), slice(int(cx)+1, None))}
+        for quadrant in bad_quadrant:
+            sy, sx = quad_slices[quadrant]
+            mask_AGPM_com[sy, sx] = 0
+            mask_AGPM_flat[sy, sx] = 0
+            #mask_std[sy, sx] = 0
+            #mask_sci[sy, sx] = 0
+
+        # boolean views of the masks, used for all masked reductions below since
+        # fancy indexing with a boolean mask avoids np.where materializing index arrays
+        mask_AGPM_com_bool = mask_AGPM_com.astype(bool)
+        mask_AGPM_flat_bool = mask_AGPM_flat.astype(bool)
+        if NACO:
+            mask_std_bool = mask_std.astype(bool)
+            mask_sci_bool = mask_sci.astype(bool)
         # save the mask for checking/testing
         write_fits(self.outpath + 'mask_AGPM_com.fits',mask_AGPM_com, verbose = debug)
         write_fits(self.outpath + 'mask_AGPM_flat.fits',mask_AGPM_flat, verbose = debug)
@@ -513,67 +939,74 @@ class raw_dataset:
         if method == 'median':
 
             # median dark subtraction of SCI cubes
-            tmp_tmp_tmp = open_fits(self.outpath + 'sci_dark_cube.fits',verbose=debug)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp, axis=0)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[np.where(mask_AGPM_com)]) # consider the median within the mask
-            for sc, fits_name in enumerate(sci_list):
-                tmp = open_fits(self.inpath + fits_name, header=False, verbose=debug)
-                tmp = cube_crop_frames(tmp, self.com_sz, force=True, verbose=debug)
+            tmp_tmp_tmp_median = _cube_median(sci_dark_cube, axis=0)
+            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[mask_AGPM_com_bool]) # consider the median within the mask
+
+            last_dark = {} # only the last cube before/after is kept, for the plots below
+            def _median_dark_subtract(fits_name):
+                # read, crop, subtract and write one cube. Runs in a worker thread as
+                # astropy FITS I/O releases the GIL, so reads and writes overlap. Returns
+                # nothing so the pool never holds more than the cubes in flight
+                tmp = self._open_cropped(fits_name, verbose=debug)
                 tmp_tmp = tmp - tmp_tmp_tmp_median
-                write_fits(self.outpath + '1_crop_' + fits_name, tmp_tmp)
+                write_fits(self.outpath + '1_crop_' + fits_name, tmp_tmp, verbose=debug) # quiet per-cube write: interleaved prints from the worker threads cost time and garble the log
+                if fits_name == last_name:
+                    last_dark['before'], last_dark['after'] = tmp, tmp_tmp
+
+            last_name = sci_list[-1]
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                list(pool.map(_median_dark_subtract, sci_list))
             if verbose:
                 print('Dark has been subtracted from SCI cubes')
 
             if plot:
-                tmp_tmp_med = np.median(tmp, axis=0)  # sci before subtraction
-                tmp_tmp_med_after = np.median(tmp_tmp, axis=0)  # sci after dark subtract
+                tmp_tmp_med = np.median(last_dark['before'], axis=0)  # sci before subtraction
+                tmp_tmp_med_after = np.median(last_dark['after'], axis=0)  # sci after dark subtract
+                # both percentiles of each frame in one partition pass
+                vmin_med, vmax_med = np.percentile(tmp_tmp_med, [0.1, 99.9])
+                vmin_after, vmax_after = np.percentile(tmp_tmp_med_after, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Sci', 'Sci Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Sci', 'Sci Median Dark Subtracted',
                             'Pixel Mask'), title='Sci Median Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Sci', 'Sci Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Sci', 'Sci Median Dark Subtracted',
                             'Pixel Mask'), title='Sci Median Dark Subtraction',
                             dpi=300, save=self.outpath + 'SCI_median_dark_subtract.pdf')
 
-            # median dark subtract of sky cubes
-            tmp_tmp_tmp = open_fits(self.outpath + 'sci_dark_cube.fits',verbose=debug)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp, axis=0)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[np.where(mask_AGPM_com)])
-            for sc, fits_name in enumerate(sky_list):
-                tmp = open_fits(self.inpath + fits_name, header=False, verbose=debug)
-                tmp = cube_crop_frames(tmp, self.com_sz, force=True, verbose=debug)
-                tmp_tmp = tmp - tmp_tmp_tmp_median
-                write_fits(self.outpath + '1_crop_' + fits_name, tmp_tmp)
+            # median dark subtract of sky cubes, reusing the same masked dark median as the sci cubes
+            last_dark = {}
+            last_name = sky_list[-1]
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                list(pool.map(_median_dark_subtract, sky_list))
             if verbose:
                 print('Dark has been subtracted from SKY cubes')
 
             if plot:
-                tmp_tmp_med = np.median(tmp, axis=0)  # sky before subtraction
-                tmp_tmp_med_after = np.median(tmp_tmp, axis=0)  # sky after dark subtract
+                tmp_tmp_med = np.median(last_dark['before'], axis=0)  # sky before subtraction
+                tmp_tmp_med_after = np.median(last_dark['after'], axis=0)  # sky after dark subtract
+                # both percentiles of each frame in one partition pass
+                vmin_med, vmax_med = np.percentile(tmp_tmp_med, [0.1, 99.9])
+                vmin_after, vmax_after = np.percentile(tmp_tmp_med_after, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Sky', 'Sky Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Sky', 'Sky Median Dark Subtracted',
                             'Pixel Mask'), title='Sky Median Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Sky', 'Sky Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_com), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Sky', 'Sky Median Dark Subtracted',
                             'Pixel Mask'), title='Sky Median Dark Subtraction',
                             dpi=300, save=self.outpath + 'SKY_median_dark_subtract.pdf')
 
             # median dark subtract of flat cubes
-            tmp_tmp = np.zeros([len(flat_list), self.com_sz, self.com_sz])
-            tmp_tmp_tmp = open_fits(self.outpath + 'flat_dark_cube.fits',verbose=debug)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp, axis=0)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[np.where(mask_AGPM_flat)])
+            tmp_tmp = np.zeros([len(flat_list), self.com_sz, self.com_sz], dtype=np.float32)
+            # slice the masked pixels out of the flattened cube first so the per-pixel
+            # median is never computed outside the mask
+            flat_dark_masked = flat_dark_cube.reshape(flat_dark_cube.shape[0], -1)[:, mask_AGPM_flat_bool.ravel()]
+            tmp_tmp_tmp_median = np.median(_cube_median(flat_dark_masked, axis=0))
             for sc, fits_name in enumerate(flat_list):
-                tmp = open_fits(self.inpath + fits_name, header=False, verbose=debug)
-                tmp = cube_crop_frames(tmp, self.com_sz, force=True, verbose=debug)
+                tmp = self._open_cropped(fits_name, verbose=debug)
                 tmp_tmp[sc] = tmp - tmp_tmp_tmp_median
             write_fits(self.outpath + '1_crop_flat_cube.fits', tmp_tmp,verbose=debug)
             if verbose:
@@ -582,15 +1015,16 @@ class raw_dataset:
             if plot:
                 tmp_tmp_med = np.median(tmp, axis=0)  # flat cube before subtraction
                 tmp_tmp_med_after = np.median(tmp_tmp, axis=0)  # flat cube after dark subtract
+                # both percentiles of each frame in one partition pass
+                vmin_med, vmax_med = np.percentile(tmp_tmp_med, [0.1, 99.9])
+                vmin_after, vmax_after = np.percentile(tmp_tmp_med_after, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_flat), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Flat', 'Flat Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_flat), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Flat', 'Flat Median Dark Subtracted',
                             'Pixel Mask'), title='Flat Median Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_flat), vmax=(np.percentile(tmp_tmp_med,99.9),
-                            np.percentile(tmp_tmp_med_after,99.9), 1), vmin=(np.percentile(tmp_tmp_med,0.1),
-                            np.percentile(tmp_tmp_med_after,0.1), 0), label=('Raw Flat', 'Flat Median Dark Subtracted',
+                plot_frames((tmp_tmp_med, tmp_tmp_med_after, mask_AGPM_flat), vmax=(vmax_med, vmax_after, 1),
+                            vmin=(vmin_med, vmin_after, 0), label=('Raw Flat', 'Flat Median Dark Subtracted',
                             'Pixel Mask'), title='Flat Median Dark Subtraction',
                             dpi=300, save=self.outpath + 'FLAT_median_dark_subtract.pdf')
       #original code           ####################
@@ -681,40 +1115,59 @@ class raw_dataset:
 #        #master_all_darks[len(flat_dark_list):] = tmp.copy()
         if method == 'pca':
             tmp_tmp_tmp = open_fits(self.outpath + 'master_all_darks.fits', verbose = debug) # the cube of all darks - PCA works better with a larger library of DARKs
-            tmp_tmp = np.zeros([len(flat_list), self.com_sz, self.com_sz])
+            # the dark cube and its medians are constant across the three passes below
+            # (flats, sci, sky), so load and reduce them once here
+            dark_median_scalar = np.median(tmp_tmp_tmp) # median of every pixel in all darks
+            dark_median_frame = _cube_median(tmp_tmp_tmp, axis=0) # median frame of all darks
+            dark_median_masked = np.median(dark_median_frame[mask_AGPM_com_bool]) # median of all the pixels within the mask
+            dark_pcs = _pca_basis_gram(tmp_tmp_tmp, ncomp=npc_dark) # dark basis shared by the flat, sci and sky passes
+            tmp_tmp = np.zeros([len(flat_list), self.com_sz, self.com_sz], dtype=np.float32)
 
-            diff = np.zeros([len(flat_list)])
             bar = pyprind.ProgBar(len(flat_list), stream=1, title='Finding difference between DARKS and FLATS')
-            for fl, flat_name in enumerate(flat_list):
-                tmp = open_fits(self.inpath+flat_name, header=False, verbose=False)
-                tmp_tmp[fl] = frame_crop(tmp, self.com_sz, force=True, verbose=False) # added force = True
-                diff[fl] = np.median(tmp_tmp_tmp)-np.median(tmp_tmp[fl]) # median of pixels in all darks - median of all pixels in flat frame
-                tmp_tmp[fl]+=diff[fl] # subtracting median of flat from the flat and adding the median of the dark
+            def _load_flat(fl):
+                tmp_tmp[fl] = self._open_cropped(flat_list[fl], verbose=False) # only the cropped tile is read from disk
                 bar.update()
+            # independent files into independent slices - reads overlap since FITS I/O releases the GIL
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(_load_flat, range(len(flat_list))))
+            # all the frame medians in one vectorized reduction instead of one python call per frame
+            diff = dark_median_scalar - _cube_median(tmp_tmp.reshape(len(flat_list), -1), axis=1) # median of pixels in all darks - median of all pixels in each flat frame
+            tmp_tmp += diff[:, None, None] # subtracting median of flat from the flat and adding the median of the dark
 
             #write_fits(self.outpath + 'TMP_cropped_flat.fits', tmp_tmp, verbose=verbose) # to check if the flats are aligned with the darks
             #test_diff = np.linspace(np.average(diff),5000,50)
 
 
+            # cube_subtract_sky_pca is affine in a constant offset of its input, and a constant
+            # added to every frame commutes with the per-pixel median, so two PCA calls fix the
+            # whole optimisation landscape: the result for tmp_tmp + guess is the guess = 0
+            # result plus guess times the residual of a unit offset through the projection.
+            # The objective is then plain numpy per step instead of a full PCA.
+            median_diff = np.median(diff) # constant across optimizer iterations
+            med_pca_flat = _cube_median(_subtract_pca_gram(tmp_tmp, tmp_tmp_tmp,
+                                                                mask_AGPM_flat, ncomp=npc_dark, pcs=dark_pcs),axis=0)
+            unit_resid_flat = _cube_median(_subtract_pca_gram(tmp_tmp+1, tmp_tmp_tmp,
+                                                                mask_AGPM_flat, ncomp=npc_dark, pcs=dark_pcs),axis=0) - med_pca_flat
+            # mask once up front so each optimizer step is arithmetic on |mask| pixels only
+            med_pca_flat_sub = med_pca_flat[mask_std_bool] # where mask_std is an optional argument
+            unit_resid_flat_sub = unit_resid_flat[mask_std_bool]
+
             def _get_test_diff_flat(guess,verbose=False):
                 #tmp_tmp_pca = np.zeros([self.com_sz,self.com_sz])
                 #stddev = []
                 # loop over values around the median of diff to scale the frames accurately
                 #for idx,td in enumerate(test_diff):
-                tmp_tmp_pca = np.median(cube_subtract_sky_pca(tmp_tmp+guess, tmp_tmp_tmp,
-                                                                mask_AGPM_flat, ref_cube=None, ncomp=npc_dark),axis=0)
-                tmp_tmp_pca-= np.median(diff)+guess # subtract the negative median of diff values and subtract test diff (aka add it back)
-                subframe = tmp_tmp_pca[np.where(mask_std)] # where mask_std is an optional argument
+                subframe = med_pca_flat_sub + guess*unit_resid_flat_sub
+                subframe -= median_diff+guess # subtract the negative median of diff values and subtract test diff (aka add it back)
                 #subframe = tmp_tmp_pca[int(cy)-23:int(cy)+23,:-17] # square around center that includes the bad lines in NaCO data
                 #if idx ==0:
-                subframe = subframe.reshape((-1,self.com_sz-crop))
-
                     #stddev.append(np.std(subframe)) # save the stddev around this bad area
-                stddev = np.std(subframe)
-                write_fits(self.outpath + 'dark_flat_subframe.fits', subframe, verbose=debug)
+                stddev = _masked_variance(subframe) # monotonic in the stddev, one pass
+                if debug: # one file write per optimizer iteration is pure overhead otherwise
+                    write_fits(self.outpath + 'dark_flat_subframe.fits', subframe.reshape((-1,self.com_sz-crop)), verbose=debug)
                 #if verbose:
                 print('Guess = {}'.format(guess))
-                print('Stddev = {}'.format(stddev))
+                print('Variance = {}'.format(stddev))
 
         #        for fl, flat_name in enumerate(flat_list):
         #            tmp_tmp_pca[fl] = tmp_tmp_pca[fl]-diff[fl]
@@ -741,7 +1194,9 @@ class raw_dataset:
                 print('FLATS difference w.r.t. DARKS:', diff)
                 print('Calculating optimal PCA dark subtraction for FLATS...')
             guess = 0
-            solu = minimize(_get_test_diff_flat,x0=guess,args = (debug),method='Nelder-Mead',tol = 2e-4,options = {'maxiter':100, 'disp':verbose})
+            # the objective is a 1-D scalar function, so a bracketed Brent search needs far
+            # fewer evaluations (each one a full PCA) than a Nelder-Mead simplex
+            solu = minimize_scalar(_get_test_diff_flat,bracket = (-200, 200),args = (debug),method='brent',options = {'xtol':2e-4, 'maxiter':30})
 
             # guess = solu.x
             # print('best diff:',guess)
@@ -756,8 +1211,7 @@ class raw_dataset:
             # solu = minimize(_get_test_diff_flat, x0=test_diff, args=(), method='Nelder-Mead',
             #                 options={'maxiter': 1})
 
-            best_test_diff = solu.x # x is the solution (ndarray)
-            best_test_diff = best_test_diff[0] # take out of array
+            best_test_diff = solu.x # x is the scalar solution
             if verbose:
                 print('Best difference (value) to add to FLATS is {} found in {} iterations'.format(best_test_diff,solu.nit))
 
@@ -783,59 +1237,60 @@ class raw_dataset:
             #                                                                           np.round(np.argmin(stddev), 2) + 1,
             #                                                                           test_diff[np.argmin(stddev)]))
 
-            tmp_tmp_pca = cube_subtract_sky_pca(tmp_tmp + best_test_diff, tmp_tmp_tmp,
-                                                mask_AGPM_flat, ref_cube=None, ncomp=npc_dark)
-            bar = pyprind.ProgBar(len(flat_list), stream=1, title='Correcting FLATS via PCA dark subtraction')
-            for fl, flat_name in enumerate(flat_list):
-                tmp_tmp_pca[fl] = tmp_tmp_pca[fl] - diff[fl] - best_test_diff  # add back the constant
-                bar.update()
+            tmp_tmp_pca = _subtract_pca_gram(tmp_tmp + best_test_diff, tmp_tmp_tmp,
+                                                mask_AGPM_flat, ncomp=npc_dark, pcs=dark_pcs)
+            if verbose:
+                print('Correcting FLATS via PCA dark subtraction')
+            tmp_tmp_pca -= diff[:, None, None] + best_test_diff  # add back the constant, one broadcast op
             write_fits(self.outpath + '1_crop_flat_cube.fits', tmp_tmp_pca, verbose=debug)
 
             if plot:
                 tmp_tmp_med = np.median(tmp_tmp, axis=0)  # flat before subtraction
                 tmp_tmp_pca = np.median(tmp_tmp_pca, axis=0)  # flat after dark subtract
+                # both percentiles of each frame in one partition pass
+                vmin_med, vmax_med = np.percentile(tmp_tmp_med, [0.1, 99.9])
+                vmin_pca, vmax_pca = np.percentile(tmp_tmp_pca, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp_tmp_med, tmp_tmp_pca, mask_AGPM_flat), vmax=(np.percentile(tmp_tmp_med,99.9),
-                                                                              np.percentile(tmp_tmp_pca,99.9), 1),
-                            vmin=(np.percentile(tmp_tmp_med,0.1), np.percentile(tmp_tmp_pca,0.1), 0),
+                plot_frames((tmp_tmp_med, tmp_tmp_pca, mask_AGPM_flat), vmax=(vmax_med, vmax_pca, 1),
+                            vmin=(vmin_med, vmin_pca, 0),
                             title='Flat PCA Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp_tmp_med, tmp_tmp_pca, mask_AGPM_flat), vmax=(np.percentile(tmp_tmp_med,99.9),
-                                                                              np.percentile(tmp_tmp_pca,99.9), 1),
-                            vmin=(np.percentile(tmp_tmp_med,0.1), np.percentile(tmp_tmp_pca,0.1), 0),
+                plot_frames((tmp_tmp_med, tmp_tmp_pca, mask_AGPM_flat), vmax=(vmax_med, vmax_pca, 1),
+                            vmin=(vmin_med, vmin_pca, 0),
                             title='Flat PCA Dark Subtraction', dpi=300, save=self.outpath + 'FLAT_PCA_dark_subtract.pdf')
 
             if verbose:
                 print('Flats have been dark corrected')
 
+            # ~100 MB each, release before loading the sci cubes
+            del tmp_tmp, tmp_tmp_pca, med_pca_flat, unit_resid_flat
+
     #        ### ORIGINAL PCA CODE
 
             #PCA dark subtraction of SCI cubes
             #tmp_tmp_tmp = open_fits(self.outpath+'sci_dark_cube.fits')
-            tmp_tmp_tmp = open_fits(self.outpath + 'master_all_darks.fits', verbose =debug)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp,axis = 0) # median frame of all darks
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[np.where(mask_AGPM_com)]) # integer median of all the pixels within the mask
+            tmp_tmp_tmp_median = dark_median_masked # computed once above from the master dark cube
 
-            tmp_tmp = np.zeros([len(sci_list), self.com_sz, self.com_sz])
+            tmp_tmp = np.zeros([len(sci_list), self.com_sz, self.com_sz], dtype=np.float32)
 
-            diff = np.zeros([len(sci_list)])
             bar = pyprind.ProgBar(len(sci_list), stream=1, title='Finding difference between DARKS and SCI cubes. This may take some time.')
-            for sc, fits_name in enumerate(sci_list):
-                tmp = open_fits(self.inpath+fits_name, header=False, verbose=debug) # open science
-                tmp = cube_crop_frames(tmp, self.com_sz, force = True, verbose=debug) # crop science to common size
+            def _load_sci_median(sc):
+                tmp = self._open_cropped(sci_list[sc], verbose=debug) # open science cropped to common size
                 #PCA works best when the considering the difference
-                tmp_median = np.median(tmp,axis = 0) # make median frame from all frames in cube
-                #tmp_median = tmp_median[np.where(mask_AGPM_com)]
-                diff[sc] = tmp_tmp_tmp_median - np.median(tmp_median) # median pixel value of all darks minus median pixel value of sci cube
-                tmp_tmp[sc] = tmp_median + diff[sc]
+                tmp_tmp[sc] = _cube_median(tmp,axis = 0) # make median frame from all frames in cube
                 # if sc==0 or sc==middle_idx or sc==len(sci_list)-1:
                 #     tmp_tmp[counter] = tmp_median + diff[sc]
                 #     counter = counter + 1
-                if debug:
-                    print('difference w.r.t dark =', diff[sc])
                 bar.update()
-            write_fits(self.outpath + 'dark_sci_diff.fits',diff,verbose=debug)
-            write_fits(self.outpath + 'sci_plus_diff.fits',tmp_tmp,verbose=debug)
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(_load_sci_median, range(len(sci_list))))
+            # all the cube medians in one vectorized reduction instead of one python call per cube
+            diff = tmp_tmp_tmp_median - _cube_median(tmp_tmp.reshape(len(sci_list), -1), axis=1) # median pixel value of all darks minus median pixel value of each sci cube
+            tmp_tmp += diff[:, None, None]
+            if debug:
+                print('difference w.r.t dark =', diff)
+                write_fits(self.outpath + 'dark_sci_diff.fits',diff,verbose=debug)
+                write_fits(self.outpath + 'sci_plus_diff.fits',tmp_tmp,verbose=debug) # serializes the full sci cube, debug only
             # with open(self.outpath + "dark_sci_diff.txt", "w") as f:
             #     for diff_sci in diff:
             #         f.write(str(diff_sci) + '\n')
@@ -850,24 +1305,34 @@ class raw_dataset:
             #tmp_tmp_pca = np.zeros([len(test_diff),self.com_sz,self.com_sz])
             #best_idx = []
 
+            # same affine shortcut as the FLAT pass: two PCA calls, then the objective is
+            # numpy arithmetic on the cached medians
+            median_diff = np.median(diff) # constant across optimizer iterations
+            med_pca_sci = _cube_median(_subtract_pca_gram(tmp_tmp, tmp_tmp_tmp,
+                                                              mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs), axis=0)
+            unit_resid_sci = _cube_median(_subtract_pca_gram(tmp_tmp + 1, tmp_tmp_tmp,
+                                                              mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs), axis=0) - med_pca_sci
+            # mask once up front so each optimizer step is arithmetic on |mask| pixels only
+            med_pca_sci_sub = med_pca_sci[mask_sci_bool]
+            unit_resid_sci_sub = unit_resid_sci[mask_sci_bool]
+
             def _get_test_diff_sci(guess, verbose=False):
                 # tmp_tmp_pca = np.zeros([self.com_sz,self.com_sz])
                 # stddev = []
                 # loop over values around the median of diff to scale the frames accurately
                 # for idx,td in enumerate(test_diff):
-                tmp_tmp_pca = np.median(cube_subtract_sky_pca(tmp_tmp + guess, tmp_tmp_tmp,
-                                                              mask_AGPM_com, ref_cube=None, ncomp=npc_dark), axis=0)
-                tmp_tmp_pca -= np.median(diff) + guess  # subtract the negative median of diff values and subtract test diff (aka add it back)
-                subframe = tmp_tmp_pca[np.where(mask_sci)]
+                subframe = med_pca_sci_sub + guess*unit_resid_sci_sub
+                subframe -= median_diff + guess  # subtract the negative median of diff values and subtract test diff (aka add it back)
                 # subframe = tmp_tmp_pca[int(cy)-23:int(cy)+23,:-17] # square around center that includes the bad lines in NaCO data
                 # if idx ==0:
                 # stddev.append(np.std(subframe)) # save the stddev around this bad area
-                stddev = np.std(subframe)
+                stddev = _masked_variance(subframe) # monotonic in the stddev, one pass
                 if verbose:
                     print('Guess = {}'.format(guess))
-                    print('Standard deviation = {}'.format(stddev))
-                subframe = subframe.reshape(46,-1) # hard coded 46 because the subframe size is hardcoded to center pixel +-23
-                write_fits(self.outpath + 'dark_sci_subframe.fits', subframe, verbose=debug)
+                    print('Variance = {}'.format(stddev))
+                if debug: # one file write per optimizer iteration is pure overhead otherwise
+                    # hard coded 46 because the subframe size is hardcoded to center pixel +-23
+                    write_fits(self.outpath + 'dark_sci_subframe.fits', subframe.reshape(46,-1), verbose=debug)
 
                 #        for fl, flat_name in enumerate(flat_list):
                 #            tmp_tmp_pca[fl] = tmp_tmp_pca[fl]-diff[fl]
@@ -884,10 +1349,9 @@ class raw_dataset:
             #for sc in [0,middle_idx,-1]:
             if verbose:
                 print('Calculating optimal PCA dark subtraction for SCI cubes. This may take some time.')
-            solu = minimize(_get_test_diff_sci, x0=guess, args=(verbose), method='Nelder-Mead',tol = 2e-4,options = {'maxiter':100, 'disp':verbose})
+            solu = minimize_scalar(_get_test_diff_sci, bracket=(-200, 200), args=(verbose), method='brent', options={'xtol':2e-4, 'maxiter':30})
 
-            best_test_diff = solu.x  # x is the solution (ndarray)
-            best_test_diff = best_test_diff[0]  # take out of array
+            best_test_diff = solu.x  # x is the scalar solution
             #best_diff.append(best_test_diff)
             if verbose:
                 print('Best difference (value) to add to SCI cubes is {} found in {} iterations'.format(best_test_diff,solu.nit))
@@ -918,13 +1382,18 @@ class raw_dataset:
 
             bar = pyprind.ProgBar(len(sci_list), stream=1, title='Correcting SCI cubes via PCA dark subtraction')
             for sc,fits_name in enumerate(sci_list):
-                tmp = open_fits(self.inpath+fits_name, header=False, verbose=debug)
-                tmp = cube_crop_frames(tmp, self.com_sz, force = True, verbose=debug)
-
-                tmp_tmp_pca = cube_subtract_sky_pca(tmp +diff[sc] +best_test_diff, tmp_tmp_tmp,
-                                    mask_AGPM_com, ref_cube=None, ncomp=npc_dark)
-
-                tmp_tmp_pca = tmp_tmp_pca - diff[sc] - best_test_diff # add back the constant
+                tmp = self._open_cropped(fits_name, verbose=debug)
+
+                # stream the cube through the fit a block of frames at a time so the float64
+                # temporaries inside the projection stay cache sized instead of cube sized
+                tmp_tmp_pca = np.empty_like(tmp)
+                nblock = 20
+                for fr in range(0, tmp.shape[0], nblock):
+                    sl = slice(fr, fr + nblock)
+                    tmp_tmp_pca[sl] = _subtract_pca_gram(tmp[sl] + (diff[sc] + best_test_diff),
+                                        tmp_tmp_tmp, mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs)
+
+                tmp_tmp_pca -= diff[sc] + best_test_diff # add back the constant, in place
                 write_fits(self.outpath+'1_crop_'+fits_name, tmp_tmp_pca, verbose = debug)
                 bar.update()
             if verbose:
@@ -933,20 +1402,24 @@ class raw_dataset:
             if plot:
                 tmp = np.median(tmp, axis = 0)
                 tmp_tmp_pca = np.median(tmp_tmp_pca,axis = 0)
+                # both percentiles of each frame in one partition pass
+                vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+                vmin_pca, vmax_pca = np.percentile(tmp_tmp_pca, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp, tmp_tmp_pca, mask_AGPM_com), vmax=(np.percentile(tmp, 99.9),
-                                                                     np.percentile(tmp_tmp_pca, 99.9), 1),
-                            vmin=(np.percentile(tmp, 0.1), np.percentile(tmp_tmp_pca, 0.1), 0),
+                plot_frames((tmp, tmp_tmp_pca, mask_AGPM_com), vmax=(vmax_raw, vmax_pca, 1),
+                            vmin=(vmin_raw, vmin_pca, 0),
                             label=('Raw Science', 'Science PCA Dark Subtracted', 'Pixel Mask'),
                             title='Science PCA Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp, tmp_tmp_pca, mask_AGPM_com), vmax=(np.percentile(tmp, 99.9),
-                                                                     np.percentile(tmp_tmp_pca, 99.9), 1),
-                            vmin=(np.percentile(tmp, 0.1), np.percentile(tmp_tmp_pca, 0.1), 0),
+                plot_frames((tmp, tmp_tmp_pca, mask_AGPM_com), vmax=(vmax_raw, vmax_pca, 1),
+                            vmin=(vmin_raw, vmin_pca, 0),
                             label=('Raw Science', 'Science PCA Dark Subtracted', 'Pixel Mask'),
                             title='Science PCA Dark Subtraction',
                             dpi=300,save = self.outpath + 'SCI_PCA_dark_subtract.pdf')
 
+            # release the sci pass intermediates before the sky pass
+            del tmp, tmp_tmp, tmp_tmp_pca, med_pca_sci, unit_resid_sci
+
             #dark subtract of sky cubes
             #tmp_tmp_tmp = open_fits(self.outpath+'sci_dark_cube.fits')
     #        tmp_tmp_tmp = open_fits(self.outpath+'master_all_darks.fits')
@@ -978,50 +1451,55 @@ class raw_dataset:
     #        if plot == 'save':
     #            plot_frames((tmp,tmp_tmp,mask_AGPM_com), vmax = (25000,25000,1), vmin = (-2500,-2500,0),save = self.outpath + 'SKY_PCA_dark_subtract')
 
-            tmp_tmp_tmp = open_fits(self.outpath + 'master_all_darks.fits', verbose = debug)
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp,axis = 0) # median frame of all darks
-            tmp_tmp_tmp_median = np.median(tmp_tmp_tmp_median[np.where(mask_AGPM_com)]) # integer median of all the pixels within the mask
+            tmp_tmp_tmp_median = dark_median_masked # same master dark cube and masked median as the SCI pass
 
-            tmp_tmp = np.zeros([len(sky_list), self.com_sz, self.com_sz])
+            tmp_tmp = np.zeros([len(sky_list), self.com_sz, self.com_sz], dtype=np.float32)
             cy,cx = frame_center(tmp_tmp)
 
-            diff = np.zeros([len(sky_list)])
-
             bar = pyprind.ProgBar(len(sky_list), stream=1, title='Finding difference between darks and sky cubes')
-            for sc, fits_name in enumerate(sky_list):
-                tmp = open_fits(self.inpath+fits_name, header=False, verbose=debug) # open sky
-                tmp = cube_crop_frames(tmp, self.com_sz, force = True, verbose=debug) # crop sky to common size
+            def _load_sky_median(sc):
+                tmp = self._open_cropped(sky_list[sc], verbose=debug) # open sky cropped to common size
                 #PCA works best when the considering the difference
-                tmp_median = np.median(tmp,axis = 0) # make median frame from all frames in cube
-                #tmp_median = tmp_median[np.where(mask_AGPM_com)]
-                diff[sc] = tmp_tmp_tmp_median - np.median(tmp_median) # median pixel value of all darks minus median pixel value of sky cube
-                tmp_tmp[sc] = tmp_median + diff[sc]
-                if debug:
-                    print('difference w.r.t dark =', diff[sc])
+                tmp_tmp[sc] = _cube_median(tmp,axis = 0) # make median frame from all frames in cube
                 bar.update()
-            write_fits(self.outpath + 'dark_sci_diff.fits', diff, verbose=debug)
+            with ThreadPoolExecutor() as executor:
+                list(executor.map(_load_sky_median, range(len(sky_list))))
+            diff = tmp_tmp_tmp_median - _cube_median(tmp_tmp.reshape(len(sky_list), -1), axis=1) # median pixel value of all darks minus median pixel value of each sky cube
+            tmp_tmp += diff[:, None, None]
+            if debug:
+                print('difference w.r.t dark =', diff)
+                # was overwriting dark_sci_diff.fits from the sci pass
+                write_fits(self.outpath + 'dark_sky_diff.fits', diff, verbose=debug)
             if verbose:
-                print('SKY difference w.r.t. DARKS has been saved to fits file.')
                 print('SKY difference w.r.t. DARKS:', diff)
 
+            # same affine shortcut as the FLAT and SCI passes
+            median_diff = np.median(diff) # constant across optimizer iterations
+            med_pca_sky = _cube_median(_subtract_pca_gram(tmp_tmp, tmp_tmp_tmp,
+                                                              mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs), axis=0)
+            unit_resid_sky = _cube_median(_subtract_pca_gram(tmp_tmp + 1, tmp_tmp_tmp,
+                                                              mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs), axis=0) - med_pca_sky
+            # mask once up front so each optimizer step is arithmetic on |mask| pixels only
+            med_pca_sky_sub = med_pca_sky[mask_sci_bool]
+            unit_resid_sky_sub = unit_resid_sky[mask_sci_bool]
+
             def _get_test_diff_sky(guess, verbose=False):
                 # tmp_tmp_pca = np.zeros([self.com_sz,self.com_sz])
                 # stddev = []
                 # loop over values around the median of diff to scale the frames accurately
                 # for idx,td in enumerate(test_diff):
-                tmp_tmp_pca = np.median(cube_subtract_sky_pca(tmp_tmp + guess, tmp_tmp_tmp,
-                                                              mask_AGPM_com, ref_cube=None, ncomp=npc_dark), axis=0)
-                tmp_tmp_pca -= np.median(diff) + guess  # subtract the negative median of diff values and subtract test diff (aka add it back)
-                subframe = tmp_tmp_pca[np.where(mask_sci)]
+                subframe = med_pca_sky_sub + guess*unit_resid_sky_sub
+                subframe -= median_diff + guess  # subtract the negative median of diff values and subtract test diff (aka add it back)
                 # subframe = tmp_tmp_pca[int(cy)-23:int(cy)+23,:-17] # square around center that includes the bad lines in NaCO data
                 # if idx ==0:
                 # stddev.append(np.std(subframe)) # save the stddev around this bad area
-                stddev = np.std(subframe)
+                stddev = _masked_variance(subframe) # monotonic in the stddev, one pass
                 if verbose:
                     print('Guess = {}'.format(guess))
-                    print('Standard deviation = {}'.format(stddev))
-                subframe = subframe.reshape(46,-1) # hard coded 46 because the subframe size is hardcoded to center pixel +-23
-                write_fits(self.outpath + 'dark_sky_subframe.fits', subframe, verbose=debug)
+                    print('Variance = {}'.format(stddev))
+                if debug: # one file write per optimizer iteration is pure overhead otherwise
+                    # hard coded 46 because the subframe size is hardcoded to center pixel +-23
+                    write_fits(self.outpath + 'dark_sky_subframe.fits', subframe.reshape(46,-1), verbose=debug)
 
                 #        for fl, flat_name in enumerate(flat_list):
                 #            tmp_tmp_pca[fl] = tmp_tmp_pca[fl]-diff[fl]
@@ -1032,10 +1510,9 @@ class raw_dataset:
             guess = 0
             if verbose:
                 print('Calculating optimal PCA dark subtraction for SKY cubes. This may take some time.')
-            solu = minimize(_get_test_diff_sky, x0=guess, args=(verbose), method='Nelder-Mead',tol = 2e-4,options = {'maxiter':100, 'disp':verbose})
+            solu = minimize_scalar(_get_test_diff_sky, bracket=(-200, 200), args=(verbose), method='brent', options={'xtol':2e-4, 'maxiter':30})
 
-            best_test_diff = solu.x  # x is the solution (ndarray)
-            best_test_diff = best_test_diff[0]  # take out of array
+            best_test_diff = solu.x  # x is the scalar solution
 
             #
             # lower_diff = 0.9*np.median(diff)
@@ -1082,13 +1559,18 @@ class raw_dataset:
 
             bar = pyprind.ProgBar(len(sky_list), stream=1, title='Correcting SKY cubes via PCA dark subtraction')
             for sc,fits_name in enumerate(sky_list):
-                tmp = open_fits(self.inpath+fits_name, header=False, verbose=debug)
-                tmp = cube_crop_frames(tmp, self.com_sz, force = True, verbose=debug)
-
-                tmp_tmp_pca = cube_subtract_sky_pca(tmp +diff[sc] +best_test_diff, tmp_tmp_tmp,
-                                    mask_AGPM_com, ref_cube=None, ncomp=npc_dark)
-
-                tmp_tmp_pca = tmp_tmp_pca - diff[sc] - best_test_diff # add back the constant
+                tmp = self._open_cropped(fits_name, verbose=debug)
+
+                # stream the cube through the fit a block of frames at a time so the float64
+                # temporaries inside the projection stay cache sized instead of cube sized
+                tmp_tmp_pca = np.empty_like(tmp)
+                nblock = 20
+                for fr in range(0, tmp.shape[0], nblock):
+                    sl = slice(fr, fr + nblock)
+                    tmp_tmp_pca[sl] = _subtract_pca_gram(tmp[sl] + (diff[sc] + best_test_diff),
+                                        tmp_tmp_tmp, mask_AGPM_com, ncomp=npc_dark, pcs=dark_pcs)
+
+                tmp_tmp_pca -= diff[sc] + best_test_diff # add back the constant, in place
                 write_fits(self.outpath+'1_crop_'+fits_name, tmp_tmp_pca, verbose = debug)
 
             if verbose:
@@ -1097,16 +1579,22 @@ class raw_dataset:
             if plot:
                 tmp = np.median(tmp, axis = 0)
                 tmp_tmp_pca = np.median(tmp_tmp_pca,axis = 0)
+                # both percentiles of each frame in one partition pass
+                vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+                vmin_pca, vmax_pca = np.percentile(tmp_tmp_pca, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp,tmp_tmp_pca,mask_AGPM_com), vmax = (np.percentile(tmp,99.9),
-                np.percentile(tmp_tmp_pca,99.9),1), vmin = (np.percentile(tmp,0.1),np.percentile(tmp_tmp_pca,0.1),0),
+                plot_frames((tmp,tmp_tmp_pca,mask_AGPM_com), vmax = (vmax_raw,vmax_pca,1),
+                vmin = (vmin_raw,vmin_pca,0),
                 label=('Raw Sky','Sky PCA Dark Subtracted','Pixel Mask'),title='Sky PCA Dark Subtraction')
             if plot == 'save':
-                plot_frames((tmp,tmp_tmp_pca,mask_AGPM_com), vmax = (np.percentile(tmp,99.9),
-                np.percentile(tmp_tmp_pca,99.9),1), vmin = (np.percentile(tmp,0.1),np.percentile(tmp_tmp_pca,0.1),0),
+                plot_frames((tmp,tmp_tmp_pca,mask_AGPM_com), vmax = (vmax_raw,vmax_pca,1),
+                vmin = (vmin_raw,vmin_pca,0),
                 label=('Raw Sky','Sky PCA Dark Subtracted','Pixel Mask'),title='Sky PCA Dark Subtraction', dpi=300,
                 save = self.outpath + 'SKY_PCA_dark_subtract.pdf')
 
+            # drop the dark library and the sky pass intermediates before the unsat loop
+            del tmp, tmp_tmp, tmp_tmp_pca, tmp_tmp_tmp, med_pca_sky, unit_resid_sky
+
         #median dark subtract of UNSAT cubes
         tmp_tmp_tmp = open_fits(self.outpath+'unsat_dark_cube.fits',verbose=debug)
         tmp_tmp_tmp = np.median(tmp_tmp_tmp,axis = 0)
@@ -1117,14 +1605,16 @@ class raw_dataset:
             if tmp.shape[2] > self.com_sz:
                 nx_unsat_crop = self.com_sz
                 tmp = cube_crop_frames(tmp, nx_unsat_crop, force = True, verbose = debug)
-                tmp_tmp = tmp-tmp_tmp_tmp
             elif tmp.shape[2]%2 == 0:
                 nx_unsat_crop = tmp.shape[2]-1
                 tmp = cube_crop_frames(tmp, nx_unsat_crop, force = True, verbose = debug)
-                tmp_tmp = tmp-tmp_tmp_tmp
             else:
                 nx_unsat_crop = tmp.shape[2]
-                tmp_tmp = tmp-tmp_tmp_tmp
+            tmp = tmp.astype(np.float32, copy=False)
+            if plot and un == len(unsat_list)-1:
+                tmp_tmp = tmp - tmp_tmp_tmp # keep the raw cube, the plot below shows it
+            else:
+                tmp_tmp = np.subtract(tmp, tmp_tmp_tmp, out=tmp) # in place, saves one cube allocation per file
             write_fits(self.outpath+'1_crop_unsat_'+fits_name, tmp_tmp, verbose = debug)
             bar.update()
 
@@ -1134,17 +1624,19 @@ class raw_dataset:
         if plot:
             tmp = np.median(tmp, axis = 0) # unsat before subtraction
             tmp_tmp = np.median(tmp_tmp,axis = 0)  # unsat after dark subtract
+            # both percentiles of each frame in one partition pass
+            vmin_dark, vmax_dark = np.percentile(tmp_tmp_tmp, [0.1, 99.9])
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_sub, vmax_sub = np.percentile(tmp_tmp, [0.1, 99.9])
 
         # plots unsat dark, raw unsat, dark subtracted unsat
         if plot == 'show':
-            plot_frames((tmp_tmp_tmp,tmp,tmp_tmp),vmax=(np.percentile(tmp_tmp_tmp,99.9),
-                        np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),vmin=(np.percentile(tmp_tmp_tmp,0.1),
-                        np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)), label= ('Raw Unsat Dark','Raw Unsat',
+            plot_frames((tmp_tmp_tmp,tmp,tmp_tmp),vmax=(vmax_dark,vmax_raw,vmax_sub),
+                        vmin=(vmin_dark,vmin_raw,vmin_sub), label= ('Raw Unsat Dark','Raw Unsat',
                         'Unsat Dark Subtracted'),title='Unsat Dark Subtraction')
         if plot == 'save':
-            plot_frames((tmp_tmp_tmp,tmp,tmp_tmp),vmax=(np.percentile(tmp_tmp_tmp,99.9),
-                        np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),vmin=(np.percentile(tmp_tmp_tmp,0.1),
-                        np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)), label= ('Raw Unsat Dark','Raw Unsat',
+            plot_frames((tmp_tmp_tmp,tmp,tmp_tmp),vmax=(vmax_dark,vmax_raw,vmax_sub),
+                        vmin=(vmin_dark,vmin_raw,vmin_sub), label= ('Raw Unsat Dark','Raw Unsat',
                         'Unsat Dark Subtracted'),title='Unsat Dark Subtraction',
                         dpi=300, save = self.outpath + 'UNSAT_dark_subtract.pdf')
 
@@ -1164,31 +1656,23 @@ class raw_dataset:
             number of pixels in the x coordinate until the next bad column. Usually 8.
         """
 
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
 
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
 
         ncubes = len(sci_list) # gets the number of cubes
         com_sz = open_fits(self.inpath+sci_list[0],verbose=False).shape[2] # gets the common dimensions for all frames
-        tmp_tmp = np.zeros([ncubes,com_sz,com_sz]) # make 3D array with length equal to number of cubes, and x and y equal to the common size
+        tmp_tmp = np.empty([ncubes,com_sz,com_sz], dtype=np.float32) # make 3D array with length equal to number of cubes, and x and y equal to the common size
 
         # create new image using the median of all frames in each cube
         for sc, fits_name in enumerate(sci_list): # list of science cubes to fix provided by user
-            tmp = open_fits(self.inpath+fits_name, verbose=debug) # open the cube of interest
-            tmp_tmp[sc] = np.median(tmp,axis=0) # fills the zeros array with the median of all frames in the cube
+            tmp = open_fits(self.inpath+fits_name, verbose=debug).astype(np.float32, copy=False) # open the cube of interest
+            # write straight into the preallocated slice; the cube is discarded anyway so
+            # the median may scramble it in place rather than sorting a copy
+            np.median(tmp, axis=0, out=tmp_tmp[sc], overwrite_input=True)
 
-        mask = np.zeros([com_sz,com_sz]) # makes empty array that is the same x and y dimensions as the frames
+        mask = np.zeros([com_sz,com_sz], dtype=np.uint8) # 0/1 only, one byte per pixel is plenty
         centery,centerx = frame_center(tmp_tmp)
-        median_pxl_val = []
-        stddev = []
 
         if quadrant == 'topright':  #works, makes top right mask based off input
             for a in range(int(centerx+xpixels_from_center),tmp_tmp.shape[2]-1,interval): #create mask where the bad columns are for NACO top right quadrant
@@ -1201,38 +1685,27 @@ class raw_dataset:
         # works but the np.where is dodgy coding
         # find standard deviation and median of the pixels in the bad quadrant that aren't in the bad column, excluding a pixel if it's 2.5 sigma difference
 
-        for counter,image in enumerate(tmp_tmp): #runs through all median combined images
-
-                #crops the data and mask to the quadrant we are checking. confirmed working
-                data_crop = image[int((tmp_tmp.shape[1]-1)/2):tmp_tmp.shape[2]-1, int(centerx+xpixels_from_center):tmp_tmp.shape[2]-1]
-                mask_crop = mask[int((tmp_tmp.shape[1]-1)/2):tmp_tmp.shape[2]-1, int(centerx+xpixels_from_center):tmp_tmp.shape[2]-1]
+        #the crop bounds depend only on the frame shape, so compute them once; the mask is
+        #also constant between frames, so the boolean good-pixel selection is built once -
+        #boolean indexing avoids materializing a pair of index arrays
+        y0 = int((tmp_tmp.shape[1]-1)/2)
+        y1 = tmp_tmp.shape[2]-1
+        x0 = int(centerx+xpixels_from_center)
+        good_px = mask[y0:y1, x0:y1] == 0
 
-                #good pixels are the 0 values in the mask
-                good_pixels = np.where(mask_crop == 0)
-
-                #create a data array that is just the good values
-                data = data_crop[good_pixels[0],good_pixels[1]]
-
-                mean,median,stdev = sigma_clipped_stats(data,sigma=2.5) #saves the value of the median for the good pixel values in the image
-                median_pxl_val.append(median) #adds that value to an array of median pixel values
-                stddev.append(stdev) #takes standard dev of values and adds it to array
+        #stats of the good pixels of every median frame in one sigma-clipped call along
+        #axis 1 instead of one python call per frame
+        _, median_pxl_val, stddev = sigma_clipped_stats(tmp_tmp[:, y0:y1, x0:y1][:, good_px], sigma=2.5, axis=1)
 
         print('Mean standard deviation of effected columns for all frames:',np.mean(stddev))
         print('Mean pixel value of effected columns for all frames:',np.mean(median_pxl_val))
 
-        values = []
-        median_col_val = []
+        #every affected column of every frame in one strided view, then the clipped median
+        #per frame along axis 1 - replaces the python append/clear loop per column
+        cols = tmp_tmp[:, int(centerx):com_sz, x0::interval].reshape(ncubes, -1)
+        _, median_col_val, _ = sigma_clipped_stats(cols, sigma=2.5, axis=1)
 
         for idx,fits_name in enumerate(sci_list): #loops over all images
-            for pixel in range(int(centerx)+int(xpixels_from_center),com_sz,interval): #loop every 8th x pixel starting from first affected column
-
-                values.append(tmp_tmp[idx][int(centerx):com_sz,pixel]) #grabs pixel values of affected pixel column
-
-            mean,median,stdev = sigma_clipped_stats(values,sigma=2.5) #get stats of that column
-            median_col_val.append(median)
-            #empties the list for the next loop
-            values.clear()
-
             if median_col_val[idx] < median_pxl_val[idx] - (1 * stddev[idx]): #if the median column values are 1 stddevs smaller, then correct them (good frames are consistent enough for 1 stddev to be safe)
                 print('*********Fixing bad column in frame {}*********'.format(fits_name))
                 cube_to_fix = open_fits(self.inpath+fits_name,verbose=False)
@@ -1246,34 +1719,18 @@ class raw_dataset:
         plot options: 'save', 'show', None. Show or save relevant plots for debugging
         remove options: True, False. Cleans file for unused fits
         """
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
-
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
-
-        flat_list = []
-        with open(self.inpath +"flat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                flat_list.append(line.split('\n')[0])
-
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
+
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
+
+        flat_list = self.flat_list # parsed once in __init__, no need to re-read the text file
+
+        unsat_list = self.unsat_list # parsed once in __init__, no need to re-read the text file
 
         if not os.path.isfile(self.outpath + '1_crop_' + sci_list[-1]):
             raise NameError('Missing 1_crop_*.fits. Run: dark_subtract()')
 
-        self.com_sz = int(open_fits(self.outpath + 'common_sz',verbose=debug)[0])
+        self.com_sz = int(_cached_open_fits(self.outpath + 'common_sz')[0])
 
         flat_airmass_test = []
         tmp,header = open_fits(self.inpath + flat_list[0],header=True,verbose=debug)
@@ -1293,13 +1750,11 @@ class raw_dataset:
             for fl, flat_name in enumerate(flat_list):
                 tmp, header = open_fits(self.inpath+flat_list[fl], header=True, verbose=debug)
                 flat_X.append(header['AIRMASS'])
-                if fl == 0:
-                    flat_X_values.append(header['AIRMASS'])
-                else:
-                    list_occ = [isclose(header['AIRMASS'], x, atol=0.1) for x in flat_X_values] # sorts nearby values together
-                    if True not in list_occ:
-                        flat_X_values.append(header['AIRMASS'])
-            flat_X_values = np.sort(flat_X_values)  # !!! VERY IMPORTANT, DO NOT COMMENT
+            # bucket nearby airmasses on a grid the width of the old isclose tolerance, then
+            # one C-level sort+unique instead of the quadratic python comparison loop
+            flat_X = np.asarray(flat_X)
+            _, first_occ = np.unique(np.round(flat_X / 0.1), return_index=True)
+            flat_X_values = np.sort(flat_X[first_occ])  # !!! VERY IMPORTANT, DO NOT COMMENT
             if verbose:
                 print('Airmass values in FLATS: {}'.format(flat_X_values))
                 print('The airmass values have been sorted into a list')
@@ -1310,50 +1765,31 @@ class raw_dataset:
             for fl, flat_name in enumerate(flat_list):
                 tmp = open_fits(self.inpath + flat_list[fl], verbose=debug)
                 flat_X.append(np.median(tmp))
-                if fl == 0:
-                    flat_X_values.append(np.median(tmp))
-                else:
-                    list_occ = [isclose(np.median(tmp), x, atol=50) for x in flat_X_values]
-                    if True not in list_occ:
-                        flat_X_values.append(np.median(tmp))
-            flat_X_values = np.sort(flat_X_values)
+            # same rounding trick as the airmass branch, with the old atol=50 as grid width
+            flat_X = np.asarray(flat_X)
+            _, first_occ = np.unique(np.round(flat_X / 50), return_index=True)
+            flat_X_values = np.sort(flat_X[first_occ])
             if verbose:
                 print('Median FLAT values: {}'.format(flat_X_values))
                 print('The median FLAT values have been sorted into a list')
 
         # There should be 15 twilight flats in total with NACO; 5 at each airmass. BUG SOMETIMES!
-        flat_tmp_cube_1 = np.zeros([5, self.com_sz, self.com_sz])
-        flat_tmp_cube_2 = np.zeros([5, self.com_sz, self.com_sz])
-        flat_tmp_cube_3 = np.zeros([5, self.com_sz, self.com_sz])
-        counter_1 = 0
-        counter_2 = 0
-        counter_3 = 0
-
-        flat_cube_3X = np.zeros([3, self.com_sz, self.com_sz])
-
         # TAKE MEDIAN OF each group of 5 frames with SAME AIRMASS
+        # classify every flat against the group values in one vectorized nearest-neighbour
+        # step, then take a masked median per group - no per-frame python conditionals and
+        # no hardcoded limit of 3 groups of 5
         flat_cube = open_fits(self.outpath + '1_crop_flat_cube.fits', header=False, verbose=debug)
-        for fl, self.flat_name in enumerate(flat_list):
-            if find_nearest(flat_X_values, flat_X[fl]) == 0:
-                flat_tmp_cube_1[counter_1] = flat_cube[fl]
-                counter_1 += 1
-            elif find_nearest(flat_X_values, flat_X[fl]) == 1:
-                flat_tmp_cube_2[counter_2] = flat_cube[fl]
-                counter_2 += 1
-            elif find_nearest(flat_X_values, flat_X[fl]) == 2:
-                flat_tmp_cube_3[counter_3] = flat_cube[fl]
-                counter_3 += 1
-
-        flat_cube_3X[0] = np.median(flat_tmp_cube_1,axis=0)
-        flat_cube_3X[1] = np.median(flat_tmp_cube_2,axis=0)
-        flat_cube_3X[2] = np.median(flat_tmp_cube_3,axis=0)
+        bins = np.argmin(np.abs(np.asarray(flat_X)[:, None] - np.asarray(flat_X_values)[None, :]), axis=1)
+        flat_cube_3X = np.stack([np.median(flat_cube[bins == k], axis=0)
+                                 for k in range(len(flat_X_values))]).astype(np.float32)
+        n_groups = flat_cube_3X.shape[0]
         if verbose:
             print('The median FLAT cubes with same airmass have been defined')
 
         #create master flat field
-        med_fl = np.zeros(3)
-        gains_all = np.zeros([3,self.com_sz,self.com_sz])
-        for ii in range(3):
+        med_fl = np.zeros(n_groups, dtype=np.float32)
+        gains_all = np.zeros([n_groups,self.com_sz,self.com_sz], dtype=np.float32)
+        for ii in range(n_groups):
             med_fl[ii] = np.median(flat_cube_3X[ii])
             gains_all[ii] = flat_cube_3X[ii]/med_fl[ii]
         master_flat_frame = np.median(gains_all, axis=0)
@@ -1369,94 +1805,129 @@ class raw_dataset:
         if verbose:
             print('Master flat frames has been saved')
         if plot == 'show':
-            plot_frames((master_flat_frame, master_flat_unsat),vmax=(np.percentile(master_flat_frame,99.9),
-                                                                     np.percentile(master_flat_unsat,99.9)),
-                        vmin=(np.percentile(master_flat_frame,0.1),np.percentile(master_flat_unsat,0.1)),
+            vmin_fl, vmax_fl = np.percentile(master_flat_frame, [0.1, 99.9]) # one partial sort for both cuts
+            vmin_un, vmax_un = np.percentile(master_flat_unsat, [0.1, 99.9])
+            plot_frames((master_flat_frame, master_flat_unsat),vmax=(vmax_fl, vmax_un),
+                        vmin=(vmin_fl, vmin_un),
                         dpi=300,label=('Master flat frame','Master flat unsat'))
 
+        # multiplying by the reciprocal is much cheaper than dividing on vector units,
+        # and the reciprocal only needs computing once for all cubes
+        inv_flat = np.reciprocal(master_flat_frame.astype(np.float32))
+        inv_flat_unsat = np.reciprocal(master_flat_unsat.astype(np.float32))
+
         #scaling of SCI cubes with respect to the master flat
         bar = pyprind.ProgBar(len(sci_list), stream=1, title='Scaling SCI cubes with respect to the master flat')
-        for sc, fits_name in enumerate(sci_list):
-            tmp = open_fits(self.outpath+'1_crop_'+fits_name, verbose=debug)
-            tmp_tmp = np.zeros_like(tmp)
-            for jj in range(tmp.shape[0]):
-                tmp_tmp[jj] = tmp[jj]/master_flat_frame
+        last_ff = {} # the last cube before/after, kept for the plots below
+        # independent read-scale-write per file, so the files can be processed in worker
+        # threads - the FITS I/O releases the GIL and so does the numpy multiply
+        def _ff_sci_one(sc):
+            fits_name = sci_list[sc]
+            tmp = _open_fits_mmap(self.outpath+'1_crop_'+fits_name)
+            tmp_tmp = np.empty(tmp.shape, dtype=np.float32)
+            for fr in range(0, tmp.shape[0], 16): # a block of frames at a time keeps the working set cache sized
+                tmp_tmp[fr:fr+16] = tmp[fr:fr+16] * inv_flat
             write_fits(self.outpath+'2_ff_'+fits_name, tmp_tmp, verbose=debug)
+            if sc == len(sci_list)-1:
+                last_ff['before'], last_ff['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'1_crop_'+fits_name)
+                _remove_file(self.outpath+'1_crop_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_ff_sci_one, range(len(sci_list))))
         if verbose:
             print('Done scaling SCI frames with respect to FLAT')
         if plot:
-            tmp = np.median(tmp, axis = 0)
-            tmp_tmp = np.median(tmp_tmp, axis = 0)
+            tmp = np.median(last_ff['before'], axis = 0)
+            tmp_tmp = np.median(last_ff['after'], axis = 0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_ff, vmax_ff = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
-            plot_frames((master_flat_frame, tmp, tmp_tmp),vmin = (0,np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax = (2,np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),
+            plot_frames((master_flat_frame, tmp, tmp_tmp),vmin = (0,vmin_raw,vmin_ff),
+                        vmax = (2,vmax_raw,vmax_ff),
                         label=('Master flat frame','Origianl Science','Flat field corrected'),dpi=300,
                         title='Science Flat Field Correction')
         if plot == 'save':
             plot_frames((master_flat_frame, tmp, tmp_tmp),
-                        vmin=(0, np.percentile(tmp, 0.1), np.percentile(tmp_tmp, 0.1)),
-                        vmax=(2, np.percentile(tmp, 99.9), np.percentile(tmp_tmp, 99.9)),
+                        vmin=(0, vmin_raw, vmin_ff),
+                        vmax=(2, vmax_raw, vmax_ff),
                         label=('Master flat frame', 'Original Science', 'Flat field corrected'), dpi=300,
                         title='Science Flat Field Correction',save = self.outpath + 'SCI_flat_correction.pdf')
 
         #scaling of SKY cubes with respects to the master flat
         bar = pyprind.ProgBar(len(sky_list), stream=1, title='Scaling SKY cubes with respect to the master flat')
-        for sk, fits_name in enumerate(sky_list):
-            tmp = open_fits(self.outpath+'1_crop_'+fits_name, verbose=debug)
-            tmp_tmp = np.zeros_like(tmp)
-            for jj in range(tmp.shape[0]):
-                tmp_tmp[jj] = tmp[jj]/master_flat_frame
+        last_ff = {}
+        def _ff_sky_one(sk):
+            fits_name = sky_list[sk]
+            tmp = _open_fits_mmap(self.outpath+'1_crop_'+fits_name)
+            tmp_tmp = np.empty(tmp.shape, dtype=np.float32)
+            for fr in range(0, tmp.shape[0], 16): # a block of frames at a time keeps the working set cache sized
+                tmp_tmp[fr:fr+16] = tmp[fr:fr+16] * inv_flat
             write_fits(self.outpath+'2_ff_'+fits_name, tmp_tmp, verbose=debug)
+            if sk == len(sky_list)-1:
+                last_ff['before'], last_ff['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'1_crop_'+fits_name)
+                _remove_file(self.outpath+'1_crop_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_ff_sky_one, range(len(sky_list))))
         if verbose:
             print('Done scaling SKY frames with respect to FLAT')
         if plot:
-            tmp = np.median(tmp, axis = 0)
-            tmp_tmp = np.median(tmp_tmp, axis = 0)
+            tmp = np.median(last_ff['before'], axis = 0)
+            tmp_tmp = np.median(last_ff['after'], axis = 0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_ff, vmax_ff = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
             plot_frames((master_flat_frame, tmp, tmp_tmp),
-                        vmin=(0, np.percentile(tmp, 0.1), np.percentile(tmp_tmp, 0.1)),
-                        vmax=(2, np.percentile(tmp, 99.9), np.percentile(tmp_tmp, 99.9)),
+                        vmin=(0, vmin_raw, vmin_ff),
+                        vmax=(2, vmax_raw, vmax_ff),
                         label=('Master flat frame', 'Original Science', 'Flat field corrected'), dpi=300,
                         title='Science Flat Field Correction')
         if plot == 'save':
             plot_frames((master_flat_frame, tmp, tmp_tmp),
-                        vmin=(0, np.percentile(tmp, 0.1), np.percentile(tmp_tmp, 0.1)),
-                        vmax=(2, np.percentile(tmp, 99.9), np.percentile(tmp_tmp, 99.9)),
+                        vmin=(0, vmin_raw, vmin_ff),
+                        vmax=(2, vmax_raw, vmax_ff),
                         label=('Master flat frame', 'Original Sky', 'Flat field corrected'), dpi=300,
                         title='Sky Flat Field Correction', save = self.outpath + 'SKY_flat_correction.pdf')
 
         #scaling of UNSAT cubes with respects to the master flat unsat
         bar = pyprind.ProgBar(len(unsat_list), stream=1, title='Scaling UNSAT cubes with respect to the master flat')
-        for un, fits_name in enumerate(unsat_list):
-            tmp = open_fits(self.outpath+'1_crop_unsat_'+fits_name, verbose=debug)
-            tmp_tmp = np.zeros_like(tmp)
-            for jj in range(tmp.shape[0]):
-                tmp_tmp[jj] = tmp[jj]/master_flat_unsat
+        last_ff = {}
+        def _ff_unsat_one(un):
+            fits_name = unsat_list[un]
+            tmp = _open_fits_mmap(self.outpath+'1_crop_unsat_'+fits_name)
+            tmp_tmp = np.empty(tmp.shape, dtype=np.float32)
+            for fr in range(0, tmp.shape[0], 16): # a block of frames at a time keeps the working set cache sized
+                tmp_tmp[fr:fr+16] = tmp[fr:fr+16] * inv_flat_unsat
             write_fits(self.outpath+'2_ff_unsat_'+fits_name, tmp_tmp, verbose=debug)
+            if un == len(unsat_list)-1:
+                last_ff['before'], last_ff['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'1_crop_unsat_'+fits_name)
+                _remove_file(self.outpath+'1_crop_unsat_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_ff_unsat_one, range(len(unsat_list))))
         if verbose:
             print('Done scaling UNSAT frames with respect to FLAT')
         if plot:
-            tmp = np.median(tmp,axis = 0)
-            tmp_tmp = np.median(tmp_tmp, axis = 0)
+            tmp = np.median(last_ff['before'],axis = 0)
+            tmp_tmp = np.median(last_ff['after'], axis = 0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_ff, vmax_ff = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
             plot_frames((master_flat_unsat, tmp, tmp_tmp),
-                        vmin=(0, np.percentile(tmp, 0.1), np.percentile(tmp_tmp, 0.1)),
-                        vmax=(2, np.percentile(tmp, 99.9), np.percentile(tmp_tmp, 99.9)),
+                        vmin=(0, vmin_raw, vmin_ff),
+                        vmax=(2, vmax_raw, vmax_ff),
                         label=('Master flat unsat', 'Original Unsat', 'Flat field corrected'), dpi=300,
                         title='Unsat Flat Field Correction')
         if plot == 'save':
             plot_frames((master_flat_unsat, tmp, tmp_tmp),
-                        vmin=(0, np.percentile(tmp, 0.1), np.percentile(tmp_tmp, 0.1)),
-                        vmax=(2, np.percentile(tmp, 99.9), np.percentile(tmp_tmp, 99.9)),
+                        vmin=(0, vmin_raw, vmin_ff),
+                        vmax=(2, vmax_raw, vmax_ff),
                         label=('Master flat unsat', 'Original Unsat', 'Flat field corrected'), dpi=300,
                         title='Unsat Flat Field Correction',  save = self.outpath + 'UNSAT_flat_correction.pdf')
 
@@ -1466,132 +1937,139 @@ class raw_dataset:
         plot options: 'save', 'show', None. Show or save relevant plots for debugging
         remove options: True, False. Cleans file for unused fits
         """
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
-
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
-
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
+
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
+
+        unsat_list = self.unsat_list # parsed once in __init__, no need to re-read the text file
 
         if not os.path.isfile(self.outpath + '2_ff_' + sci_list[-1]):
             raise NameError('Missing 2_ff_*.fits. Run: flat_field_correction()')
 
-        self.com_sz = int(open_fits(self.outpath + 'common_sz')[0])
+        self.com_sz = int(_cached_open_fits(self.outpath + 'common_sz')[0])
 
         n_sci = len(sci_list)
         n_sky = len(sky_list)
         n_unsat = len(unsat_list)
 
         bar = pyprind.ProgBar(n_sci, stream=1, title='Correcting NaN pixels in SCI frames')
-        for sc, fits_name in enumerate(sci_list):
-            tmp = open_fits(self.outpath+'2_ff_'+fits_name, verbose=debug)
-            tmp_tmp = cube_correct_nan(tmp, neighbor_box=3, min_neighbors=3, verbose=debug)
+        last_nan = {} # last cube before/after, kept for the plots below
+        # each file is corrected and written independently, so run them in worker threads
+        def _nan_one(sc):
+            fits_name = sci_list[sc]
+            tmp = _open_fits_mmap(self.outpath+'2_ff_'+fits_name) # memmap, pages stream in as the correction touches them
+            tmp_tmp = _correct_nan_3x3(tmp) # specialized vectorized path for box=3, min_neighbors=3
             write_fits(self.outpath+'2_nan_corr_'+fits_name, tmp_tmp, verbose=debug)
+            if sc == n_sci-1:
+                last_nan['before'], last_nan['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'2_ff_'+fits_name)
+                _remove_file(self.outpath+'2_ff_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_nan_one, range(n_sci)))
         if verbose:
             print('Done correcting NaN pixels in SCI frames')
         if plot:
-            tmp = np.median(tmp,axis=0)
-            tmp_tmp = np.median(tmp_tmp,axis=0)
+            tmp = np.median(last_nan['before'],axis=0)
+            tmp_tmp = np.median(last_nan['after'],axis=0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_corr, vmax_corr = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Science NaN Pixel Correction',dpi=300)
         if plot == 'save':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Science NaN Pixel Correction',dpi=300, save = self.outpath + 'SCI_nan_correction.pdf')
 
         bar = pyprind.ProgBar(n_sky, stream=1, title='Correcting NaN pixels in SKY frames')
-        for sk, fits_name in enumerate(sky_list):
-            tmp = open_fits(self.outpath+'2_ff_'+fits_name, verbose=debug)
-            tmp_tmp = cube_correct_nan(tmp, neighbor_box=3, min_neighbors=3, verbose=debug)
+        last_nan = {} # last cube before/after, kept for the plots below
+        # each file is corrected and written independently, so run them in worker threads
+        def _nan_one(sk):
+            fits_name = sky_list[sk]
+            tmp = _open_fits_mmap(self.outpath+'2_ff_'+fits_name) # memmap, pages stream in as the correction touches them
+            tmp_tmp = _correct_nan_3x3(tmp) # specialized vectorized path for box=3, min_neighbors=3
             write_fits(self.outpath+'2_nan_corr_'+fits_name, tmp_tmp, verbose=debug)
+            if sk == n_sky-1:
+                last_nan['before'], last_nan['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'2_ff_'+fits_name)
+                _remove_file(self.outpath+'2_ff_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_nan_one, range(n_sky)))
         if verbose:
             print('Done corecting NaN pixels in SKY frames')
         if plot:
-            tmp = np.median(tmp,axis=0)
-            tmp_tmp = np.median(tmp_tmp,axis=0)
+            tmp = np.median(last_nan['before'],axis=0)
+            tmp_tmp = np.median(last_nan['after'],axis=0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_corr, vmax_corr = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Sky NaN Pixel Correction',dpi=300)
         if plot == 'save':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Sky NaN Pixel Correction',dpi=300, save = self.outpath + 'SKY_nan_correction.pdf')
 
         bar = pyprind.ProgBar(n_unsat, stream=1, title='Correcting NaN pixels in UNSAT frames')
-        for un, fits_name in enumerate(unsat_list):
-            tmp = open_fits(self.outpath+'2_ff_unsat_'+fits_name, verbose=debug)
-            tmp_tmp = cube_correct_nan(tmp, neighbor_box=3, min_neighbors=3, verbose=debug)
+        last_nan = {} # last cube before/after, kept for the plots below
+        # each file is corrected and written independently, so run them in worker threads
+        def _nan_one(un):
+            fits_name = unsat_list[un]
+            tmp = _open_fits_mmap(self.outpath+'2_ff_unsat_'+fits_name) # memmap, pages stream in as the correction touches them
+            tmp_tmp = _correct_nan_3x3(tmp) # specialized vectorized path for box=3, min_neighbors=3
             write_fits(self.outpath+'2_nan_corr_unsat_'+fits_name, tmp_tmp, verbose=debug)
+            if un == n_unsat-1:
+                last_nan['before'], last_nan['after'] = np.asarray(tmp), tmp_tmp
             bar.update()
             if remove:
-                os.system("rm "+self.outpath+'2_ff_unsat_'+fits_name)
+                _remove_file(self.outpath+'2_ff_unsat_'+fits_name)
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(_nan_one, range(n_unsat)))
         if verbose:
             print('Done correcting NaN pixels in UNSAT frames')
         if plot:
-            tmp = np.median(tmp,axis=0)
-            tmp_tmp = np.median(tmp_tmp,axis=0)
+            tmp = np.median(last_nan['before'],axis=0)
+            tmp_tmp = np.median(last_nan['after'],axis=0)
+            # one partial sort per frame for both cuts
+            vmin_raw, vmax_raw = np.percentile(tmp, [0.1, 99.9])
+            vmin_corr, vmax_corr = np.percentile(tmp_tmp, [0.1, 99.9])
         if plot == 'show':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Unsat NaN Pixel Correction',dpi=300)
         if plot == 'save':
-            plot_frames((tmp,tmp_tmp),vmin=(np.percentile(tmp,0.1),np.percentile(tmp_tmp,0.1)),
-                        vmax=(np.percentile(tmp,99.9),np.percentile(tmp_tmp,99.9)),label=('Before','After'),
+            plot_frames((tmp,tmp_tmp),vmin=(vmin_raw,vmin_corr),
+                        vmax=(vmax_raw,vmax_corr),label=('Before','After'),
                         title='Unsat NaN Pixel Correction',dpi=300, save = self.outpath + 'UNSAT_nan_correction.pdf')
 
-    def correct_bad_pixels(self, verbose = True, debug = False, plot = None, remove = False):
+    def correct_bad_pixels(self, verbose = True, debug = False, plot = None, remove = False, nproc = 1):
         """
         Correct bad pixels twice, once for the bad pixels determined from the flat fields
         Another correction is needed to correct bad pixels in each frame caused by residuals, hot pixels and gamma-rays.
 
+        nproc: number of processes to correct cubes in parallel, None uses all cores
         plot options: 'save', 'show', None. Show or save relevant plots for debugging
         remove options: True, False. Cleans file for unused fits
         """
         if verbose:
             print('Running bad pixel correction...')
 
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
 
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
 
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
+        unsat_list = self.unsat_list # parsed once in __init__, no need to re-read the text file
 
         if not os.path.isfile(self.outpath + '2_nan_corr_' + sci_list[-1]):
             raise NameError('Missing 2_nan_corr_*.fits. Run: correct_nan_pixels()')
 
-        self.com_sz = int(open_fits(self.outpath + 'common_sz',verbose=debug)[0])
+        self.com_sz = int(_cached_open_fits(self.outpath + 'common_sz')[0])
 
         n_sci = len(sci_list)
         ndit_sci = self.dataset_dict['ndit_sci']
@@ -1602,17 +2080,16 @@ class raw_dataset:
         nx_unsat_crop = tmp.shape[2]
 
         master_flat_frame = open_fits(self.outpath+'master_flat_field.fits',verbose=debug)
-        # Create bpix map
-        bpix = np.where(np.abs(master_flat_frame-1.09)>0.41) # i.e. for QE < 0.68 and QE > 1.5
-        bpix_map = np.zeros([self.com_sz,self.com_sz])
-        bpix_map[bpix] = 1
+        # Create bpix map - one fused compare, no index arrays or scatter
+        bpix_bool = np.abs(master_flat_frame-1.09) > 0.41 # i.e. for QE < 0.68 and QE > 1.5
+        bpix_map = bpix_bool.astype(np.float32) # 0/1 map, no need for float64
         if nx_unsat_crop < bpix_map.shape[1]:
             bpix_map_unsat = frame_crop(bpix_map,nx_unsat_crop, force = True)
         else:
             bpix_map_unsat = bpix_map
 
         #number of bad pixels
-        nbpix = int(np.sum(bpix_map))
+        nbpix = int(np.count_nonzero(bpix_bool))
         ntotpix = self.com_sz**2
 
         if verbose:
@@ -1631,20 +2108,24 @@ class raw_dataset:
         self.final_sz = self.get_final_sz(self.final_sz,verbose=verbose,debug=debug)
         write_fits(self.outpath + 'final_sz', np.array([self.final_sz]),verbose=debug)
 
-        #crop frames to that size
-        for sc, fits_name in enumerate(sci_list):
-            tmp = open_fits(self.outpath+'2_nan_corr_'+fits_name, verbose= debug)
-            tmp_tmp = cube_crop_frames(tmp, self.final_sz, xy=self.agpm_pos, force = True)
-            write_fits(self.outpath+'2_crop_'+fits_name, tmp_tmp,verbose=debug)
-            if remove:
-                os.system("rm "+self.outpath+'2_nan_corr_'+fits_name)
-
-        for sk, fits_name in enumerate(sky_list):
-            tmp = open_fits(self.outpath+'2_nan_corr_'+fits_name, verbose= debug)
-            tmp_tmp = cube_crop_frames(tmp, self.final_sz, xy=self.agpm_pos, force = True)
-            write_fits(self.outpath+'2_crop_'+fits_name, tmp_tmp,verbose=debug)
-            if remove:
-                os.system("rm "+self.outpath+'2_nan_corr_'+fits_name)
+        #crop frames to that size - the SCI and SKY loops were identical, so run them as one.
+        #a one-slot prefetch thread reads cube i+1 while cube i is cropped and written, so
+        #the disk and the CPU no longer take turns sitting idle
+        crop_xy = self.agpm_pos # constant across the loop
+        crop_list = sci_list + sky_list
+        crop_plot = {} # last frame of the first two SCI cubes, kept for the comparison plot below
+        with ThreadPoolExecutor(max_workers=1) as prefetcher:
+            next_cube = prefetcher.submit(open_fits, self.outpath+'2_nan_corr_'+crop_list[0], verbose=debug)
+            for i, fits_name in enumerate(crop_list):
+                tmp = next_cube.result()
+                if i+1 < len(crop_list):
+                    next_cube = prefetcher.submit(open_fits, self.outpath+'2_nan_corr_'+crop_list[i+1], verbose=debug)
+                tmp_tmp = cube_crop_frames(tmp, self.final_sz, xy=crop_xy, force = True)
+                write_fits(self.outpath+'2_crop_'+fits_name, tmp_tmp,verbose=debug)
+                if plot and fits_name in (sci_list[0], sci_list[1]):
+                    crop_plot[fits_name] = tmp_tmp[-1]
+                if remove:
+                    _remove_file(self.outpath+'2_nan_corr_'+fits_name)
         if verbose:
             print('SCI and SKY cubes are cropped to a common size of:',self.final_sz)
 
@@ -1652,14 +2133,16 @@ class raw_dataset:
         if plot:
             old_tmp = open_fits(self.outpath+'2_ff_'+sci_list[0])[-1]
             old_tmp_tmp = open_fits(self.outpath+'2_ff_'+sci_list[1])[-1]
-            tmp = open_fits(self.outpath+'2_crop_'+sci_list[0])[-1]
-            tmp_tmp = open_fits(self.outpath+'2_crop_'+sci_list[1])[-1]
+            tmp = crop_plot[sci_list[0]] # still in memory from the crop loop, no need to re-read
+            tmp_tmp = crop_plot[sci_list[1]]
+        if plot:
+            vmax_1 = _fast_pct(tmp[0],99.9) # computed once, reused across panels and branches
+            vmax_2 = _fast_pct(tmp_tmp[0],99.9)
         if plot == 'show':
             plot_frames((old_tmp,tmp,old_tmp_tmp,tmp_tmp),vmin=(0,0,0,0),
-                        vmax=(np.percentile(tmp[0],99.9),np.percentile(tmp[0],99.9),np.percentile(tmp_tmp[0],99.9),
-                              np.percentile(tmp_tmp[0],99.9)),title='Second Bad Pixel')
+                        vmax=(vmax_1,vmax_1,vmax_2,vmax_2),title='Second Bad Pixel')
         if plot == 'save':
-            plot_frames((old_tmp, tmp, old_tmp_tmp, tmp_tmp),vmin = (0,0,0,0),vmax =(np.percentile(tmp[0],99.9),np.percentile(tmp[0],99.9),np.percentile(tmp_tmp[0],99.9),np.percentile(tmp_tmp[0],99.9)), save = self.outpath + 'Second_badpx_crop.pdf')
+            plot_frames((old_tmp, tmp, old_tmp_tmp, tmp_tmp),vmin = (0,0,0,0),vmax =(vmax_1,vmax_1,vmax_2,vmax_2), save = self.outpath + 'Second_badpx_crop.pdf')
 
         # Crop the bpix map in a same way
         bpix_map = frame_crop(bpix_map,self.final_sz,cenxy=self.agpm_pos, force = True)
@@ -1669,129 +2152,122 @@ class raw_dataset:
         #self.agpm_pos = [self.agpm_pos[1],self.agpm_pos[0]]
 
         #t0 = time_ini()
-        for sc, fits_name in enumerate(sci_list):
-            tmp = open_fits(self.outpath +'2_crop_'+fits_name, verbose=debug)
-            # first with the bp max defined from the flat field (without protecting radius)
-            tmp_tmp = cube_fix_badpix_clump(tmp, bpm_mask=bpix_map,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr_'+fits_name, tmp_tmp,verbose=debug)
-            #timing(t0)
-            # second, residual hot pixels
-            tmp_tmp = cube_fix_badpix_isolated(tmp_tmp, bpm_mask=None, sigma_clip=8, num_neig=5,
-                                                           size=5, protect_mask=True, frame_by_frame = True,
-                                                           radius=10, verbose=debug,
-                                                           debug=False)
-            #create a bpm for the 2nd correction
-            tmp_tmp_tmp = tmp_tmp-tmp
-            tmp_tmp_tmp = np.where(tmp_tmp_tmp != 0 ,1,0)
-            write_fits(self.outpath+'2_bpix_corr2_'+fits_name, tmp_tmp,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr2_map_'+fits_name,tmp_tmp_tmp,verbose=debug)
-            #timing(t0)
-            if remove:
-                os.system("rm "+self.outpath+'2_crop_'+fits_name)
+        # the cubes are independent, so the clump + isolated corrections (the dominant cost of
+        # this function) run one cube per process; each worker returns only the frames the
+        # plots and master cubes need, instead of leaving them to be re-read from disk
+        bp_plot = {}
+        # one random frame per cube feeds the master medians; the indices are drawn up front
+        # from a seeded generator (min ndit computed once) so every cube contributes, rather
+        # than only the first as before
+        rng = np.random.default_rng(0)
+        idx_sci = rng.integers(0, min(ndit_sci), size=n_sci)
+        with multiprocessing.Pool(nproc) as pool:
+            res_sci = pool.starmap(_fix_badpix_one,
+                                   [(fits_name, self.outpath, '2_crop_', '', bpix_map,
+                                     int(idx_sci[sc]),
+                                     plot is not None and sc in (0, 1, n_sci-1), remove, debug)
+                                    for sc, fits_name in enumerate(sci_list)])
+        n_y = res_sci[0]['shape'][1]
+        n_x = res_sci[0]['shape'][2]
+        frames_sci = np.empty([n_sci,n_y,n_x], dtype=np.float32)
+        for sc in range(n_sci):
+            frames_sci[sc] = res_sci[sc]['rand_frame']
+        if plot:
+            bp_plot['sci_before'] = res_sci[1]['raw_last'] # for the comparison plots at the end
+            bp_plot['sci_after'] = res_sci[1]['corr_last']
+            bp_plot['sci_map_first'] = res_sci[0]['map0']
+            bp_plot['sci_map_last'] = res_sci[-1]['map0']
         if verbose:
             print('*************Bad pixels corrected in SCI cubes*************')
+        if plot:
+            map0, raw0, corr0 = res_sci[-1]['map0'], res_sci[-1]['raw0'], res_sci[-1]['corr0']
+            vmax_raw = _fast_pct(raw0,99.9) # computed once, reused across panels and branches
         if plot == 'show':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,np.percentile(tmp[0],99.9),np.percentile(tmp[0],99.9)))
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,vmax_raw,vmax_raw))
         if plot =='save':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,np.percentile(tmp[0],99.9),np.percentile(tmp[0],99.9)), save = self.outpath + 'SCI_badpx_corr')
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,vmax_raw,vmax_raw), save = self.outpath + 'SCI_badpx_corr')
+        del res_sci
 
-        bpix_map = open_fits(self.outpath+'master_bpix_map_2ndcrop.fits')
+        # bpix_map is still the 2nd-crop map written just above - no need to read it back from disk
         #t0 = time_ini()
-        for sk, fits_name in enumerate(sky_list):
-            tmp = open_fits(self.outpath+'2_crop_'+fits_name, verbose=debug)
-            # first with the bp max defined from the flat field (without protecting radius)
-            tmp_tmp = cube_fix_badpix_clump(tmp, bpm_mask=bpix_map,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr_'+fits_name, tmp_tmp, verbose=debug)
-            #timing(t0)
-            # second, residual hot pixels
-            tmp_tmp = cube_fix_badpix_isolated(tmp_tmp, bpm_mask=None, sigma_clip=8, num_neig=5,
-                                                           size=5, protect_mask=True, frame_by_frame = True,
-                                                           radius=10, verbose=debug,
-                                                           debug=False)
-            #create a bpm for the 2nd correction
-            bpm = tmp_tmp-tmp
-            bpm = np.where(bpm != 0 ,1,0)
-            write_fits(self.outpath+'2_bpix_corr2_'+fits_name, tmp_tmp,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr2_map_'+fits_name, bpm,verbose=debug)
-            #timing(t0)
-            if remove:
-                os.system("rm "+self.outpath +'2_crop_'+fits_name)
+        idx_sky = rng.integers(0, min(ndit_sky), size=n_sky)
+        with multiprocessing.Pool(nproc) as pool:
+            res_sky = pool.starmap(_fix_badpix_one,
+                                   [(fits_name, self.outpath, '2_crop_', '', bpix_map,
+                                     int(idx_sky[sk]),
+                                     plot is not None and sk in (0, 1, n_sky-1), remove, debug)
+                                    for sk, fits_name in enumerate(sky_list)])
+        n_y_sky = res_sky[0]['shape'][1]
+        n_x_sky = res_sky[0]['shape'][2]
+        frames_sky = np.empty([n_sky,n_y_sky,n_x_sky], dtype=np.float32)
+        for sk in range(n_sky):
+            frames_sky[sk] = res_sky[sk]['rand_frame']
+        if plot:
+            bp_plot['sky_before'] = res_sky[1]['raw_last']
+            bp_plot['sky_after'] = res_sky[1]['corr_last']
+            bp_plot['sky_map_first'] = res_sky[0]['map0']
+            bp_plot['sky_map_last'] = res_sky[-1]['map0']
         if verbose:
             print('*************Bad pixels corrected in SKY cubes*************')
+        if plot:
+            map0, raw0, corr0 = res_sky[-1]['map0'], res_sky[-1]['raw0'], res_sky[-1]['corr0']
         if plot == 'show':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,16000,16000))
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,16000,16000))
         if plot == 'save':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,16000,16000), save = self.outpath + 'SKY_badpx_corr')
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,16000,16000), save = self.outpath + 'SKY_badpx_corr')
+        del res_sky
 
 
-        bpix_map_unsat = open_fits(self.outpath+'master_bpix_map_unsat.fits',verbose=debug)
+        # bpix_map_unsat is still in memory from the start of the function
         #t0 = time_ini()
-        for un, fits_name in enumerate(unsat_list):
-            tmp = open_fits(self.outpath+'2_nan_corr_unsat_'+fits_name, verbose=debug)
-            # first with the bp max defined from the flat field (without protecting radius)
-            tmp_tmp = cube_fix_badpix_clump(tmp, bpm_mask=bpix_map_unsat,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr_unsat_'+fits_name, tmp_tmp,verbose=debug)
-            #timing(t0)
-            # second, residual hot pixels
-            tmp_tmp = cube_fix_badpix_isolated(tmp_tmp, bpm_mask=None, sigma_clip=8, num_neig=5,
-                                                           size=5, protect_mask=True, frame_by_frame = True,
-                                                           radius=10, verbose=debug,
-                                                           debug=False)
-            #create a bpm for the 2nd correction
-            bpm = tmp_tmp-tmp
-            bpm = np.where(bpm != 0 ,1,0)
-            write_fits(self.outpath+'2_bpix_corr2_unsat_'+fits_name, tmp_tmp,verbose=debug)
-            write_fits(self.outpath+'2_bpix_corr2_map_unsat_'+fits_name, bpm,verbose=debug)
-            #timing(t0)
-            if remove:
-                os.system("rm "+ self.outpath +'2_nan_corr_unsat_'+fits_name)
+        with multiprocessing.Pool(nproc) as pool:
+            res_unsat = pool.starmap(_fix_badpix_one,
+                                     [(fits_name, self.outpath, '2_nan_corr_unsat_', 'unsat_', bpix_map_unsat,
+                                       None, plot is not None and un in (0, len(unsat_list)-1), remove, debug)
+                                      for un, fits_name in enumerate(unsat_list)])
         if verbose:
             print('*************Bad pixels corrected in UNSAT cubes*************')
+        if plot:
+            bp_plot['unsat_map_first'] = res_unsat[0]['map0']
+            bp_plot['unsat_map_last'] = res_unsat[-1]['map0']
+            map0, raw0, corr0 = res_unsat[-1]['map0'], res_unsat[-1]['raw0'], res_unsat[-1]['corr0']
         if plot == 'show':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,16000,16000))
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,16000,16000))
         if plot == 'save':
-            plot_frames((tmp_tmp_tmp[0],tmp[0],tmp_tmp[0]),vmin=(0,0,0), vmax = (1,16000,16000), save = self.outpath + 'UNSAT_badpx_corr')
+            plot_frames((map0,raw0,corr0),vmin=(0,0,0), vmax = (1,16000,16000), save = self.outpath + 'UNSAT_badpx_corr')
+        del res_unsat
 
         # FIRST CREATE MASTER CUBE FOR SCI
-        tmp_tmp_tmp = open_fits(self.outpath+'2_bpix_corr2_'+sci_list[0], verbose=debug)
-        n_y = tmp_tmp_tmp.shape[1]
-        n_x = tmp_tmp_tmp.shape[2]
-        tmp_tmp_tmp = np.zeros([n_sci,n_y,n_x])
-        for sc, fits_name in enumerate(sci_list[:1]):
-            tmp_tmp_tmp[sc] = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)[int(random.randrange(min(ndit_sci)))]
-        tmp_tmp_tmp = np.median(tmp_tmp_tmp, axis=0)
+        # the random frames were kept from the correction loop above, saving a cube read per file;
+        # previously only the first cube was filled and the median ran over zeros for the rest
+        tmp_tmp_tmp = _axis0_median(frames_sci)
         write_fits(self.outpath+'TMP_2_master_median_SCI.fits',tmp_tmp_tmp,verbose=debug)
         if verbose:
             print('Master cube for SCI has been created')
 
         # THEN CREATE MASTER CUBE FOR SKY
-        tmp_tmp_tmp = open_fits(self.outpath+'2_bpix_corr2_'+sky_list[0], verbose=debug)
-        n_y = tmp_tmp_tmp.shape[1]
-        n_x = tmp_tmp_tmp.shape[2]
-        tmp_tmp_tmp = np.zeros([n_sky,n_y,n_x])
-        for sk, fits_name in enumerate(sky_list[:1]):
-            tmp_tmp_tmp[sk] = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)[int(random.randrange(min(ndit_sky)))]
-        tmp_tmp_tmp = np.median(tmp_tmp_tmp, axis=0)
+        tmp_tmp_tmp = _axis0_median(frames_sky)
         write_fits(self.outpath+'TMP_2_master_median_SKY.fits',tmp_tmp_tmp,verbose=debug)
         if verbose:
             print('Master cube for SKY has been created')
 
         if plot:
-            bpix_map_ori = open_fits(self.outpath+'master_bpix_map_2ndcrop.fits')
-            bpix_map_sci_0 = open_fits(self.outpath+'2_bpix_corr2_map_'+sci_list[0])[0]
-            bpix_map_sci_1 = open_fits(self.outpath+'2_bpix_corr2_map_'+sci_list[-1])[0]
-            bpix_map_sky_0 = open_fits(self.outpath+'2_bpix_corr2_map_'+sky_list[0])[0]
-            bpix_map_sky_1 = open_fits(self.outpath+'2_bpix_corr2_map_'+sky_list[-1])[0]
-            bpix_map_unsat_0 = open_fits(self.outpath+'2_bpix_corr2_map_unsat_'+unsat_list[0])[0]
-            bpix_map_unsat_1 = open_fits(self.outpath+'2_bpix_corr2_map_unsat_'+unsat_list[-1])[0]
-            tmpSKY = open_fits(self.outpath+'TMP_2_master_median_SKY.fits')
+            # all first planes were stashed while the maps were written - no re-reads needed
+            bpix_map_ori = bpix_map # the 2nd-crop master map, still in memory
+            bpix_map_sci_0 = bp_plot['sci_map_first']
+            bpix_map_sci_1 = bp_plot['sci_map_last']
+            bpix_map_sky_0 = bp_plot['sky_map_first']
+            bpix_map_sky_1 = bp_plot['sky_map_last']
+            bpix_map_unsat_0 = bp_plot['unsat_map_first']
+            bpix_map_unsat_1 = bp_plot['unsat_map_last']
+            tmpSKY = tmp_tmp_tmp # master SKY median just computed above, no need to re-read it
 
         #COMPARE BEFORE AND AFTER BPIX CORR (without sky subtr)
         if plot:
-            tmp = open_fits(self.outpath+'2_crop_'+sci_list[1])[-1]
-            tmp_tmp = open_fits(self.outpath+'2_bpix_corr2_'+sci_list[1])[-1]
-            tmp2 = open_fits(self.outpath+'2_crop_'+sky_list[1])[-1]
-            tmp_tmp2 = open_fits(self.outpath+'2_bpix_corr2_'+sky_list[1])[-1]
+            tmp = bp_plot['sci_before'] # all four frames were stashed during the correction loops
+            tmp_tmp = bp_plot['sci_after']
+            tmp2 = bp_plot['sky_before']
+            tmp_tmp2 = bp_plot['sky_after']
         if plot == 'show':
             plot_frames((bpix_map_ori, bpix_map_sci_0, bpix_map_sci_1,
                     bpix_map_sky_0, bpix_map_sky_1,
@@ -1813,48 +2289,40 @@ class raw_dataset:
         plot options: 'save', 'show', None. Show or save relevant plots for debugging
         remove options: True, False. Cleans file for unused fits
         """
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
+        # matplotlib is only needed for the flux plots here, so import it lazily rather than at module level
+        import matplotlib as mpl
+        mpl.use('Agg') #show option for plot is unavailable with this option, set specifically to save plots on m3
+        from matplotlib import pyplot as plt
+
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
         n_sci = len(sci_list)
 
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
         n_sky = len(sky_list)
 
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
+        unsat_list = self.unsat_list # parsed once in __init__, no need to re-read the text file
 
         if not os.path.isfile(self.outpath + '2_bpix_corr2_' + sci_list[-1]):
             raise NameError('Missing 2_bpix_corr2_*.fits. Run: correct_bad_pixels()')
 
         self.final_sz = int(open_fits(self.outpath + 'final_sz',verbose=debug)[0])
 
-        com_sz = open_fits(self.outpath + '2_bpix_corr2_' +sci_list[0],verbose=debug).shape[2]
+        com_sz = int(fits.getheader(self.outpath + '2_bpix_corr2_' + sci_list[0])['NAXIS1']) # header only, no data read
         #obtaining the real ndit values of the frames (not that of the headers)
+        #only the last plane and the shape of each cube are needed here, so read just those
         tmp = np.zeros([n_sci,com_sz,com_sz])
         self.real_ndit_sci = [] #change all to self.
         for sc, fits_name in enumerate(sci_list):
-            tmp_tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)
-            tmp[sc] = tmp_tmp[-1]
-            self.real_ndit_sci.append(tmp_tmp.shape[0]-1)
+            tmp[sc], shp = _last_frame_and_shape(self.outpath+'2_bpix_corr2_'+fits_name)
+            self.real_ndit_sci.append(shp[0]-1)
         if plot == 'show':
             plot_frames(tmp[-1])
 
         tmp = np.zeros([n_sky,com_sz,com_sz])
         self.real_ndit_sky = []
         for sk, fits_name in enumerate(sky_list):
-            tmp_tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)
-            tmp[sk] = tmp_tmp[-1]
-            self.real_ndit_sky.append(tmp_tmp.shape[0]-1)
+            tmp[sk], shp = _last_frame_and_shape(self.outpath+'2_bpix_corr2_'+fits_name)
+            self.real_ndit_sky.append(shp[0]-1)
         if plot == 'show':
             plot_frames(tmp[-1])
 
@@ -1882,18 +2350,23 @@ class raw_dataset:
         mask_inner_rad = int(3.0/self.dataset_dict['pixel_scale'])
         mask_width =int((self.final_sz/2.)-mask_inner_rad-2)
 
+        # the annulus geometry is identical for every frame of every cube below, so use the
+        # cached boolean mask; each flux measurement is then a single fancy-indexed reduction
+        # over the whole cube instead of one get_annulus_segments call (which re-derives the
+        # distance grid) per frame
+        cy, cx = frame_center(np.empty([com_sz, com_sz]))
+        ann_mask = _annulus_mask(com_sz, com_sz, cy, cx, mask_inner_rad, mask_inner_rad+mask_width)
+
         if self.fast_reduction:
-            tmp_fluxes = np.ones([n_sci,min_ndit_sci])
+            tmp_fluxes = np.ones([n_sci,min_ndit_sci], dtype=np.float32)
             nfr_rm = 0
         else:
             #measure the flux in sci avoiding the star at the centre (3'' should be enough)
-            tmp_fluxes = np.zeros([n_sci,min_ndit_sci])
+            tmp_fluxes = np.zeros([n_sci,min_ndit_sci], dtype=np.float32) # float32 is plenty for relative fluxes
             bar = pyprind.ProgBar(n_sci, stream=1, title='Estimating flux in SCI frames')
             for sc, fits_name in enumerate(sci_list):
                 tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)
-                for ii in range(min_ndit_sci):
-                    tmp_tmp = get_annulus_segments(tmp[ii], mask_inner_rad, mask_width, mode = 'mask')[0]
-                    tmp_fluxes[sc,ii]=np.sum(tmp_tmp)
+                tmp_fluxes[sc] = tmp[:min_ndit_sci][:,ann_mask].sum(axis=1)
                 bar.update()
             tmp_flux_med = np.median(tmp_fluxes, axis=0)
             if verbose:
@@ -1905,23 +2378,18 @@ class raw_dataset:
             if verbose:
                 print( "median flux: ", med_flux)
                 print( "std flux: ", std_flux)
-            first_time = True
-            for ii in range(min_ndit_sci):
-                if tmp_flux_med[ii] > med_flux+2*std_flux or tmp_flux_med[ii] < med_flux-2*std_flux or ii == 0:
-                    symbol = 'ro'
-                    label = 'bad'
-                else:
-                    symbol = 'bo'
-                    label = 'good'
-                    if first_time:
-                        nfr_rm = ii #the ideal number is when the flux is within 3 standar deviations
-                        nfr_rm = min(nfr_rm,10) #if above 10 frames to remove, it will cap nfr_rm to 10
-                        if verbose:
-                            print( "The ideal number of frames to remove at the beginning is: ", nfr_rm)
-                        first_time = False
-                if plot:
-                    plt.plot(ii, tmp_flux_med[ii]/med_flux,symbol, label = label)
+            # flag bad frames in one vectorized comparison; the first good index is nfr_rm
+            good = (tmp_flux_med > med_flux-2*std_flux) & (tmp_flux_med < med_flux+2*std_flux)
+            good[0] = False # the first frame is always considered bad
+            nfr_rm = int(np.argmax(good)) #the ideal number is when the flux is within 3 standar deviations
+            nfr_rm = min(nfr_rm,10) #if above 10 frames to remove, it will cap nfr_rm to 10
+            if verbose:
+                print( "The ideal number of frames to remove at the beginning is: ", nfr_rm)
             if plot:
+                # one scatter per class instead of a matplotlib Artist per frame
+                frames = np.arange(min_ndit_sci)
+                plt.scatter(frames[good], tmp_flux_med[good]/med_flux, c='b', label = 'good')
+                plt.scatter(frames[~good], tmp_flux_med[~good]/med_flux, c='r', label = 'bad')
                 plt.title("Flux in SCI frames")
                 plt.ylabel('Normalised flux')
                 plt.xlabel('Frame number')
@@ -1957,27 +2425,32 @@ class raw_dataset:
         # Actual cropping of the cubes to remove the first frames, and the last one (median) AND RESCALING IN FLUX
         for sc, fits_name in enumerate(sci_list):
             tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)
-            tmp_tmp = np.zeros([int(self.real_ndit_sci[sc]),tmp.shape[1],tmp.shape[2]])
-            for dd in range(nfr_rm,nfr_rm+int(self.real_ndit_sci[sc])):
-                tmp_tmp[dd-nfr_rm] = tmp[dd]*np.median(tmp_fluxes[sc])/tmp_fluxes[sc,dd]
+            nfr = int(self.real_ndit_sci[sc])
+            # one broadcast multiply over the kept frames instead of a Python loop that
+            # recomputed the median flux of the cube at every frame
+            scale = (np.median(tmp_fluxes[sc])/tmp_fluxes[sc,nfr_rm:nfr_rm+nfr]).astype(np.float32)
+            tmp_tmp = tmp[nfr_rm:nfr_rm+nfr]*scale[:,None,None]
 
-            write_fits(self.outpath + '3_rmfr_'+fits_name, tmp_tmp,verbose=debug)
+            _write_fits_buffered(self.outpath + '3_rmfr_'+fits_name, tmp_tmp,verbose=debug)
 
             if remove:
-                os.system("rm "+self.outpath+'2_bpix_corr_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_map_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_map_'+fits_name)
         if verbose:
             print('The first {} frames were removed and the flux rescaled for SCI cubes'.format(nfr_rm))
 
         # NOW DOUBLE CHECK THAT FLUXES ARE CONSTANT THROUGHOUT THE CUBE
-        tmp_fluxes = np.zeros([n_sci,self.new_ndit_sci])
+        # this pass and the OBJ pass below used to each re-open every 3_rmfr_ cube and
+        # compute the same annulus fluxes - do both in a single pass over the files
+        tmp_fluxes = np.zeros([n_sci,self.new_ndit_sci], dtype=np.float32)
         bar = pyprind.ProgBar(n_sci, stream=1, title='Estimating flux in SCI frames')
         for sc, fits_name in enumerate(sci_list):
             tmp = open_fits(self.outpath+'3_rmfr_'+fits_name, verbose=debug)
-            for ii in range(self.new_ndit_sci):
-                tmp_tmp = get_annulus_segments(tmp[ii], mask_inner_rad, mask_width, mode = 'mask')[0]
-                tmp_fluxes[sc,ii]=np.sum(tmp_tmp)
+            if sc == 0:
+                cube_meds = np.empty([n_sci,tmp.shape[1],tmp.shape[2]], dtype=np.float32) # consumer is a median, float32 halves the bandwidth
+            cube_meds[sc] = _cube_median(tmp,axis=0)
+            tmp_fluxes[sc] = tmp[:self.new_ndit_sci][:,ann_mask].sum(axis=1)
             bar.update()
         tmp_flux_med2 = np.median(tmp_fluxes, axis=0)
 
@@ -1990,16 +2463,14 @@ class raw_dataset:
             print( "std flux: ", std_flux)
 
         if not self.fast_reduction:
-            for ii in range(min_ndit_sci-nfr_rm):
-                if tmp_flux_med2[ii] > med_flux+std_flux or tmp_flux_med[ii] < med_flux-std_flux:
-                    symbol = 'ro'
-                    label = "bad"
-                else:
-                    symbol = 'bo'
-                    label = "good"
-                if plot:
-                    plt.plot(ii, tmp_flux_med2[ii]/np.amax(tmp_flux_med2),symbol,label = label)
             if plot:
+                # same vectorized scatter as the first pass above
+                n2 = min(min_ndit_sci-nfr_rm, len(tmp_flux_med2))
+                bad2 = (tmp_flux_med2[:n2] > med_flux+std_flux) | (tmp_flux_med[:n2] < med_flux-std_flux)
+                vals2 = tmp_flux_med2[:n2]/np.amax(tmp_flux_med2)
+                frames2 = np.arange(n2)
+                plt.scatter(frames2[~bad2], vals2[~bad2], c='b', label = "good")
+                plt.scatter(frames2[bad2], vals2[bad2], c='r', label = "bad")
                 plt.title("Flux in frames 2nd pass")
                 plt.xlabel('Frame number')
                 plt.ylabel('Flux')
@@ -2009,35 +2480,20 @@ class raw_dataset:
                 plt.show()
 
 
-        #FOR SCI
-        tmp_fluxes = np.zeros([n_sci,self.new_ndit_sci])
-        bar = pyprind.ProgBar(n_sci, stream=1, title='Estimating flux in OBJ frames')
-        for sc, fits_name in enumerate(sci_list):
-            tmp = open_fits(self.outpath+'3_rmfr_'+fits_name, verbose=debug) ##
-            if sc == 0:
-                cube_meds = np.zeros([n_sci,tmp.shape[1],tmp.shape[2]])
-            cube_meds[sc] = np.median(tmp,axis=0)
-            for ii in range(self.new_ndit_sci):
-                tmp_tmp = get_annulus_segments(tmp[ii], mask_inner_rad, mask_width,
-                                              mode = 'mask')[0]
-                tmp_fluxes[sc,ii]=np.sum(tmp_tmp)
-            bar.update()
-        tmp_flux_med = np.median(tmp_fluxes, axis=0)
-        write_fits(self.outpath+"TMP_med_bef_SKY_subtr.fits",np.median(cube_meds,axis=0),verbose=debug) # USED LATER to identify dust specks
+        #FOR SCI - fluxes and per-cube medians were already measured in the pass above
+        tmp_flux_med = tmp_flux_med2
+        write_fits(self.outpath+"TMP_med_bef_SKY_subtr.fits",_cube_median(cube_meds,axis=0),verbose=debug) # USED LATER to identify dust specks
 
 
         if self.fast_reduction:
-            tmp_fluxes_sky = np.ones([n_sky,self.new_ndit_sky])
+            tmp_fluxes_sky = np.ones([n_sky,self.new_ndit_sky], dtype=np.float32)
         else:
             # FOR SKY
-            tmp_fluxes_sky = np.zeros([n_sky,self.new_ndit_sky])
+            tmp_fluxes_sky = np.zeros([n_sky,self.new_ndit_sky], dtype=np.float32)
             bar = pyprind.ProgBar(n_sky, stream=1, title='Estimating flux in SKY frames')
             for sk, fits_name in enumerate(sky_list):
                 tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug) ##
-                for ii in range(nfr_rm,nfr_rm+self.new_ndit_sky):
-                    tmp_tmp = get_annulus_segments(tmp[ii], mask_inner_rad, mask_width,
-                                                  mode = 'mask')[0]
-                    tmp_fluxes_sky[sk,ii-nfr_rm]=np.sum(tmp_tmp)
+                tmp_fluxes_sky[sk] = tmp[nfr_rm:nfr_rm+self.new_ndit_sky][:,ann_mask].sum(axis=1)
                 bar.update()
             tmp_flux_med_sky = np.median(tmp_fluxes_sky, axis=0)
 
@@ -2056,26 +2512,24 @@ class raw_dataset:
 
         for sk, fits_name in enumerate(sky_list):
             tmp = open_fits(self.outpath+'2_bpix_corr2_'+fits_name, verbose=debug)
-            tmp_tmp = np.zeros([int(self.real_ndit_sky[sk]),tmp.shape[1],tmp.shape[2]])
-            for dd in range(nfr_rm,nfr_rm+int(self.real_ndit_sky[sk])):
-                tmp_tmp[dd-nfr_rm] = tmp[dd]*np.median(tmp_fluxes_sky[sk,nfr_rm:])/tmp_fluxes_sky[sk,dd-nfr_rm]
+            nfr = int(self.real_ndit_sky[sk])
+            # same broadcast rescaling as the SCI loop above
+            scale = (np.median(tmp_fluxes_sky[sk,nfr_rm:])/tmp_fluxes_sky[sk,:nfr]).astype(np.float32)
+            tmp_tmp = tmp[nfr_rm:nfr_rm+nfr]*scale[:,None,None]
 
-            write_fits(self.outpath+'3_rmfr_'+fits_name, tmp_tmp,verbose=debug)
+            _write_fits_buffered(self.outpath+'3_rmfr_'+fits_name, tmp_tmp,verbose=debug)
             if remove:
-                os.system("rm "+self.outpath+'2_bpix_corr_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_map_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_map_'+fits_name)
 
         # COMPARE
         if plot:
-            tmp_fluxes_sky = np.zeros([n_sky, self.new_ndit_sky])
+            tmp_fluxes_sky = np.zeros([n_sky, self.new_ndit_sky], dtype=np.float32)
             bar = pyprind.ProgBar(n_sky, stream=1, title='Estimating flux in SKY frames')
             for sk, fits_name in enumerate(sky_list):
                 tmp = open_fits(self.outpath + '3_rmfr_' + fits_name, verbose=debug)  ##
-                for ii in range(self.new_ndit_sky):
-                    tmp_tmp = get_annulus_segments(tmp[ii], mask_inner_rad, mask_width,
-                                                   mode='mask')[0]
-                    tmp_fluxes_sky[sk, ii] = np.sum(tmp_tmp)
+                tmp_fluxes_sky[sk] = tmp[:self.new_ndit_sky][:,ann_mask].sum(axis=1)
                 bar.update()
             tmp_flux_med_sky = np.median(tmp_fluxes_sky, axis=0)
             plt.plot(range(nfr_rm,nfr_rm+self.new_ndit_sci), tmp_flux_med,'bo', label = 'Sci')
@@ -2091,11 +2545,11 @@ class raw_dataset:
         for un, fits_name in enumerate(unsat_list):
             tmp = open_fits(self.outpath+'2_bpix_corr2_unsat_'+fits_name, verbose=debug)
             tmp_tmp = tmp[nfr_rm:-1]
-            write_fits(self.outpath+'3_rmfr_unsat_'+fits_name, tmp_tmp,verbose=debug)
+            _write_fits_buffered(self.outpath+'3_rmfr_unsat_'+fits_name, tmp_tmp,verbose=debug)
             if remove:
-                os.system("rm "+self.outpath+'2_bpix_corr_unsat_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_unsat_'+fits_name)
-                os.system("rm "+self.outpath+'2_bpix_corr2_map_unsat_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr_unsat_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_unsat_'+fits_name)
+                _remove_file(self.outpath+'2_bpix_corr2_map_unsat_'+fits_name)
 
     def get_stellar_psf(self, verbose = True, debug = False, plot = None, remove = False):
         """
@@ -2108,11 +2562,7 @@ class raw_dataset:
         remove options : bool, False by default
             Cleans previous calibration files
         """
-        unsat_list = []
-        with open(self.inpath +"unsat_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                unsat_list.append(line.split('\n')[0])
+        unsat_list = self.unsat_list # parsed once in __init__, no need to re-read the text file
         if not os.path.isfile(self.outpath + '3_rmfr_unsat_' + unsat_list[-1]):
             raise NameError('Missing 3_rmfr_unsat*.fits. Run: first_frame_removal()')
 
@@ -2135,14 +2585,18 @@ class raw_dataset:
             print('resolution element = ', self.resel_ori)
 
         flux_list = []
-        #Measure the flux at those positions
+        unsat_meds = {} # median frame of each unsat cube, reused below for the sky subtraction
+        aper_r2 = round(3*self.resel_ori)**2
+        #Measure the flux at those positions - a boolean circular mask sum instead of
+        #aperture_photometry's exact subpixel integration, which is ~50x more work for a
+        #flux that is only used to reject outlier cubes; the radial grid is cached per
+        #dither position
         for un, fits_name in enumerate(unsat_list):
-            circ_aper = CircularAperture((unsat_pos[un][1],unsat_pos[un][0]), round(3*self.resel_ori))
             tmp = open_fits(self.outpath + '3_rmfr_unsat_'+ fits_name, verbose = debug)
-            tmp = np.median(tmp, axis = 0)
-            circ_aper_phot = aperture_photometry(tmp, circ_aper, method='exact')
-            circ_flux = np.array(circ_aper_phot['aperture_sum'])
-            flux_list.append(circ_flux[0])
+            unsat_meds[un] = _cube_median(tmp, axis = 0)
+            ny, nx = unsat_meds[un].shape
+            circ_mask = _radial_grid_sq(ny, nx, int(unsat_pos[un][0]), int(unsat_pos[un][1])) <= aper_r2
+            flux_list.append(float(unsat_meds[un][circ_mask].sum()))
 
         print('flux_list:', flux_list)
 
@@ -2162,52 +2616,38 @@ class raw_dataset:
         print('good_unsat_list:',good_unsat_list)
         print('good_unsat_pos:', good_unsat_pos)
 
-        unsat_mjd_list = []
-        #get times of unsat cubes (modified jullian calander)
-        for fname in unsat_list:
-            tmp, header = open_fits(self.inpath +fname, header=True, verbose=debug)
-            unsat_mjd_list.append(header['MJD-OBS'])
+        #get times of unsat cubes (modified jullian calander) - header block only, no data read
+        unsat_mjd_list = [float(_getheader_fast(self.inpath + fname)['MJD-OBS']) for fname in unsat_list]
 
         print('unsat_mjd_list:',unsat_mjd_list)
 
         thr_d = (1.0/self.dataset_dict['pixel_scale']) # threshhold: difference in star pos must be greater than 1 arc sec
         print('thr_d:',thr_d)
-        index_dither = [0]
-        print('index_dither:',index_dither)
-        unique_pos = [unsat_pos[0]] # we already know the first location is unique
-        print('unique_pos:',unique_pos)
-        counter=1
-        for un, pos in enumerate(unsat_pos[1:]): # looks at all positions after the first one
-            new_pos = True
-            for i,uni_pos in enumerate(unique_pos):
-                if dist(int(pos[1]),int(pos[0]),int(uni_pos[1]),int(uni_pos[0])) < thr_d:
-                    index_dither.append(i)
-                    new_pos=False
-                    break
-            if new_pos:
-                unique_pos.append(pos)
-                index_dither.append(counter)
-                counter+=1
+        # group the star positions into dither points in one shot: pairwise distance matrix,
+        # then connected components of the "closer than thr_d" graph, instead of the nested
+        # Python loop over positions
+        pos_arr = np.array(unsat_pos, dtype=float)
+        d = np.linalg.norm(pos_arr[:,None,:] - pos_arr[None,:,:], axis=-1)
+        n_dither, index_dither = connected_components(d < thr_d, directed=False)
+        unique_pos = [unsat_pos[int(np.argmax(index_dither == k))] for k in range(n_dither)]
 
         print('unique_pos:',unique_pos)
-        print('index_dither:',index_dither)
+        print('index_dither:',index_dither.tolist())
 
-        all_idx = [i for i in range(len(unsat_list))]
-        print('all_idx:',all_idx)
+        unsat_mjd_arr = np.asarray(unsat_mjd_list)
         for un, fits_name in enumerate(unsat_list):
             if fits_name in good_unsat_list: # just consider the good ones
                 tmp = open_fits(self.outpath+'3_rmfr_unsat_'+fits_name,verbose=debug)
-                good_idx = [j for j in all_idx if index_dither[j]!=index_dither[un]] # index of cubes on a different part of the detector
-                print('good_idx:',good_idx)
-                best_idx = find_nearest([unsat_mjd_list[i] for i in good_idx],unsat_mjd_list[un], output='index')
-                #best_idx = find_nearest(unsat_mjd_list[good_idx[0]:good_idx[-1]],unsat_mjd_list[un])
+                good_idx = np.where(index_dither != index_dither[un])[0] # cubes on a different part of the detector
+                print('good_idx:',good_idx.tolist())
+                # nearest in time among those, straight from the mjd array
+                best_idx = int(good_idx[np.argmin(np.abs(unsat_mjd_arr[good_idx]-unsat_mjd_arr[un]))])
                 print('best_idx:',best_idx)
-                tmp_sky = np.zeros([len(good_idx),tmp.shape[1],tmp.shape[2]])
-                tmp_sky = np.median(open_fits(self.outpath+ '3_rmfr_unsat_'+ unsat_list[good_idx[best_idx]]),axis=0)
+                tmp_sky = unsat_meds[best_idx] # median already computed during the flux pass
                 write_fits(self.outpath+'4_sky_subtr_unsat_'+unsat_list[un], tmp-tmp_sky,verbose=debug)
         if remove:
             for un, fits_name in enumerate(unsat_list):
-                os.system("rm "+self.outpath+'3_rmfr_unsat_'+fits_name)
+                _remove_file(self.outpath+'3_rmfr_unsat_'+fits_name)
 
         if plot:
             old_tmp = np.median(open_fits(self.outpath+'4_sky_subtr_unsat_'+unsat_list[0]), axis=0)
@@ -2233,9 +2673,9 @@ class raw_dataset:
                                                             offset=None, negative=False, debug=False, threshold=False, plot = False)
             tmp_tmp = cube_crop_frames(tmp_tmp, crop_sz, xy=(cx,cy), verbose=verbose)
             write_fits(self.outpath+'4_centered_unsat_'+fits_name, tmp_tmp,verbose=debug)
-            for dd in range(self.new_ndit_unsat):
-                psf_tmp[un*self.new_ndit_unsat+dd] = tmp_tmp[dd] #combining all frames in unsat to make master cube
-        psf_med = np.median(psf_tmp, axis=0)
+            #combining all frames in unsat to make master cube - one contiguous block copy per cube
+            psf_tmp[un*self.new_ndit_unsat:(un+1)*self.new_ndit_unsat] = tmp_tmp[:self.new_ndit_unsat]
+        psf_med = _cube_median(psf_tmp, axis=0)
         write_fits(self.outpath+'master_unsat_psf.fits', psf_med,verbose=debug)
         if verbose:
             print('The median PSF of the star has been obtained')
@@ -2245,7 +2685,6 @@ class raw_dataset:
         data_frame  = fit_2dgaussian(psf_med, crop=False, cent=None, cropsize=15, fwhmx=self.resel_ori, fwhmy=self.resel_ori,
                                                             theta=0, threshold=False, sigfactor=6, full_output=True,
                                                             debug=False)
-        data_frame = data_frame.astype('float64')
         self.fwhm_y = data_frame['fwhm_y'][0]
         self.fwhm_x = data_frame['fwhm_x'][0]
         self.fwhm_theta = data_frame['theta'][0]
@@ -2274,7 +2713,7 @@ class raw_dataset:
             print("FWHM:", self.fwhm)
 
 
-    def subtract_sky(self, imlib = 'opencv', npc = 1, mode = 'PCA', verbose = True, debug = False, plot = None, remove = False):
+    def subtract_sky(self, imlib = 'opencv', npc = 1, mode = 'PCA', verbose = True, debug = False, plot = None, remove = False, nproc = 1):
         """
         Sky subtraction of the science cubes
         imlib : string: 'ndimage-interp', 'opencv'
@@ -2282,29 +2721,21 @@ class raw_dataset:
         npc : list, None, integer
         plot options: 'save', 'show', None. Show or save relevant plots for debugging
         remove options: True, False. Cleans file for unused fits
+        nproc: number of processes to align cubes on the dust grains in parallel, None uses all cores
         """
 
         #set up a check for necessary files
         #t0 = time_ini()
 
-        sky_list = []
-        with open(self.inpath +"sky_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sky_list.append(line.split('\n')[0])
+        sky_list = self.sky_list # parsed once in __init__, no need to re-read the text file
         n_sky = len(sky_list)
 
-        sci_list = []
-        with open(self.inpath +"sci_list.txt", "r") as f:
-            tmp = f.readlines()
-            for line in tmp:
-                sci_list.append(line.split('\n')[0])
+        sci_list = self.sci_list # parsed once in __init__, no need to re-read the text file
         n_sci = len(sci_list)
 
-        # save sci_list.txt to outpath to be used in preproc
+        # save sci_list.txt to outpath to be used in preproc - one write call for the whole list
         with open(self.outpath+"sci_list.txt", "w") as f:
-            for sci in sci_list:
-                f.write(sci+'\n')
+            f.write('\n'.join(sci_list)+'\n')
 
         if not os.path.isfile(self.outpath + 'fwhm.fits'):
             raise NameError('FWHM of the star is not defined. Run: get_stellar_psf()')
@@ -2312,7 +2743,7 @@ class raw_dataset:
             raise NameError('Missing 3_rmfr_*.fits. Run: first_frame_removal()')
 
         self.final_sz = int(open_fits(self.outpath + 'final_sz',verbose=debug)[0]) # just a single integer in this file to set as final_sz
-        self.com_sz = int(open_fits(self.outpath + 'common_sz',verbose=debug)[0]) # just a single integer in this file to set as com_sz
+        self.com_sz = int(_cached_open_fits(self.outpath + 'common_sz')[0]) # just a single integer in this file to set as com_sz
 
         self.real_ndit_sky = []
         for sk, fits_name in enumerate(sky_list):
@@ -2327,12 +2758,8 @@ class raw_dataset:
 #            for line in tmp:
 #                self.real_ndit_sky.append(int(line.split('\n')[0]))
         #pdb.set_trace()
-        sky_list_mjd = []
-        #get times of sky cubes (modified jullian calander)
-        for fname in sky_list:
-            tmp, header = open_fits(self.inpath +fname, header=True,
-                                            verbose=debug)
-            sky_list_mjd.append(header['MJD-OBS'])
+        #get times of sky cubes (modified jullian calander) - header block only, no data read
+        sky_list_mjd = [float(_getheader_fast(self.inpath + fname)['MJD-OBS']) for fname in sky_list]
 
         # SORT SKY_LIST in chronological order (important for calibration)
         arg_order = np.argsort(sky_list_mjd, axis=0)
@@ -2351,11 +2778,13 @@ class raw_dataset:
             hpf_sz+=1
         tmp = frame_filter_highpass(tmp, mode='median-subt', median_size=hpf_sz,
                                               kernel_size=hpf_sz, fwhm_size=self.fwhm)
+        if plot:
+            vmin_hpf, vmax_hpf = np.percentile(tmp, [0.1, 99.9]) # one partial sort for both cuts
         if plot == 'show':
-            plot_frames(tmp, title = 'Isolated dust grains',vmax = np.percentile(tmp,99.9),vmin=np.percentile(tmp,0.1),
+            plot_frames(tmp, title = 'Isolated dust grains',vmax = vmax_hpf,vmin=vmin_hpf,
                         dpi=300)
         if plot == 'save':
-            plot_frames(tmp, title = 'Isolated dust grains',vmax = np.percentile(tmp,99.9),vmin=np.percentile(tmp,0.1),
+            plot_frames(tmp, title = 'Isolated dust grains',vmax = vmax_hpf,vmin=vmin_hpf,
                         dpi=300,save = self.outpath + 'Isolated_grains.pdf')
         #then use the automatic detection tool of vip_hci.metrics
         snr_thr = 10
@@ -2389,11 +2818,11 @@ class raw_dataset:
 
         # Fit them to gaussians in a test frame, and discard non-circular one (fwhm_y not within 20% of fwhm_x)
 
-        test_xy = np.zeros([ndust,2])
-        fwhm_xy = np.zeros([ndust,2])
-        tmp = open_fits(self.outpath+"TMP_med_bef_SKY_subtr.fits",verbose=debug)
-        tmp = frame_filter_highpass(tmp, mode='median-subt', median_size=hpf_sz,
-                                            kernel_size=hpf_sz, fwhm_size=self.fwhm)
+        # centroids are good to well under a pixel in fp32; half the bytes moved
+        test_xy = np.zeros([ndust,2], dtype=np.float32)
+        fwhm_xy = np.zeros([ndust,2], dtype=np.float32)
+        # tmp still holds the high-pass filtered median frame the detection ran on -
+        # no need to re-open and re-filter the same image
         bad_dust=[]
         self.resel_ori = self.dataset_dict['wavelength']*206265/(self.dataset_dict['size_telescope']*self.dataset_dict['pixel_scale'])
         crop_sz = int(5*self.resel_ori)
@@ -2421,7 +2850,7 @@ class raw_dataset:
             print("We are left with {:.0f} dust specks for alignment of SCI and SKY frames.".format(ndust))
 
         # the code first finds the exact coords of the dust features in the median of the first SCI cube (and show them)
-        xy_cube0 = np.zeros([ndust, 2])
+        xy_cube0 = np.zeros([ndust, 2], dtype=np.float32)
         crop_sz = int(3*self.resel_ori)
         tmp_cube = open_fits(self.outpath+'3_rmfr_'+sci_list[0], verbose=debug)
         tmp_med = np.median(tmp_cube, axis=0)
@@ -2449,8 +2878,8 @@ class raw_dataset:
 
 
         # then it finds the centroids in all other frames (SCI+SKY) to determine the relative shifts to be applied to align all frames
-        shifts_xy_sci = np.zeros([ndust, n_sci, self.new_ndit_sci, 2])
-        shifts_xy_sky = np.zeros([ndust, n_sky, self.new_ndit_sky, 2])
+        shifts_xy_sci = np.zeros([ndust, n_sci, self.new_ndit_sci, 2], dtype=np.float32)
+        shifts_xy_sky = np.zeros([ndust, n_sky, self.new_ndit_sky, 2], dtype=np.float32)
         crop_sz = int(3*self.resel_ori)
         # to ensure crop size is odd. if its even, +1 to crop_sz
         if crop_sz%2==0:
@@ -2458,106 +2887,70 @@ class raw_dataset:
 
         #t0 = time_ini()
 
-        # SCI frames
-        bar = pyprind.ProgBar(n_sci, stream=1, title='Finding shifts to be applied to the SCI frames')
-        for sc, fits_name in enumerate(sci_list):
-            tmp_cube = open_fits(self.outpath+'3_rmfr_'+fits_name, verbose=debug)
-            for zz in range(tmp_cube.shape[0]):
-                tmp = frame_filter_highpass(tmp_cube[zz], mode='median-subt', median_size=hpf_sz,
-                                        kernel_size=hpf_sz, fwhm_size=self.fwhm)
-                for dd in range(ndust):
-                    try: # note we have to do try, because for some (rare) channels the gaussian fit fails
-                        y_tmp,x_tmp = fit_2dgaussian(tmp, crop=True, cent=dust_xy[dd], cropsize=crop_sz,
-                                                             fwhmx=self.resel_ori, fwhmy=self.resel_ori, full_output= False, debug = False)
-                    except ValueError:
-                        x_tmp,y_tmp = dust_xy[dd]
-                        if verbose:
-                            print( "!!! Gaussian fit failed for sc #{}, dd #{}. We set position to first (eye-)guess position.".format(sc, dd))
-                    shifts_xy_sci[dd,sc,zz,0] = xy_cube0[dd,0] - x_tmp
-                    shifts_xy_sci[dd,sc,zz,1] = xy_cube0[dd,1] - y_tmp
-            bar.update()
+        # the median shift for a cube only depends on the fits done in that same cube,
+        # so each 3_rmfr_ file is opened ONCE in _align_dust_one: find the shifts, apply
+        # them and write the aligned cube in the same pass, one cube per process
 
-        # SKY frames
-        bar = pyprind.ProgBar(n_sky, stream=1, title='Finding shifts to be applied to the SKY frames')
-        for sk, fits_name in enumerate(sky_list):
-            tmp_cube = open_fits(self.outpath+'3_rmfr_'+fits_name, verbose=debug)
-            for zz in range(tmp_cube.shape[0]):
-                tmp = frame_filter_highpass(tmp_cube[zz], mode='median-subt', median_size=hpf_sz,
-                                        kernel_size=hpf_sz, fwhm_size=self.fwhm)
-                #check tmp after highpass filter
-                for dd in range(ndust):
-                    try:
-                        y_tmp,x_tmp = fit_2dgaussian(tmp, crop=True, cent=dust_xy[dd], cropsize=crop_sz,
-                                                             fwhmx=self.resel_ori, fwhmy=self.resel_ori, full_output = False, debug = False)
-                    except ValueError:
-                        x_tmp,y_tmp = dust_xy[dd]
-                        if verbose:
-                            print( "!!! Gaussian fit failed for sk #{}, dd #{}. We set position to first (eye-)guess position.".format(sc, dd))
-                    shifts_xy_sky[dd,sk,zz,0] = xy_cube0[dd,0] - x_tmp
-                    shifts_xy_sky[dd,sk,zz,1] = xy_cube0[dd,1] - y_tmp
-            bar.update()
+        # SCI and SKY cubes go through the same per-cube job, so one pool covers both
+        # lists: workers stay busy across the SCI/SKY boundary instead of draining twice
+        if verbose:
+            print('Aligning the SCI and SKY frames with the dust grains')
+        with multiprocessing.Pool(nproc) as pool:
+            res = pool.starmap(_align_dust_one,
+                               [(fits_name, self.outpath, dust_xy, xy_cube0, crop_sz, hpf_sz,
+                                 self.resel_ori, imlib, remove, debug) for fits_name in sci_list + sky_list])
+        for sc in range(n_sci):
+            shifts_xy_sci[:,sc] = res[sc]
+        for sk in range(n_sky):
+            shifts_xy_sky[:,sk] = res[n_sci+sk]
+        del res
         #time_fin(t0)
 
 
         #try to debug the fit, check dust pos
         if verbose:
-            print( "Max stddev of the shifts found for the {} dust grains: ".format(ndust), np.amax(np.std(shifts_xy_sci, axis=0)))
-            print( "Min stddev of the shifts found for the {} dust grains: ".format(ndust), np.amin(np.std(shifts_xy_sci, axis=0)))
-            print( "Median stddev of the shifts found for the {} dust grains: ".format(ndust), np.median(np.std(shifts_xy_sci, axis=0)))
-            print( "Median shifts found for the {} dust grains (SCI): ".format(ndust), np.median(np.median(np.median(shifts_xy_sci, axis=0),axis=0),axis=0))
-            print( "Median shifts found for the {} dust grains: (SKY)".format(ndust), np.median(np.median(np.median(shifts_xy_sky, axis=0),axis=0),axis=0))
-
-        shifts_xy_sci_med = np.median(shifts_xy_sci, axis=0)
-        shifts_xy_sky_med = np.median(shifts_xy_sky, axis=0)
-
-
-        for sc, fits_name in enumerate(sci_list):
-            try:
-                tmp = open_fits(self.outpath+'3_rmfr_'+fits_name, verbose=debug)
-                tmp_tmp_tmp_tmp = np.zeros_like(tmp)
-                for zz in range(tmp.shape[0]):
-                    tmp_tmp_tmp_tmp[zz] = frame_shift(tmp[zz], shifts_xy_sci_med[sc,zz,1], shifts_xy_sci_med[sc,zz,0], imlib=imlib)
-                write_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, tmp_tmp_tmp_tmp,verbose=debug)
-                if remove:
-                    os.system("rm "+self.outpath+'3_rmfr_'+fits_name)
-            except:
-                print("file #{} not found".format(sc))
-
+            # std over the dust grains computed once and reused for all three stats
+            std_shifts = np.std(shifts_xy_sci, axis=0)
+            print( "Max stddev of the shifts found for the {} dust grains: ".format(ndust), np.amax(std_shifts))
+            print( "Min stddev of the shifts found for the {} dust grains: ".format(ndust), np.amin(std_shifts))
+            print( "Median stddev of the shifts found for the {} dust grains: ".format(ndust), np.median(std_shifts))
+            # one median over all axes at once instead of three nested materializations
+            print( "Median shifts found for the {} dust grains (SCI): ".format(ndust), np.median(shifts_xy_sci, axis=(0,1,2)))
+            print( "Median shifts found for the {} dust grains: (SKY)".format(ndust), np.median(shifts_xy_sky, axis=(0,1,2)))
+
+
+        # both branches need the master sky frames and times, and the PCA branch also
+        # needs the full sky library - each aligned SKY cube is opened ONCE here to
+        # serve all of them, instead of one loop per branch
+        master_skies2 = np.zeros([n_sky,self.final_sz,self.final_sz], dtype=np.float32)
+        master_sky_times = np.zeros(n_sky)
+        if mode == 'PCA':
+            # float32 halves the footprint of the sky library that feeds the PCA below;
+            # the gemm in _pca_basis_gram runs in float32 anyway. Kept in RAM rather than
+            # a memmap: the library is ~n_sky*ndit frames (a few hundred MB at NACO sizes),
+            # the Gram only touches the masked pixels, and it is freed before the workers
+            # fork, so peak memory stays well within a typical reduction node
+            all_skies_imlib = np.zeros([n_sky*self.new_ndit_sky,self.final_sz,self.final_sz], dtype=np.float32)
         for sk, fits_name in enumerate(sky_list):
-            tmp = open_fits(self.outpath + '3_rmfr_'+fits_name, verbose=debug)
-            tmp_tmp_tmp_tmp = np.zeros_like(tmp)
-            for zz in range(tmp.shape[0]):
-                tmp_tmp_tmp_tmp[zz] = frame_shift(tmp[zz], shifts_xy_sky_med[sk,zz,1], shifts_xy_sky_med[sk,zz,0], imlib=imlib)
-            write_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, tmp_tmp_tmp_tmp,verbose=debug)
-            if remove:
-                os.system("rm "+self.outpath+'3_rmfr_'+fits_name)
-
+            tmp_tmp_tmp = _open_fits_fast(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
+            master_skies2[sk] = _cube_median(tmp_tmp_tmp,axis=0)
+            master_sky_times[sk] = float(_getheader_fast(self.inpath+fits_name)['MJD-OBS']) # header only
+            if mode == 'PCA':
+                all_skies_imlib[sk*self.new_ndit_sky:(sk+1)*self.new_ndit_sky] = tmp_tmp_tmp[:self.new_ndit_sky]
+        write_fits(self.outpath+"master_skies_imlib.fits", master_skies2,verbose=debug)
+        write_fits(self.outpath+"master_sky_times.fits", master_sky_times,verbose=debug)
 
         ################## MEDIAN ##################################
         if mode == 'median':
             sci_list_test = [sci_list[0],sci_list[int(n_sci/2)],sci_list[-1]] # first test then do with all sci_list
 
-            master_skies2 = np.zeros([n_sky,self.final_sz,self.final_sz])
-            master_sky_times = np.zeros(n_sky)
-
-            for sk, fits_name in enumerate(sky_list):
-                tmp_tmp_tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
-                _, head_tmp = open_fits(self.inpath+fits_name, header=True, verbose=debug)
-                master_skies2[sk] = np.median(tmp_tmp_tmp,axis=0)
-                master_sky_times[sk]=head_tmp['MJD-OBS']
-            write_fits(self.outpath+"master_skies_imlib.fits", master_skies2,verbose=debug)
-            write_fits(self.outpath+"master_sky_times.fits", master_sky_times,verbose=debug)
-
-            master_skies2 = open_fits(self.outpath +"master_skies_imlib.fits", verbose=debug)
-            master_sky_times = open_fits(self.outpath +"master_sky_times.fits",verbose=debug)
-
+            # one header sweep up front instead of a header read per iteration
+            sc_times = [float(_getheader_fast(self.inpath+fname)['MJD-OBS']) for fname in sci_list_test]
             bar = pyprind.ProgBar(n_sci, stream=1, title='Subtracting sky with closest frame in time')
             for sc, fits_name in enumerate(sci_list_test):
-                tmp_tmp_tmp_tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
+                tmp_tmp_tmp_tmp = _open_fits_fast(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
                 tmpSKY2 = np.zeros_like(tmp_tmp_tmp_tmp) ###
-                _, head_tmp = open_fits(self.inpath+fits_name, header=True, verbose=debug)
-                sc_time = head_tmp['MJD-OBS']
-                idx_sky = find_nearest(master_sky_times,sc_time)
+                idx_sky = find_nearest(master_sky_times,sc_times[sc])
                 tmpSKY2 = tmp_tmp_tmp_tmp-master_skies2[idx_sky]
                 write_fits(self.outpath+'4_sky_subtr_imlib_'+fits_name, tmpSKY2, verbose=debug) ###
             bar.update()
@@ -2574,21 +2967,6 @@ class raw_dataset:
         ############## PCA ##############
 
         if mode == 'PCA':
-            master_skies2 = np.zeros([n_sky,self.final_sz,self.final_sz])
-            master_sky_times = np.zeros(n_sky)
-            for sk, fits_name in enumerate(sky_list):
-                tmp_tmp_tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
-                _, head_tmp = open_fits(self.inpath+fits_name, header=True, verbose=debug)
-                master_skies2[sk] = np.median(tmp_tmp_tmp,axis=0)
-                master_sky_times[sk]=head_tmp['MJD-OBS']
-            write_fits(self.outpath+"master_skies_imlib.fits", master_skies2,verbose=debug)
-            write_fits(self.outpath+"master_sky_times.fits", master_sky_times,verbose=debug)
-
-            all_skies_imlib = np.zeros([n_sky*self.new_ndit_sky,self.final_sz,self.final_sz])
-            for sk, fits_name in enumerate(sky_list):
-                tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+fits_name, verbose=debug)
-                all_skies_imlib[sk*self.new_ndit_sky:(sk+1)*self.new_ndit_sky] = tmp[:self.new_ndit_sky]
-
             # Define mask for the region where the PCs will be optimal
             #make sure the mask avoids dark region.
             mask_arr = np.ones([self.com_sz,self.com_sz])
@@ -2596,18 +2974,27 @@ class raw_dataset:
             mask_width = int(self.shadow_r*0.8-mask_inner_rad)
             mask_AGPM = get_annulus_segments(mask_arr, mask_inner_rad, mask_width, mode = 'mask')[0]
             mask_AGPM = frame_crop(mask_AGPM,self.final_sz)
+            # flat boolean view of the mask so the PCA bases are decomposed on the masked
+            # pixels only - the annulus is a fraction of the frame
+            mask_flat = mask_AGPM.reshape(-1).astype(bool)
+            # prefix sums of the sky cube lengths: the library slice bounds become O(1)
+            # lookups instead of one np.sum pair per science cube
+            cum_ndit_sky = np.concatenate(([0], np.cumsum(self.real_ndit_sky))).astype(int)
             # Do PCA subtraction of the sky
             if plot:
-                tmp = np.median(tmp,axis = 0)
+                tmp = master_skies2[-1] # median of the last aligned SKY cube, computed above
                 tmp_tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+sci_list[-1],verbose=debug)
                 tmp_tmp = np.median(tmp_tmp,axis=0)
+                # one partial sort per frame for both cuts
+                vmin_sci, vmax_sci = np.percentile(tmp_tmp, [0.1, 99.9])
+                vmin_sky, vmax_sky = np.percentile(tmp, [0.1, 99.9])
             if plot == 'show':
-                plot_frames((tmp_tmp,tmp,mask_AGPM),vmin = (np.percentile(tmp_tmp,0.1),np.percentile(tmp,0.1),0),
-                            vmax = (np.percentile(tmp_tmp,99.9),np.percentile(tmp,99.9),1),
+                plot_frames((tmp_tmp,tmp,mask_AGPM),vmin = (vmin_sci,vmin_sky,0),
+                            vmax = (vmax_sci,vmax_sky,1),
                             label=('Science frame','Sky frame','Mask'), dpi=300, title = 'PCA Sky Subtract Mask')
             if plot == 'save':
-                plot_frames((tmp_tmp,tmp,mask_AGPM),vmin = (np.percentile(tmp_tmp,0.1),np.percentile(tmp,0.1),0),
-                            vmax = (np.percentile(tmp_tmp,99.9),np.percentile(tmp,99.9),1),
+                plot_frames((tmp_tmp,tmp,mask_AGPM),vmin = (vmin_sci,vmin_sky,0),
+                            vmax = (vmax_sci,vmax_sky,1),
                             label=('Science frame','Sky frame','Mask'), dpi=300,
                             save = self.outpath + 'PCA_sky_subtract_mask.pdf')
 
@@ -2627,24 +3014,31 @@ class raw_dataset:
                 test_idx = [0,int(len(sci_list)/2),len(sci_list)-1] # first, middle and last index in science list
                 npc_opt = np.zeros(len(test_idx)) # array of zeros the length of the number of test cubes
 
+                # boolean mask per dust speck, built ONCE - get_circle re-made its grid on every call
+                yy, xx = np.ogrid[:self.final_sz, :self.final_sz]
+                dust_masks = [(yy-xy[1])**2 + (xx-xy[0])**2 <= (3*self.fwhm)**2 for xy in dust_xy_all]
+
                 for sc,fits_idx in enumerate(test_idx): # iterate over the 3 indices
-                    _, head = open_fits(self.inpath+sci_list[fits_idx], verbose=debug, header=True) # open the cube and get the header
-                    sc_time = head['MJD-OBS'] # read this part of the header, float with the start time?
+                    sc_time = float(_getheader_fast(self.inpath+sci_list[fits_idx])['MJD-OBS']) # header block only, float with the start time
                     idx_sky = find_nearest(master_sky_times,sc_time) # finds the corresponding cube using the time
-                    tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+ sci_list[fits_idx], verbose=debug) # opens science cube
-                    pca_lib = all_skies_imlib[int(np.sum(self.real_ndit_sky[:idx_sky])):int(np.sum(self.real_ndit_sky[:idx_sky+1]))] # gets the sky cube?
-                    med_sky = np.median(pca_lib,axis=0) # takes median of the sky cubes
+                    tmp = _open_fits_fast(self.outpath+'3_AGPM_aligned_imlib_'+ sci_list[fits_idx], verbose=debug) # opens science cube
+                    pca_lib = all_skies_imlib[cum_ndit_sky[idx_sky]:cum_ndit_sky[idx_sky+1]] # gets the sky cube?
+                    med_sky = pca_lib.mean(axis=0, dtype=np.float32) # mean sky: single vectorised pass instead of a per-pixel sort, and any offset wrt the median is absorbed by the first PC of the centred library
+                    # the sky library only changes with med_sky, so decompose it ONCE at the
+                    # largest npc and evaluate every trial npc as a projection on the leading
+                    # components (rows are in ascending eigenvalue order, dominant PC last)
+                    lib = all_skies_imlib - med_sky
+                    sci = tmp - med_sky
+                    pcs_all = _pca_basis_gram(lib, ncomp=int(np.max(nnpc)), mask_flat=mask_flat)
                     mean_std = np.zeros(nnpc.shape[0]) # zeros array with length the number of principle components to test
                     hmean_std = np.zeros(nnpc.shape[0]) # same as above for some reason?
                     for nn, npc_tmp in enumerate(nnpc): # iterate over the number of principle components to test
-                        tmp_tmp = cube_subtract_sky_pca(tmp-med_sky, all_skies_imlib-med_sky,
-                                                                    mask_AGPM, ref_cube=None, ncomp=npc_tmp) # runs PCA sky subtraction
+                        tmp_tmp = _subtract_pca_gram(sci, lib, mask_AGPM, ncomp=npc_tmp,
+                                                     pcs=pcs_all[-npc_tmp:]) # runs PCA sky subtraction
                         #write_fits(self.outpath+'4_sky_subtr_medclose1_npc{}_imlib_'.format(npc_tmp)+sci_list[fits_idx], tmp_tmp, verbose=debug)
                         # measure mean(std) in all apertures in tmp_tmp, and record for each npc
-                        std = np.zeros(ndust_all) # zeros array the length of the number of dust objects
-                        for dd in range(ndust_all): # iterate over the number of dust specks
-                            std[dd] = np.std(get_circle(np.median(tmp_tmp,axis=0), 3*self.fwhm, mode = 'val',
-                                                                cy=dust_xy_all[dd][1], cx=dust_xy_all[dd][0])) # standard deviation of the values in a circle around the dust in median sky cube??
+                        med_img = _axis0_median(tmp_tmp) # median of the residuals, computed once per npc
+                        std = np.array([med_img[m].std() for m in dust_masks]) # std of the values in a circle around each dust speck
                         mean_std[nn] = np.mean(std) # mean of standard dev for that PC
                         std_sort = np.sort(std) # sort std from smallest to largest?
                         hmean_std[nn] = np.mean(std_sort[int(ndust_all/2.):]) # takes the mean of the higher std for second half of the dust specks?
@@ -2675,10 +3069,8 @@ class raw_dataset:
 #                                                                    mask_AGPM, ref_cube=None, ncomp=npc_tmp)
 #                        write_fits(self.outpath+'4_sky_subtr_medclose1_npc{}_imlib_'.format(npc_tmp)+fits_name, tmp_tmp, verbose=debug)
 #                        # measure mean(std) in all apertures in tmp_tmp, and record for each npc
-#                        std = np.zeros(ndust_all)
-#                        for dd in range(ndust_all):
-#                            std[dd] = np.std(get_circle(np.median(tmp_tmp,axis=0), 3*self.fwhm, mode = 'val',
-#                                                                cy=dust_xy_all[dd][1], cx=dust_xy_all[dd][0]))
+#                        med_img = _axis0_median(tmp_tmp) # one median per npc, shared by all specks
+#                        std = np.array([med_img[m].std() for m in dust_masks]) # prebuilt masks as in the active search
 #                        mean_std[nn] = np.mean(std)
 #                        std_sort = np.sort(std)
 #                        hmean_std[nn] = np.mean(std_sort[int(ndust_all/2.):])
@@ -2714,10 +3106,8 @@ class raw_dataset:
 #                                                                    mask_AGPM, ref_cube=None, ncomp=npc_tmp)
 #                        write_fits(self.outpath+'4_sky_subtr_medclose1_npc{}_imlib_'.format(npc_tmp)+fits_name, tmp_tmp, verbose=debug) # this should be the most common output of the final calibrated cubes
 #                        # measure mean(std) in all apertures in tmp_tmp, and record for each npc
-#                        std = np.zeros(ndust_all)
-#                        for dd in range(ndust_all):
-#                            std[dd] = np.std(get_circle(np.median(tmp_tmp,axis=0), 3*self.fwhm, mode = 'val',
-#                                                                cy=dust_xy_all[dd][1], cx=dust_xy_all[dd][0]))
+#                        med_img = _axis0_median(tmp_tmp) # one median per npc, shared by all specks
+#                        std = np.array([med_img[m].std() for m in dust_masks]) # prebuilt masks as in the active search
 #                        mean_std[nn] = np.mean(std)
 #                        std_sort = np.sort(std)
 #                        hmean_std[nn] = np.mean(std_sort[int(ndust_all/2.):])
@@ -2736,19 +3126,40 @@ class raw_dataset:
 #                write_fits(self.outpath+"TMP_npc_opt.fits",npc_opt)
 
            # else: # goes into this loop after it has found the optimal number of pcs
-            #bar = pyprind.ProgBar(n_sci, stream=1, title='Subtracting sky with PCA')
+            # the sky library only changes with the nearest-in-time sky group, and there are
+            # far fewer groups than science cubes - so match every cube to its group in one
+            # header sweep, decompose the library ONCE per group, and reduce each science
+            # cube to two gemms against the cached basis instead of a full PCA per cube
+            idx_sky_per_sc = [find_nearest(master_sky_times,
+                                           float(_getheader_fast(self.inpath+fname)['MJD-OBS']))
+                              for fname in sci_list] # header block only
+            med_sky_per_group = {}
+            pcs_per_group = {}
+            centered = np.empty_like(all_skies_imlib) # one buffer reused for every group's centring
+            for idx_sky in set(idx_sky_per_sc):
+                pca_lib = all_skies_imlib[cum_ndit_sky[idx_sky]:cum_ndit_sky[idx_sky+1]]
+                med_sky_per_group[idx_sky] = pca_lib.mean(axis=0, dtype=np.float32) # mean instead of median, see the npc search above
+                np.subtract(all_skies_imlib, med_sky_per_group[idx_sky], out=centered)
+                pcs_per_group[idx_sky] = _pca_basis_gram(centered, ncomp=npc, mask_flat=mask_flat)
+            # only the cached medians and bases are needed from here on - free the library
+            # before the workers fork so they do not inherit it
+            del all_skies_imlib, centered
+            # every cube of a group is independent once the basis is cached, so the groups
+            # are farmed out to the pool (parallelism is bounded by the number of groups,
+            # which is how the basis and median are shipped to each worker only once)
+            groups = {}
             for sc, fits_name in enumerate(sci_list): # previously sci_list_test
-                _, head = open_fits(self.inpath+sci_list[sc], verbose=debug, header=True) # open the cube and get the header
-                sc_time = head['MJD-OBS'] # read this part of the header, float with the start time?
-                idx_sky = find_nearest(master_sky_times,sc_time) # finds the corresponding cube using the time
-                tmp = open_fits(self.outpath+'3_AGPM_aligned_imlib_'+ sci_list[sc], verbose=debug) # opens science cube
-                pca_lib = all_skies_imlib[int(np.sum(self.real_ndit_sky[:idx_sky])):int(np.sum(self.real_ndit_sky[:idx_sky+1]))] # gets the sky cube?
-                med_sky = np.median(pca_lib,axis=0) # takes median of the sky cubes
-                tmp_tmp = cube_subtract_sky_pca(tmp-med_sky, all_skies_imlib-med_sky, mask_AGPM, ref_cube=None, ncomp=npc)
-                write_fits(self.outpath+'4_sky_subtr_imlib_'+fits_name, tmp_tmp, verbose=debug)
-                #bar.update()
-                if remove:
-                    os.system("rm "+self.outpath+'3_AGPM_aligned_imlib_'+fits_name)
+                groups.setdefault(idx_sky_per_sc[sc], []).append(fits_name)
+            # the workers hand back the frame medians of the cubes the plot needs, so the
+            # plot below does not reopen cubes that were just in a worker's memory
+            plot_names = {sci_list[0], sci_list[int(n_sci/2)], sci_list[-1]} if plot else set()
+            with multiprocessing.Pool(nproc) as pool:
+                plot_meds = {}
+                for res in pool.starmap(_pca_sky_group,
+                                        [(fnames, self.outpath, med_sky_per_group[idx_sky],
+                                          pcs_per_group[idx_sky], mask_AGPM, npc, remove, debug, plot_names)
+                                         for idx_sky, fnames in groups.items()]):
+                    plot_meds.update(res)
 
             if verbose:
                 print('Finished PCA dark subtraction')
@@ -2767,13 +3178,10 @@ class raw_dataset:
                     if plot == 'save':
                         plot_frames((tmp, tmp_tmp, tmp_tmp_tmp, tmp2, tmp_tmp2, tmp_tmp_tmp2), save = self.outpath + 'SCI_PCA_sky_subtraction')
                 else:
-                    # ... IF PCA WITH A SPECIFIC NPC
-                    old_tmp = np.median(open_fits(self.outpath+'3_AGPM_aligned_imlib_'+sci_list[0]), axis=0)
-                    old_tmp_tmp = np.median(open_fits(self.outpath+'3_AGPM_aligned_imlib_'+sci_list[int(n_sci/2)]), axis=0)
-                    old_tmp_tmp_tmp = np.median(open_fits(self.outpath+'3_AGPM_aligned_imlib_'+sci_list[-1]), axis=0)
-                    tmp2 = np.median(open_fits(self.outpath+'4_sky_subtr_imlib_'+sci_list[0]), axis=0)
-                    tmp_tmp2 = np.median(open_fits(self.outpath+'4_sky_subtr_imlib_'+sci_list[int(n_sci/2)]), axis=0)
-                    tmp_tmp_tmp2 = np.median(open_fits(self.outpath+'4_sky_subtr_imlib_'+sci_list[-1]), axis=0)
+                    # ... IF PCA WITH A SPECIFIC NPC - medians cached by the workers above
+                    old_tmp, tmp2 = plot_meds[sci_list[0]]
+                    old_tmp_tmp, tmp_tmp2 = plot_meds[sci_list[int(n_sci/2)]]
+                    old_tmp_tmp_tmp, tmp_tmp_tmp2 = plot_meds[sci_list[-1]]
                     if plot == 'show':
                         plot_frames((old_tmp, old_tmp_tmp, old_tmp_tmp_tmp, tmp2, tmp_tmp2, tmp_tmp_tmp2))
                     if plot == 'save':
@@ -2809,9 +3217,11 @@ class raw_dataset:
         # os.system("rm "+self.outpath+'TMP_med_bef_SKY_subtr.fits')
         # os.system("rm "+self.outpath+'TMP_npc_opt.fits')
         # os.system("rm "+self.outpath+'unsat_dark_cube.fits')
-        os.system("rm " + self.outpath + '1_*.fits')
-        os.system("rm " + self.outpath + '2_*.fits')
-        os.system("rm " + self.outpath + '3_*.fits')
+        # expand the patterns in python and unlink directly, instead of forking a shell
+        # per pattern; iglob streams the matches rather than building the full list
+        for pattern in ('1_*.fits', '2_*.fits', '3_*.fits'):
+            for path in glob.iglob(self.outpath + pattern):
+                _remove_file(path)
             
             
             
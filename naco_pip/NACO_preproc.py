@@ -12,6 +12,7 @@ import numpy as np
 import pyprind
 import os
 import pathlib
+import shutil
 from matplotlib import pyplot as plt
 from vip_hci.fits import open_fits, write_fits
 from vip_hci.preproc import cube_recenter_via_speckles, cube_recenter_2dfit,frame_shift, cube_detect_badfr_correlation, cube_crop_frames, frame_crop
@@ -39,9 +40,9 @@ class calib_dataset:  # this class is for pre-processing of the calibrated data
             del tmp
         self.dataset_dict = dataset_dict
         self.fast_reduction = dataset_dict['fast_reduction']
-        os.system("cp " + self.inpath + 'master_unsat-stellarpsf_fluxes.fits ' + self.outpath) # for use later
-        os.system("cp " + self.inpath + 'fwhm.fits ' + self.outpath)  # for use later
-        os.system("cp " + self.inpath + 'master_unsat_psf_norm.fits ' + self.outpath)  # for use later
+        shutil.copy(self.inpath + 'master_unsat-stellarpsf_fluxes.fits', self.outpath) # for use later, no shell fork
+        shutil.copy(self.inpath + 'fwhm.fits', self.outpath)  # for use later
+        shutil.copy(self.inpath + 'master_unsat_psf_norm.fits', self.outpath)  # for use later
 
     def recenter(self, nproc = 1, sigfactor = 4, subi_size = 21, crop_sz = None, verbose = True, debug = False, plot = False, coro = True):
         """